@@ -293,6 +293,9 @@ class Property(object):
         self.scopes = None
         self.toolsets = None
         self.__doc__ = doc
+        # (default expression,) if it's the same for all model parts, () if
+        # it isn't and None if not known yet
+        self._shared_default = None
 
     def _scope_is_directly_for(self, model_part):
         """True if the property is defined for this scope."""
@@ -347,8 +350,13 @@ class Property(object):
         :param throw_if_required: If False, returns NullExpr if the property
             is a required one (doesn't have a default value). If True,
             throws in that case.
+
+        The expressions are cached: defaults that don't depend on *for_obj*
+        are made only once, others are kept in *for_obj* until a variable
+        used to compute them changes (see
+        :meth:`bkl.model.ModelPart.cached_default_expr`).
         """
-        default = self._make_default_expr(self.default, for_obj)
+        default = self._get_default_expr(for_obj)
         if default is None:
             if throw_if_required:
                 raise error.UndefinedError("required property \"%s\" on %s not set" % (self.name, for_obj),
@@ -357,6 +365,30 @@ class Property(object):
                 return expr.NullExpr()
         return default
 
+    def is_default_shared(self):
+        """
+        Returns True if the default expression is the same object for all
+        model parts, i.e. doesn't reference any variables and isn't computed
+        by a function. Only valid after :meth:`default_expr` was called.
+        """
+        return bool(self._shared_default)
+
+    def _get_default_expr(self, for_obj):
+        shared = self._shared_default
+        if shared:
+            return shared[0]
+        if shared is None:
+            if _is_context_free(self.default):
+                e = self._make_default_expr(self.default, for_obj)
+                if e is None or not expr.has_references(e):
+                    self._shared_default = (e,)
+                    return e
+            self._shared_default = ()
+        cached = getattr(for_obj, "cached_default_expr", None)
+        if cached is None:
+            return self._make_default_expr(self.default, for_obj)
+        return cached(self, lambda: self._make_default_expr(self.default, for_obj))
+
     def _make_default_expr(self, val, for_obj):
         if hasattr(val, "__call__"):
             # default is defined as a callback function
@@ -377,9 +409,14 @@ class Property(object):
 
     def _parse_expr(self, e, for_obj):
         from interpreter.builder import Builder
-        from parser import get_parser
-        pars = get_parser("%s;" % e)
-        e = Builder().create_expression(pars.expression().tree, for_obj)
+        try:
+            ast = _parsed_defaults[e]
+        except KeyError:
+            from parser import get_parser
+            from parser.ast import compact
+            pars = get_parser("%s;" % e)
+            ast = _parsed_defaults[e] = compact(pars.expression().tree, None)
+        e = Builder().create_expression(ast, for_obj)
         e = self.type.normalize(e)
         self.type.validate(e)
         return e
@@ -391,6 +428,20 @@ class Property(object):
             self.toolsets = [toolset]
 
 
+
+# Parsed ASTs of the default values given as strings. They are shared by all
+# properties, as the same strings are often used for many of them.
+_parsed_defaults = {}
+
+def _is_context_free(val):
+    # default value that is made into the same expression in any context
+    if hasattr(val, "__call__"):
+        return False
+    if isinstance(val, list):
+        return all(_is_context_free(x) for x in val)
+    return True
+
+
 class BuildNode(object):
     """
     BuildNode represents a single node in traditional make-style build graph.
@@ -696,3 +747,15 @@ class CustomStep(Extension):
         It is permitted to create output files in this method.
         """
         pass
+
+    def passes(self):
+        """
+        Returns list of additional passes to run on the model, as
+        :class:`bkl.interpreter.passmanager.Pass` objects. Unlike
+        :meth:`finalize()`, passes can be run on toolset-specific models too
+        and can be ordered relatively to the standard passes (see
+        :mod:`bkl.interpreter.passes`) by depending on them.
+
+        Returns empty list by default.
+        """
+        return []
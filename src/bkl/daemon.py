@@ -0,0 +1,299 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Long-running Bakefile process serving requests from clients.
+
+Every run of ``bkl`` pays for starting Python, loading plugins, initializing
+properties and parsing all input files. :class:`Daemon` keeps all of this in
+memory between runs: it listens on a Unix socket for requests from clients
+(see ``bkl --connect``) and processes them as ``bkl`` would, sending the
+output back to the client as it is produced.
+
+Input files used by the processed projects are watched for changes. When a
+``.bkl`` file changes, its parsed AST is discarded and the project the daemon
+was started for is regenerated. When a plugin changes, the daemon restarts
+itself, because loaded plugins can't be replaced.
+
+The protocol is line-based: the client sends a single JSON object with
+``argv`` (command line arguments) and ``cwd`` (directory to run in) keys and
+the daemon replies with JSON arrays ``["stdout", text]``, ``["stderr",
+text]`` and finally ``["exit", code]``.
+"""
+
+import os
+import os.path
+import sys
+import json
+import signal
+import socket
+import logging
+import traceback
+import contextlib
+import SocketServer
+
+import bkl.parser
+import bkl.manifest
+import bkl.interpreter
+from bkl.error import Error
+
+logger = logging.getLogger("bkl.daemon")
+
+#: How often to check the watched files for changes, in seconds.
+poll_interval = 1.0
+
+# Maximum number of parsed files kept in memory.
+_MAX_PARSED_FILES = 10000
+
+
+def is_available():
+    """Returns True if the daemon can be used on this platform."""
+    return hasattr(socket, "AF_UNIX")
+
+
+def _get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class _Terminated(BaseException):
+    """Raised when the daemon is asked to terminate."""
+    pass
+
+
+class _ClientStream(object):
+    """File-like object sending everything written to it to the client."""
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+        self.broken = False
+
+    def write(self, text):
+        if self.broken:
+            return
+        if not isinstance(text, unicode):
+            text = text.decode("utf-8", "replace")
+        try:
+            self.wfile.write(json.dumps([self.name, text]) + "\n")
+            self.wfile.flush()
+        except socket.error:
+            # the client went away, but the request is still completed
+            self.broken = True
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+@contextlib.contextmanager
+def _redirected_output(stdout, stderr):
+    """
+    Redirects standard output and error output, including log handlers
+    writing to it, to given streams. Log level is restored afterwards too.
+    """
+    root = logging.getLogger()
+    handlers = [h for h in root.handlers
+                if isinstance(h, logging.StreamHandler) and h.stream is sys.stderr]
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    old_level = root.level
+    sys.stdout, sys.stderr = stdout, stderr
+    for h in handlers:
+        h.stream = stderr
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+        for h in handlers:
+            h.stream = old_stderr
+        root.setLevel(old_level)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # just checking if the daemon is running
+            return
+        try:
+            request = json.loads(line)
+            argv = [str(a) for a in request["argv"]]
+            cwd = request["cwd"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("ignoring malformed request")
+            return
+        code = self.server.run(argv, cwd,
+                               _ClientStream(self.wfile, "stdout"),
+                               _ClientStream(self.wfile, "stderr"))
+        try:
+            self.wfile.write(json.dumps(["exit", code]) + "\n")
+        except socket.error:
+            pass
+
+
+class Daemon(SocketServer.UnixStreamServer):
+    """
+    Daemon listening on Unix socket *path*.
+
+    Requests are processed by calling *handler* with the list of command line
+    arguments, in the directory given by the client. The handler should do
+    exactly what ``bkl`` does with them and return the exit code. Anything it
+    writes to standard output or logs is sent to the client.
+
+    *argv* are the arguments of the project the daemon is started for: it is
+    processed immediately by :meth:`serve` and again whenever its input files
+    change.
+    """
+    def __init__(self, path, handler, argv):
+        if os.path.exists(path):
+            s = socket.socket(socket.AF_UNIX)
+            try:
+                s.connect(path)
+            except socket.error:
+                # left behind by a daemon that didn't exit cleanly
+                os.remove(path)
+            else:
+                raise Error("another daemon is already listening on %s" % path)
+            finally:
+                s.close()
+        SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.path = path
+        self.handler = handler
+        self.argv = argv
+        self.timeout = poll_interval
+        self._cwd = os.getcwd()
+        # directory relative to which filenames of parsed files are given
+        self._parsed_in = self._cwd
+        # watched files, as filename -> mtime
+        self._watched = {}
+        bkl.parser.keep_parsed_files = True
+        bkl.parser._parse_file.maxsize = _MAX_PARSED_FILES
+
+
+    def serve(self):
+        """
+        Processes the project given by :attr:`argv` and then serves requests
+        until interrupted.
+        """
+        def on_terminate(signum, frame):
+            raise _Terminated()
+        signal.signal(signal.SIGTERM, on_terminate)
+
+        logger.info("bakefile daemon listening on %s", self.path)
+        try:
+            self.run(self.argv, self._cwd)
+            while True:
+                self.handle_request()
+        except _Terminated:
+            logger.info("bakefile daemon terminated")
+        finally:
+            self.close()
+
+
+    def close(self):
+        """Stops listening and removes the socket."""
+        self.server_close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+    def handle_timeout(self):
+        if self._check_changes():
+            logger.info("regenerating after changes")
+            self.run(self.argv, self._cwd)
+
+
+    def run(self, argv, cwd, stdout=None, stderr=None):
+        """
+        Processes *argv* in *cwd* by calling the handler, after checking for
+        changes of the watched files, with its output redirected to *stdout*
+        and *stderr* (if given). Returns exit code.
+        """
+        self._check_changes()
+        if cwd != self._parsed_in:
+            # files are identified by their names relative to the directory
+            bkl.parser.parse_file.clear()
+            self._parsed_in = cwd
+        bkl.interpreter.reset_state()
+
+        os.chdir(cwd)
+        try:
+            with _redirected_output(stdout or sys.stdout, stderr or sys.stderr):
+                try:
+                    code = self.handler(argv)
+                except SystemExit as e:
+                    code = e.code
+                    if code is not None and not isinstance(code, int):
+                        sys.stderr.write("%s\n" % code)
+                        code = 1
+                except Exception:
+                    sys.stderr.write(traceback.format_exc())
+                    code = 1
+        finally:
+            os.chdir(self._cwd)
+
+        for filename in bkl.manifest._inputs:
+            if filename not in self._watched:
+                self._watched[filename] = _get_mtime(filename)
+        return code or 0
+
+
+    def _check_changes(self):
+        """
+        Checks watched files for changes and discards parsed ASTs of the
+        changed ones; restarts the daemon if a plugin changed. Returns True if
+        anything changed.
+        """
+        changed = set()
+        for filename, mtime in self._watched.iteritems():
+            new_mtime = _get_mtime(filename)
+            if new_mtime != mtime:
+                logger.info("%s changed", filename)
+                self._watched[filename] = new_mtime
+                changed.add(filename)
+        if not changed:
+            return False
+
+        for filename in changed:
+            if filename.endswith(".py"):
+                self._restart()
+
+        cache = bkl.parser._parse_file.cache
+        for args in cache.keys():
+            if os.path.normpath(os.path.join(self._parsed_in, args[0])) in changed:
+                bkl.parser.parse_file.forget(*args)
+        return True
+
+
+    def _restart(self):
+        logger.info("plugins changed, restarting the daemon")
+        self.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -85,11 +85,10 @@ class DumpingInterpreter(Interpreter):
 
     def generate(self):
         if self.toolset:
-            model = self.make_toolset_specific_model(self.toolset)
-            self.finalize_for_toolset(model, self.toolset)
+            model = self.prepare_toolset_model(self.toolset)
+            print dump_project(model)
         else:
-            model = self.model
-        print dump_project(model)
+            print dump_project(self.model)
 
 
 def _indent(text):
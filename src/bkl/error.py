@@ -63,6 +63,18 @@ class Error(Exception):
         else:
             return self.msg
 
+    def __reduce__(self):
+        # Constructors of derived classes take different arguments, so
+        # pickling (needed to pass errors between processes) can't rely on
+        # calling them:
+        return (_unpickle_error, (self.__class__, self.__dict__))
+
+
+def _unpickle_error(cls, state):
+    e = cls.__new__(cls)
+    e.__dict__.update(state)
+    return e
+
 
 class ParserError(Error):
     """
@@ -53,6 +53,9 @@ class Expr(object):
 
        Location of the expression in source tree.
     """
+    # there are lots of expressions in the model, so they are kept small
+    __slots__ = ("pos",)
+
     def __init__(self, pos=None):
         self.pos = pos
     
@@ -126,6 +129,8 @@ class LiteralExpr(Expr):
 
        Location of the expression in source tree.
     """
+    __slots__ = ("value",)
+
     def __init__(self, value, pos=None):
         super(LiteralExpr, self).__init__(pos)
         self.value = value
@@ -144,6 +149,8 @@ class ListExpr(Expr):
     """
     List expression -- list of several values of the same type.
     """
+    __slots__ = ("items",)
+
     def __init__(self, items, pos=None):
         super(ListExpr, self).__init__(pos)
         self.items = items
@@ -169,6 +176,8 @@ class ConcatExpr(Expr):
     Concatenation of several expression. Typically, used with LiteralExpr
     and ReferenceExpr to express values such as "$(foo).cpp".
     """
+    __slots__ = ("items",)
+
     def __init__(self, items, pos=None):
         super(ConcatExpr, self).__init__(pos)
         assert len(items) > 0
@@ -192,6 +201,8 @@ class NullExpr(Expr):
     """
     Empty/unset value.
     """
+    __slots__ = ()
+
     def as_py(self):
         return None
 
@@ -218,6 +229,8 @@ class PlaceholderExpr(Expr):
 
        Name of referenced setting (e.g. "config" or "toolset").
     """
+    __slots__ = ("var",)
+
     def __init__(self, var, pos=None):
         super(PlaceholderExpr, self).__init__(pos)
         self.var = var
@@ -243,6 +256,8 @@ class ReferenceExpr(Expr):
        the appropriate :class:`bkl.model.ModelPart` instance (e.g. a target
        or a module).
     """
+    __slots__ = ("var", "context")
+
     def __init__(self, var, context, pos=None):
         super(ReferenceExpr, self).__init__(pos)
         self.var = var
@@ -251,13 +266,20 @@ class ReferenceExpr(Expr):
     def as_py(self):
         return self.get_value().as_py()
 
+    def get_context(self):
+        """
+        Returns the model part the reference is resolved in, i.e.
+        :attr:`context`.
+        """
+        return self.context
+
     def get_value(self):
         """
         Returns value of the referenced variable. Throws an exception if
         the reference couldn't be resolved.
         """
         with error_context(self):
-            return self.context.get_variable_value(self.var)
+            return self.get_context().get_variable_value(self.var)
 
     def get_variable(self):
         """
@@ -271,7 +293,7 @@ class ReferenceExpr(Expr):
         wasn't explicitly set and uses the default value.
         """
         with error_context(self):
-            return self.context.resolve_variable(self.var)
+            return self.get_context().resolve_variable(self.var)
 
     def __nonzero__(self):
         return bool(self.get_value())
@@ -288,6 +310,8 @@ class BoolValueExpr(Expr):
 
        Value of the literal, as (Python) boolean.
     """
+    __slots__ = ("value",)
+
     def __init__(self, value, pos=None):
         super(BoolValueExpr, self).__init__(pos)
         self.value = value
@@ -319,6 +343,7 @@ class BoolExpr(Expr):
 
        Right operand. Not set for the NOT operator.
     """
+    __slots__ = ("operator", "left", "right")
 
     #: And operator
     AND       = "&&"
@@ -403,6 +428,8 @@ class IfExpr(Expr):
 
        Value of the expression if the condition evaluates to False.
     """
+    __slots__ = ("cond", "value_yes", "value_no")
+
     def __init__(self, cond, yes, no, pos=None):
         super(IfExpr, self).__init__(pos)
         self.cond = cond
@@ -484,6 +511,8 @@ class PathExpr(Expr):
 
        Location of the expression in source tree.
     """
+    __slots__ = ("components", "anchor", "anchor_file")
+
     def __init__(self, components, anchor=ANCHOR_SRCDIR, anchor_file=None, pos=None):
         super(PathExpr, self).__init__(pos)
         if anchor_file is None and pos is not None:
@@ -617,6 +646,113 @@ class PathExpr(Expr):
         return isinstance(first, PlaceholderExpr)
 
 
+class ExprFactory(object):
+    """
+    Creates expression objects. Code building big models, in particular
+    :class:`bkl.interpreter.builder.Builder`, creates expressions through a
+    factory instead of directly, so that :class:`InterningExprFactory` can be
+    used instead of this one, which simply creates new objects.
+    """
+    def literal(self, value, pos=None):
+        return LiteralExpr(value, pos=pos)
+
+    def bool_value(self, value, pos=None):
+        return BoolValueExpr(value, pos=pos)
+
+    def null(self, pos=None):
+        return NullExpr(pos=pos)
+
+    def placeholder(self, var, pos=None):
+        return PlaceholderExpr(var, pos=pos)
+
+    def reference(self, var, context, pos=None):
+        return ReferenceExpr(var, context, pos=pos)
+
+    def list(self, items, pos=None):
+        return ListExpr(items, pos=pos)
+
+    def concat(self, items, pos=None):
+        return ConcatExpr(items, pos=pos)
+
+    def bool(self, operator, left, right=None, pos=None):
+        return BoolExpr(operator, left, right, pos=pos)
+
+    def if_(self, cond, yes, no, pos=None):
+        return IfExpr(cond, yes, no, pos=pos)
+
+    def path(self, components, anchor=ANCHOR_SRCDIR, anchor_file=None, pos=None):
+        if anchor_file is None and pos is not None:
+            anchor_file = pos.filename
+        return PathExpr(components, anchor, anchor_file, pos=pos)
+
+
+class InterningExprFactory(ExprFactory):
+    """
+    Expressions factory that hash-conses the expressions it creates: it
+    returns the same object for all structurally identical expressions,
+    which saves memory and makes comparing them cheap (see
+    :func:`are_equal`). Consequently, strings of equal literals are
+    shared too.
+
+    Expressions are identified by their type, values and identities of
+    their subexpressions, so the identifying key is computed in constant
+    time when the subexpressions come from the same factory. Positions are
+    not part of the identity: an expression has the position of its first
+    occurrence, so errors may be reported at another place where the same
+    expression is used.
+
+    As the expressions are shared, they must not be modified in any way,
+    including their :attr:`Expr.pos`. The factory keeps all expressions
+    created by it alive.
+    """
+    def __init__(self):
+        self._exprs = {}
+
+    def _make(self, key, cls, *args, **kwargs):
+        e = self._exprs.get(key)
+        if e is None:
+            e = self._exprs[key] = cls(*args, **kwargs)
+        return e
+
+    def literal(self, value, pos=None):
+        return self._make((LiteralExpr, type(value), value), LiteralExpr, value, pos=pos)
+
+    def bool_value(self, value, pos=None):
+        return self._make((BoolValueExpr, value), BoolValueExpr, value, pos=pos)
+
+    def null(self, pos=None):
+        return self._make(NullExpr, NullExpr, pos=pos)
+
+    def placeholder(self, var, pos=None):
+        return self._make((PlaceholderExpr, var), PlaceholderExpr, var, pos=pos)
+
+    def reference(self, var, context, pos=None):
+        return self._make((ReferenceExpr, var, id(context)),
+                          ReferenceExpr, var, context, pos=pos)
+
+    def list(self, items, pos=None):
+        return self._make((ListExpr,) + tuple(id(x) for x in items),
+                          ListExpr, items, pos=pos)
+
+    def concat(self, items, pos=None):
+        return self._make((ConcatExpr,) + tuple(id(x) for x in items),
+                          ConcatExpr, items, pos=pos)
+
+    def bool(self, operator, left, right=None, pos=None):
+        return self._make((BoolExpr, operator, id(left), id(right)),
+                          BoolExpr, operator, left, right, pos=pos)
+
+    def if_(self, cond, yes, no, pos=None):
+        return self._make((IfExpr, id(cond), id(yes), id(no)),
+                          IfExpr, cond, yes, no, pos=pos)
+
+    def path(self, components, anchor=ANCHOR_SRCDIR, anchor_file=None, pos=None):
+        if anchor_file is None and pos is not None:
+            anchor_file = pos.filename
+        return self._make((PathExpr, anchor, anchor_file) + tuple(id(x) for x in components),
+                          PathExpr, components, anchor, anchor_file, pos=pos)
+
+
 class Visitor(object):
     """
     Implements visitor pattern for :class:`Expr` expressions. This is abstract
@@ -1228,6 +1364,37 @@ def get_model_name_from_path(e):
         return _ModelNameFromPathVisitor().visit(e)
 
 
+class _HasReferencesVisitor(Visitor):
+    """
+    Helper for the has_references() function.
+    """
+    def __init__(self):
+        super(_HasReferencesVisitor, self).__init__()
+        self.found = False
+
+    null = Visitor.noop
+    literal = Visitor.noop
+    bool_value = Visitor.noop
+    placeholder = Visitor.noop
+    list = Visitor.visit_children
+    concat = Visitor.visit_children
+    path = Visitor.visit_children
+    bool = Visitor.visit_children
+    if_ = Visitor.visit_children
+
+    def reference(self, e):
+        self.found = True
+
+
+def has_references(e):
+    """
+    Returns True if expression *e* contains any references to variables.
+    """
+    v = _HasReferencesVisitor()
+    v.visit(e)
+    return v.found
+
+
 class _KeepPossibleValuesUnexpandedVisitor(Visitor):
     """
     Visitor determining if a reference should be expanded when determining its
@@ -1467,6 +1634,9 @@ def are_equal(a, b, _inside_cond=False):
     Throws the CannotDetermineError exception if it cannot reliably
     determine equality.
     """
+    if a is b:
+        # common with expressions from InterningExprFactory
+        return True
     a_is_expr = isinstance(a, Expr)
     b_is_expr = isinstance(b, Expr)
     try:
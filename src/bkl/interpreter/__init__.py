@@ -30,10 +30,17 @@ This module contains the very core of Bakefile -- the interpreter,
 import logging
 
 import bkl.parser
+import bkl.parser.prefetch
 import bkl.model
 import bkl.api
 import bkl.expr
+import bkl.io
+import bkl.manifest
 import passes
+import analyze
+import parallel
+import snapshot
+from passmanager import PassManager, FINALIZE, FAMILY, TOOLSET
 from builder import Builder
 from bkl.error import Error, warning
 from bkl.parser import parse_file
@@ -65,11 +72,80 @@ class Interpreter(object):
 
        If :const:`None` (the default), then the toolsets listed in the bakefile
        are used.
+
+    .. attribute:: jobs
+
+       Number of processes to use for the work that can be done in parallel,
+       i.e. parsing of input files and generating outputs for different
+       toolsets (see :mod:`bkl.interpreter.parallel`). The default is 1, i.e.
+       everything is done in the current process.
+
+    .. attribute:: streaming
+
+       If True, input files are parsed and added to the model one top-level
+       statement at a time (see :func:`bkl.parser.parse_file_streaming`),
+       instead of parsing the whole file first, which reduces peak memory
+       usage. The resulting model is the same. Off by default.
+
+    .. attribute:: pass_manager
+
+       :class:`bkl.interpreter.passmanager.PassManager` with the passes run
+       by :meth:`finalize` and :meth:`finalize_for_toolset`: the standard
+       ones and those added by plugins (see :meth:`bkl.api.CustomStep.passes`).
+
+    .. attribute:: early_specialization
+
+       If True and :attr:`toolsets_to_use` is set, the model is built only
+       for these toolsets: content of ``if`` statements that can't apply to
+       any of them is skipped by the builder (see
+       :attr:`bkl.interpreter.builder.Builder.toolsets`), which saves the
+       work of finalizing it. Off by default.
+
+    .. attribute:: intern_expressions
+
+       If True, identical expressions in the model built from the input
+       files are shared (see :class:`bkl.expr.InterningExprFactory`), which
+       reduces memory use, at the cost of errors in them possibly being
+       reported at another place where the same expression is used. Off by
+       default.
+
+    .. attribute:: share_toolset_families
+
+       If True (the default), toolset-specific models for toolsets of the
+       same family, e.g. all makefile-based ones, are made from a model
+       shared by them (see :meth:`make_family_model`), so that the work that
+       doesn't depend on the exact toolset is done only once.
+
+    .. attribute:: snapshot_dir
+
+       Directory with snapshots of finalized models (see
+       :mod:`bkl.interpreter.snapshot`). If set, :meth:`process_file` uses
+       the snapshot instead of building the model if the inputs didn't
+       change and saves it otherwise. :const:`None` (the default) disables
+       snapshots.
+
+    .. attribute:: verify_snapshot
+
+       If True, :meth:`process_file` always builds the model from scratch
+       and reports an error if it differs from the snapshot.
     """
 
     def __init__(self):
         self.model = bkl.model.Project()
         self.toolsets_to_use = None
+        self.jobs = 1
+        self.streaming = False
+        self.early_specialization = False
+        self.intern_expressions = False
+        self._expr_factory = None
+        self.share_toolset_families = True
+        self._family_models = {}
+        self.snapshot_dir = None
+        self.verify_snapshot = False
+        # file whose model is snapshotted
+        self._snapshot_of = None
+        self.pass_manager = PassManager(passes.standard_passes())
+        self._steps_with_passes = set()
 
 
     def limit_toolsets(self, toolsets):
@@ -102,6 +178,7 @@ class Interpreter(object):
         Step 1 is done by :meth:`add_module`. Steps 2-4 are done by
         :meth:`finalize` and step 5 is implemented in :meth:`generate`.
         """
+        self._snapshot_of = None
         self.add_module(ast, self.model)
         self.finalize()
         self.generate()
@@ -109,7 +186,71 @@ class Interpreter(object):
 
     def process_file(self, filename):
         """Like :meth:`process()`, but takes filename as its argument."""
-        self.process(parse_file(filename))
+        self._snapshot_of = filename if self.snapshot_dir else None
+        model = self._load_snapshot()
+        if model is None or self.verify_snapshot:
+            with snapshot.WarningsRecorder() as recorder:
+                self._build_model_from_file(filename)
+            self._check_snapshot(model, self.model, recorder.warnings)
+        else:
+            self.model = model
+        self.generate()
+
+
+    def _build_model_from_file(self, filename):
+        if self.jobs > 1:
+            bkl.parser.prefetch.prefetch(filename, self.jobs)
+        if self.streaming:
+            self.add_module_from_file(filename, self.model)
+        else:
+            self.add_module(parse_file(filename), self.model)
+        self.finalize()
+
+
+    def _load_snapshot(self, toolset=None):
+        if not self._snapshot_of:
+            return None
+        return snapshot.load(self.snapshot_dir, self._snapshot_of, self._snapshot_options(),
+                             replay_warnings=not self.verify_snapshot,
+                             toolset=toolset)
+
+
+    def _snapshot_options(self):
+        # options influencing the finalized model
+        if self.early_specialization and self.toolsets_to_use:
+            specialized_for = sorted(self.toolsets_to_use)
+        else:
+            specialized_for = None
+        return {"skip_diagnostics": self.pass_manager.skip_diagnostics,
+                "specialized_for": specialized_for}
+
+
+    def _check_snapshot(self, loaded_model, model, warnings, toolset=None):
+        """
+        Saves snapshot of *model* just built if there was none, or verifies
+        that the *loaded_model* from the snapshot is the same.
+        """
+        if not self._snapshot_of:
+            return
+        if loaded_model is None:
+            snapshot.save(self.snapshot_dir, self._snapshot_of, self._snapshot_options(),
+                          model, warnings, toolset=toolset)
+            return
+
+        import difflib
+        from bkl.dumper import dump_project
+        expected = dump_project(model)
+        found = dump_project(loaded_model)
+        what = self._snapshot_of
+        if toolset:
+            what += " for toolset %s" % toolset
+        if found != expected:
+            snapshot.remove(self.snapshot_dir, self._snapshot_of, toolset)
+            for line in difflib.unified_diff(expected.splitlines(), found.splitlines(),
+                                             "rebuilt", "snapshot", lineterm=""):
+                logger.debug("%s", line)
+            raise Error("snapshot of the model of %s differs from the model built from scratch" % what)
+        logger.debug("snapshot of %s verified", what)
 
 
     def add_module(self, ast, parent):
@@ -123,14 +264,54 @@ class Interpreter(object):
         logger.info("processing %s", ast.filename)
 
         submodules = []
-        b = Builder(on_submodule=lambda fn, pos: submodules.append((fn,pos)))
+        b = self._make_builder(submodules)
 
         module = b.create_model(ast, parent)
+        # the file isn't going to be needed again, don't keep it in memory
+        if not bkl.parser.keep_parsed_files:
+            parse_file.forget(ast.filename)
+
+        self._add_submodules(submodules, module)
+
+
+    def add_module_from_file(self, filename, parent):
+        """
+        Like :meth:`add_module`, but parses *filename* while adding it to the
+        model, passing every statement to the builder as soon as it's parsed
+        (see :attr:`streaming`).
+        """
+        logger.info("processing %s", filename)
 
+        submodules = []
+        b = self._make_builder(submodules)
+
+        module = b.start_model(filename, parent)
+        bkl.parser.parse_file_streaming(filename, b.handle_statement)
+
+        self._add_submodules(submodules, module)
+
+
+    def _make_builder(self, submodules):
+        if self.early_specialization and self.toolsets_to_use:
+            toolsets = self.toolsets_to_use
+        else:
+            toolsets = None
+        if self.intern_expressions and self._expr_factory is None:
+            # shared by all modules, they use many identical literals
+            self._expr_factory = bkl.expr.InterningExprFactory()
+        return Builder(on_submodule=lambda fn, pos: submodules.append((fn,pos)),
+                       toolsets=toolsets,
+                       exprs=self._expr_factory if self.intern_expressions else None)
+
+
+    def _add_submodules(self, submodules, module):
         while submodules:
             sub_filename, sub_pos = submodules[0]
             submodules.pop(0)
             try:
+                if self.streaming:
+                    self.add_module_from_file(sub_filename, module)
+                    continue
                 sub_ast = parse_file(sub_filename)
             except IOError as e:
                 if e.filename:
@@ -147,59 +328,83 @@ class Interpreter(object):
             getattr(step, func)(model)
 
 
+    def _register_custom_passes(self):
+        for step in bkl.api.CustomStep.all():
+            if step.name in self._steps_with_passes:
+                continue
+            self._steps_with_passes.add(step.name)
+            for p in step.passes():
+                logger.debug("registering pass %s of custom step %s", p, step.name)
+                self.pass_manager.register(p)
+
+
     def finalize(self):
         """
         Finalizes the model, i.e. checks it for validity, optimizes, creates
         per-toolset models etc.
         """
         logger.debug("finalizing the model")
+        # the model is complete, don't keep expressions replaced when
+        # finalizing it alive:
+        self._expr_factory = None
 
         # call any custom steps first:
         self._call_custom_steps(self.model, "finalize")
 
-        # then apply standard processing:
-        passes.detect_potential_problems(self.model)
-        passes.normalize_and_validate_bool_subexpressions(self.model)
-        passes.normalize_vars(self.model)
-        passes.validate_vars(self.model)
-        passes.normalize_paths_in_model(self.model, toolset=None)
-        passes.simplify_exprs(self.model)
+        # then apply standard processing and passes added by plugins:
+        self._register_custom_passes()
+        self.pass_manager.run(FINALIZE, self.model)
 
 
     def finalize_for_toolset(self, toolset_model, toolset):
         """
         Finalizes after "toolset" variable was set.
         """
-        passes.remove_disabled_model_parts(toolset_model, toolset)
+        self._register_custom_passes()
+        self.pass_manager.run(TOOLSET, toolset_model, toolset)
 
-        # TODO: do this in finalize() instead
-        passes.make_variables_for_missing_props(toolset_model, toolset)
 
-        passes.eliminate_superfluous_conditionals(toolset_model)
-
-        # This is done second time here (in addition to finalize()) to deal
-        # with paths added by make_variables_for_missing_props() and paths with
-        # @builddir (which is toolset specific and couldn't be resolved
-        # earlier).  Ideally we wouldn't do it, but hopefully it's not all that
-        # inefficient, as no real work is done for paths that are already
-        # normalized:
-        passes.normalize_paths_in_model(toolset_model, toolset)
+    def make_family_model(self, toolsets):
+        """
+        Returns copy of the model shared by *toolsets*, a family of similar
+        toolsets, with the family phase passes run on it (see
+        :mod:`bkl.interpreter.passmanager`). Toolset-specific models can be
+        made from it with :meth:`make_toolset_specific_model` more cheaply
+        than from the common model.
+        """
+        logger.debug("****** preparing model for toolsets %s ******", ", ".join(toolsets))
+        model = self.model.clone()
+        self._register_custom_passes()
+        self.pass_manager.run(FAMILY, model, list(toolsets))
+        return model
 
 
-    def make_toolset_specific_model(self, toolset, skip_making_copy=False):
+    def make_toolset_specific_model(self, toolset, skip_making_copy=False, base=None):
         """
         Returns toolset-specific model, i.e. one that works only with
         *toolset*, has the ``toolset`` property set to it. The caller
         still needs to call finalize_for_toolset() on it.
+
+        The model is made from *base*, which is the common model by default,
+        but may be also a model made by :meth:`make_family_model` for a
+        family including *toolset*.
         """
+        if base is None:
+            base = self.model
         if skip_making_copy:
-            model = self.model
+            model = base
+        else:
+            model = base.clone()
+        value = bkl.expr.LiteralExpr(toolset)
+        var = model.get_variable("toolset")
+        if var is None:
+            # don't use Variable.from_property(), because it's read-only
+            model.add_variable(bkl.model.Variable.from_property(
+                                                  model.get_prop("toolset"), value))
         else:
-            model = self.model.clone()
-        # don't use Variable.from_property(), because it's read-only
-        model.add_variable(bkl.model.Variable.from_property(
-                                              model.get_prop("toolset"),
-                                              bkl.expr.LiteralExpr(toolset)))
+            # the family's model has the default placeholder value already:
+            model.update_variable_value(var, value)
+            model.get_variable("toolset").is_explicitly_set = True
         return model
 
 
@@ -222,11 +427,16 @@ class Interpreter(object):
                     except KeyError:
                         raise Error("unknown toolset \"%s\" given on command line" % t)
                     warning("toolset \"%s\" is not supported by the project, there may be issues", t)
+                    # the model differs from the snapshotted one now:
+                    self._snapshot_of = None
                     # Add the forced toolset to all submodules:
                     for module in self.model.modules:
                         module_toolsets = module.get_variable("toolsets")
                         if module_toolsets:
-                            module_toolsets.value.items.append(bkl.expr.LiteralExpr(t))
+                            # don't modify the list, expressions may be shared
+                            value = module_toolsets.value
+                            module_toolsets.value = bkl.expr.ListExpr(
+                                    value.items + [bkl.expr.LiteralExpr(t)], pos=value.pos)
             toolsets = self.toolsets_to_use
 
         toolsets = list(toolsets)
@@ -238,21 +448,113 @@ class Interpreter(object):
         # call any custom steps first:
         self._call_custom_steps(self.model, "generate")
 
+        if self.jobs > 1 and len(toolsets) > 1 and parallel.is_available():
+            # every worker process has its own copy of the model, so no
+            # copies need to be made at all:
+            parallel.generate_for_toolsets(self, toolsets, self.jobs)
+            return
+
         # and generate the outputs (notice that we can avoid making a
         # (expensive!) deepcopy of the model for one of the toolsets and can
-        # reuse the current model):
-        for toolset in toolsets[:-1]:
-            self.generate_for_toolset(toolset)
-        self.generate_for_toolset(toolsets[-1], skip_making_copy=True)
+        # reuse the current model, or the model shared by the family):
+        if self.share_toolset_families:
+            families = _group_by_family(toolsets)
+        else:
+            families = [[t] for t in toolsets]
+        for family in families:
+            if len(family) == 1:
+                self.generate_for_toolset(family[0],
+                                          skip_making_copy=(family is families[-1]))
+                continue
+            for toolset in family[:-1]:
+                self.generate_for_toolset(toolset, family=family)
+            self.generate_for_toolset(family[-1], skip_making_copy=True, family=family)
+
+
+    def generate_for_toolset(self, toolset, skip_making_copy=False, family=None):
+        """
+        Generates output for given *toolset*. See
+        :meth:`prepare_toolset_model` for the meaning of the arguments.
+        """
+        model = self.prepare_toolset_model(toolset, skip_making_copy, family)
+        logger.debug("****** generating for toolset %s ********", toolset)
+        bkl.api.Toolset.get(toolset).generate(model)
 
 
-    def generate_for_toolset(self, toolset, skip_making_copy=False):
+    def prepare_toolset_model(self, toolset, skip_making_copy=False, family=None):
         """
-        Generates output for given *toolset*.
+        Returns toolset-specific model for *toolset*, finalized by
+        :meth:`finalize_for_toolset`, possibly loaded from its snapshot
+        (see :attr:`snapshot_dir`).
+
+        If *family* is given, it's the list of toolsets of *toolset*'s family
+        and the model is made from the model shared by them, which is made
+        by :meth:`make_family_model` when first needed. If
+        *skip_making_copy* is True, the common model, or the shared model,
+        is modified instead of making a copy of it and can't be used again.
         """
         logger.debug("****** preparing model for toolset %s ******", toolset)
-        model = self.make_toolset_specific_model(toolset, skip_making_copy)
-        self.finalize_for_toolset(model, toolset)
+        loaded_model = self._load_snapshot(toolset)
+        if loaded_model is not None and not self.verify_snapshot:
+            return loaded_model
+        base = None
+        if family:
+            key = tuple(family)
+            base = self._family_models.get(key)
+            if base is None:
+                base = self._family_models[key] = self.make_family_model(family)
+            if skip_making_copy:
+                del self._family_models[key]
+        with snapshot.WarningsRecorder() as recorder:
+            model = self.make_toolset_specific_model(toolset, skip_making_copy, base)
+            self.finalize_for_toolset(model, toolset)
+        self._check_snapshot(loaded_model, model, recorder.warnings, toolset)
+        return model
 
-        logger.debug("****** generating for toolset %s ********", toolset)
-        bkl.api.Toolset.get(toolset).generate(model)
+
+def _toolset_family(name):
+    """
+    Returns class identifying the family of toolset *name*: the helper base
+    class shared by similar toolsets (e.g. MakefileToolset) or the toolset's
+    own class if it has none.
+    """
+    cls = type(bkl.api.Toolset.get(name))
+    for base in cls.__mro__[1:]:
+        if base is bkl.api.Toolset:
+            break
+        if base.name is None:
+            return base
+    return cls
+
+
+def _group_by_family(toolsets):
+    """
+    Returns list of lists of *toolsets* of the same family, in the order of
+    their first occurrence.
+    """
+    families = {}
+    groups = []
+    for t in toolsets:
+        family = _toolset_family(t)
+        if family not in families:
+            families[family] = []
+            groups.append(families[family])
+        families[family].append(t)
+    return groups
+
+
+def reset_state():
+    """
+    Resets global state left behind by processing a project: files written
+    so far and their counts, used variables, recorded input and output files
+    etc. Call this before processing another project in the same process, so
+    that it is processed as if it was the first one. Loaded plugins, property
+    definitions and parsed files that weren't released are kept.
+    """
+    bkl.io._all_written_files.clear()
+    bkl.io.num_created = 0
+    bkl.io.num_modified = 0
+    bkl.io._redirect_commit = None
+    bkl.manifest.reset()
+    bkl.parser.prefetch._prefetched.clear()
+    analyze.usage_tracker.used_vars.clear()
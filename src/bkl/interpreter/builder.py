@@ -22,7 +22,7 @@
 #  IN THE SOFTWARE.
 #
 
-from ..api import TargetType
+from ..api import TargetType, Toolset
 from ..expr import *
 from ..model import Module, Target, Variable, SourceFile, Template, Setting
 from ..parser.ast import *
@@ -57,17 +57,38 @@ class Builder(object, CondTrackingMixin):
        :class:`bkl.model.Module` instance by :meth:`create_model`. When
        descending into a target, it is temporarily set to said target and
        then restored and so on.
+
+    .. attribute:: toolsets
+
+       Set of names of the only toolsets the model is going to be used for,
+       or :const:`None` if not known. If set, conditions on the ``toolset``
+       property in ``if`` statements are evaluated as far as possible while
+       building the model: content that can't apply to any of these toolsets
+       is skipped and conditions that hold for all of them are omitted. The
+       model is then only valid for these toolsets and errors in the skipped
+       content are not reported.
+
+    .. attribute:: exprs
+
+       :class:`bkl.expr.ExprFactory` used to create expressions in the model.
+       May be :class:`bkl.expr.InterningExprFactory` to share identical
+       expressions.
     """
-    def __init__(self, on_submodule=None):
+    def __init__(self, on_submodule=None, toolsets=None, exprs=None):
         """
         Constructor.
 
         :param on_module: Callback to call (with filename as argument) on
                 ``submodule`` statement.
+        :param toolsets: Value of :attr:`toolsets`.
+        :param exprs: Value of :attr:`exprs`, new
+                :class:`bkl.expr.ExprFactory` by default.
         """
         CondTrackingMixin.__init__(self)
         self.context = None
         self.on_submodule_callback = on_submodule
+        self.toolsets = set(toolsets) if toolsets else None
+        self.exprs = exprs if exprs is not None else ExprFactory()
 
 
     def create_model(self, ast, parent):
@@ -82,6 +103,30 @@ class Builder(object, CondTrackingMixin):
         return mod
 
 
+    def start_model(self, filename, parent):
+        """
+        Starts constructing model of *filename* from its top-level statements
+        passed to :meth:`handle_statement` one by one, as they are parsed.
+        This is an alternative to :meth:`create_model` that doesn't need the
+        entire AST at once.
+
+        Returns the new :class:`bkl.model.Module` instance.
+        """
+        mod = Module(parent, source_pos=Position(filename))
+        self.context = mod
+        return mod
+
+
+    def handle_statement(self, node):
+        """
+        Adds top-level statement *node* to the module created by
+        :meth:`start_model`.
+        """
+        mod = self.context
+        self._handle_node(node)
+        assert self.context is mod
+
+
     def create_expression(self, ast, parent):
         """Creates :class:`bkl.epxr.Expr` expression in given parent's context."""
         self.context = parent
@@ -128,8 +173,11 @@ class Builder(object, CondTrackingMixin):
 
 
     def on_assignment(self, node):
+        self._assign(node, self._build_expression(node.value))
+
+
+    def _assign(self, node, value):
         append = node.append
-        value = self._build_expression(node.value)
         has_cond = self.active_if_cond is not None
 
         varname = node.lvalue.var
@@ -157,7 +205,7 @@ class Builder(object, CondTrackingMixin):
                 if append or has_cond:
                     propval = prop.default_expr(context, throw_if_required=False)
                 else:
-                    propval = NullExpr() # we'll set it below
+                    propval = self.exprs.null() # we'll set it below
                 var = Variable.from_property(prop, propval)
                 context.add_variable(var)
                 # And if we didn't get previous value from anywhere else yet,
@@ -176,24 +224,24 @@ class Builder(object, CondTrackingMixin):
                 # If conditionally appending more items to an existing list,
                 # it's better to associate the condition with individual items.
                 if isinstance(value, ListExpr):
-                    ifs = [IfExpr(self.active_if_cond,
-                                  yes=i,
-                                  no=NullExpr(),
-                                  pos=i.pos)
+                    ifs = [self.exprs.if_(self.active_if_cond,
+                                          yes=i,
+                                          no=self.exprs.null(),
+                                          pos=i.pos)
                            for i in value.items]
-                    value = ListExpr(ifs, pos=value.pos)
+                    value = self.exprs.list(ifs, pos=value.pos)
                 else:
-                    value = IfExpr(self.active_if_cond,
-                                   yes=value,
-                                   no=NullExpr(),
-                                   pos=node.pos)
+                    value = self.exprs.if_(self.active_if_cond,
+                                           yes=value,
+                                           no=self.exprs.null(),
+                                           pos=node.pos)
             else:
                 # But when just setting the value, keep it all together as
                 # a single value inside single IfExpr.
-                value = IfExpr(self.active_if_cond,
-                               yes=value,
-                               no=previous_value.value if previous_value else NullExpr(),
-                               pos=node.pos)
+                value = self.exprs.if_(self.active_if_cond,
+                                       yes=value,
+                                       no=previous_value.value if previous_value else self.exprs.null(),
+                                       pos=node.pos)
 
         # create the variable if necessary:
         if var is None:
@@ -218,15 +266,14 @@ class Builder(object, CondTrackingMixin):
                 new_values = value.items
             else:
                 new_values = [value]
-            if previous_value is None:
-                # appending to inheritable list property with empty default
-                value = ListExpr(new_values)
-            elif isinstance(previous_value.value, ListExpr):
-                value = ListExpr(previous_value.value.items + new_values)
-            else:
-                value = ListExpr([previous_value.value] + new_values)
-            value.pos = node.pos
-            var.set_value(value)
+            # (if previous_value is None, we're appending to inheritable list
+            # property with empty default)
+            if previous_value is not None:
+                if isinstance(previous_value.value, ListExpr):
+                    new_values = previous_value.value.items + new_values
+                else:
+                    new_values = [previous_value.value] + new_values
+            var.set_value(self.exprs.list(new_values, pos=node.pos))
         else:
             var.set_value(value)
 
@@ -237,6 +284,10 @@ class Builder(object, CondTrackingMixin):
 
 
     def on_sources_or_headers(self, node):
+        self._add_files(node, self._build_expression(node.files))
+
+
+    def _add_files(self, node, files):
         if node.kind == "sources":
             filelist = self.context.sources
         elif node.kind == "headers":
@@ -244,23 +295,91 @@ class Builder(object, CondTrackingMixin):
         else:
             assert False, 'invalid files list kind "%s"' % node.kind
 
-        files = self._build_expression(node.files)
         analyze.mark_variables_in_expr_as_used(files)
         for cond, f in enum_possible_values(files, global_cond=self.active_if_cond):
+            if cond is None:
+                # don't create full SourceFile objects unless needed
+                filelist.add_file(f, source_pos=f.pos)
+                continue
             obj = SourceFile(self.context, f, source_pos=f.pos)
-            if cond is not None:
-                obj.set_property_value("_condition", cond)
+            obj.set_property_value("_condition", cond)
             filelist.append(obj)
 
 
     def on_if(self, node):
+        cond = self._build_expression(node.cond)
+        self._handle_if(node, cond,
+                        lambda: self.handle_children(node.content, self.context))
+
+
+    def _handle_if(self, node, cond, handle_content):
+        # handle_content is a callable processing node's content
+        if self.toolsets:
+            cond = self._specialize_for_toolsets(cond)
+            if isinstance(cond, BoolValueExpr):
+                if cond.value:
+                    handle_content()
+                else:
+                    logger.debug("%s: skipping content not used by toolsets %s",
+                                 node.pos, ", ".join(sorted(self.toolsets)))
+                return
         try:
-            self.push_cond(self._build_expression(node.cond))
-            self.handle_children(node.content, self.context)
+            self.push_cond(cond)
+            handle_content()
         finally:
             self.pop_cond()
 
 
+    def _specialize_for_toolsets(self, e):
+        """
+        Partially evaluates condition *e* using the knowledge of
+        :attr:`toolsets`. Returns :class:`bkl.expr.BoolValueExpr` if the
+        result is known, otherwise the condition with known parts removed.
+        """
+        if not isinstance(e, BoolExpr):
+            return e
+        op = e.operator
+        if op is BoolExpr.EQUAL or op is BoolExpr.NOT_EQUAL:
+            is_equal = self._compare_toolset(e.left, e.right)
+            if is_equal is None:
+                is_equal = self._compare_toolset(e.right, e.left)
+            if is_equal is None:
+                return e
+            return self.exprs.bool_value(is_equal == (op is BoolExpr.EQUAL), pos=e.pos)
+
+        left = self._specialize_for_toolsets(e.left)
+        if op is BoolExpr.NOT:
+            if isinstance(left, BoolValueExpr):
+                return self.exprs.bool_value(not left.value, pos=e.pos)
+            return e if left is e.left else self.exprs.bool(op, left, pos=e.pos)
+
+        right = self._specialize_for_toolsets(e.right)
+        # value of the operator that makes the other operand irrelevant:
+        decisive = (op is BoolExpr.OR)
+        for a, b in ((left, right), (right, left)):
+            if isinstance(a, BoolValueExpr):
+                return self.exprs.bool_value(decisive, pos=e.pos) if a.value == decisive else b
+        if left is e.left and right is e.right:
+            return e
+        return self.exprs.bool(op, left, right, pos=e.pos)
+
+
+    def _compare_toolset(self, ref, value):
+        # Returns True if $(toolset) is always equal to *value*, False if it
+        # is never equal and None if it can't be determined.
+        if not (isinstance(ref, ReferenceExpr) and ref.var == "toolset" and
+                isinstance(value, LiteralExpr)):
+            return None
+        if value.value not in Toolset.all_names():
+            # leave invalid values to be reported by the type checks
+            return None
+        if value.value not in self.toolsets:
+            return False
+        if len(self.toolsets) == 1:
+            return True
+        return None
+
+
     def _get_templates(self, node):
         templates = self.context.project.templates
         for t in node.base_templates:
@@ -277,7 +396,7 @@ class Builder(object, CondTrackingMixin):
             self._apply_templates(target, t.bases, applied)
             logger.debug("applying template %s to %s", t.name, target.name)
             applied.add(t.name)
-            self.handle_children(t._definition, target)
+            self._apply_patch(t._patch, target)
 
     def on_target(self, node):
         name = node.name
@@ -322,6 +441,7 @@ class Builder(object, CondTrackingMixin):
         bases = list(self._get_templates(node))
         t = Template(node.name, bases, source_pos=node.pos)
         t._definition = node.content
+        t._patch = self._compile(node.content)
         project.add_template(t)
 
 
@@ -355,21 +475,112 @@ class Builder(object, CondTrackingMixin):
                 raise ParserError("unknown base configuration \"%s\"" % node.base.text,
                                   pos=node.base.pos)
         if node.base:
-            cfg._definition = project.configurations[node.base.text]._definition + node.content
+            base = project.configurations[node.base.text]
+            cfg._definition = base._definition + node.content
+            cfg._patch = base._patch + self._compile(node.content)
         else:
             cfg._definition = node.content
+            cfg._patch = self._compile(node.content)
 
-        config_cond = BoolExpr(BoolExpr.EQUAL,
-                               ReferenceExpr("config", self.context),
-                               LiteralExpr(node.name),
-                               pos=node.pos)
+        config_cond = self.exprs.bool(BoolExpr.EQUAL,
+                                      self.exprs.reference("config", self.context),
+                                      self.exprs.literal(node.name),
+                                      pos=node.pos)
         try:
             self.push_cond(config_cond)
-            self.handle_children(cfg._definition, self.context)
+            self._apply_patch(cfg._patch, self.context)
         finally:
             self.pop_cond()
 
 
+    def _compile(self, nodes):
+        """
+        Compiles AST *nodes* of a template or configuration definition into
+        a patch that can be applied to any number of model parts by
+        :meth:`_apply_patch`, without building its expressions again.
+
+        The patch is a tuple of ``(node, expr, has_refs, content)``
+        operations, where *expr* is the prebuilt value, files list or
+        condition of the node and *content* is the compiled content of
+        ``if`` statements. References in the expressions are created without
+        context and are bound to the part the patch is applied to; *has_refs*
+        is false if there are none. Other nodes are kept with *expr* set to
+        :const:`None` and are handled as usual when applying the patch.
+        """
+        old_ctxt = self.context
+        self.context = None
+        try:
+            patch = []
+            for n in nodes:
+                with error_context(n):
+                    t = type(n)
+                    if t is AssignmentNode or t is AppendNode:
+                        e = self._build_expression(n.value)
+                        content = None
+                    elif t is FilesListNode:
+                        e = self._build_expression(n.files)
+                        content = None
+                    elif t is IfNode:
+                        e = self._build_expression(n.cond)
+                        content = self._compile(n.content)
+                    else:
+                        patch.append((n, None, False, None))
+                        continue
+                    patch.append((n, e, has_references(e), content))
+            return tuple(patch)
+        finally:
+            self.context = old_ctxt
+
+
+    def _apply_patch(self, patch, context):
+        """
+        Applies *patch* created by :meth:`_compile` to *context*, with the
+        same effect as handling the nodes it was compiled from there.
+        """
+        try:
+            old_ctxt = self.context
+            self.context = context
+            for node, e, has_refs, content in patch:
+                if e is None:
+                    self._handle_node(node)
+                    continue
+                with error_context(node):
+                    if has_refs:
+                        e = self._bind(e)
+                    t = type(node)
+                    if t is IfNode:
+                        self._handle_if(node, e,
+                                        lambda: self._apply_patch(content, context))
+                    elif t is FilesListNode:
+                        self._add_files(node, e)
+                    else:
+                        self._assign(node, e)
+        finally:
+            self.context = old_ctxt
+
+
+    def _bind(self, e):
+        """
+        Returns compiled expression *e* with references bound to the current
+        context. Subexpressions other than references and their containers
+        are shared with *e*.
+        """
+        t = type(e)
+        if t is ReferenceExpr:
+            return self.exprs.reference(e.var, self.context, pos=e.pos)
+        elif t is ListExpr:
+            return self.exprs.list([self._bind(i) for i in e.items], pos=e.pos)
+        elif t is ConcatExpr:
+            return self.exprs.concat([self._bind(i) for i in e.items], pos=e.pos)
+        elif t is BoolExpr:
+            left = self._bind(e.left)
+            right = None if e.right is None else self._bind(e.right)
+            return self.exprs.bool(e.operator, left, right, pos=e.pos)
+        else:
+            # expressions built from AST don't contain references elsewhere
+            return e
+
+
     def on_setting(self, node):
         name = node.name
         project = self.context.project
@@ -387,12 +598,12 @@ class Builder(object, CondTrackingMixin):
         # This is for a dummy variable created at project scope and referencing
         # the setting. By doing this, it's easy to reference settings as ordinary
         # variables.
-        var_value = PlaceholderExpr(name, pos=node.pos)
+        var_value = self.exprs.placeholder(name, pos=node.pos)
 
         if self.active_if_cond is not None:
             cond = self.active_if_cond
             setting.set_property_value("_condition", cond)
-            var_value = IfExpr(cond, yes=var_value, no=NullExpr(), pos=node.pos)
+            var_value = self.exprs.if_(cond, yes=var_value, no=self.exprs.null(), pos=node.pos)
 
         project.add_variable(Variable(name, var_value, source_pos=node.pos))
         # set any properties on the setting object:
@@ -483,38 +694,37 @@ class Builder(object, CondTrackingMixin):
 
     def _build_expression(self, ast):
         t = type(ast)
+        pos = ast.pos
         if t is LiteralNode:
             # FIXME: type handling
-            e = LiteralExpr(ast.text)
+            return self.exprs.literal(ast.text, pos=pos)
         elif t is BoolvalNode:
-            e = BoolValueExpr(ast.value)
+            return self.exprs.bool_value(ast.value, pos=pos)
         elif t is VarReferenceNode:
-            e = ReferenceExpr(ast.var, self.context)
+            return self.exprs.reference(ast.var, self.context, pos=pos)
         elif t is ListNode:
             items = [self._build_expression(e) for e in ast.values]
-            e = ListExpr(items)
+            return self.exprs.list(items, pos=pos)
         elif t is ConcatNode:
             items = [self._build_expression(e) for e in ast.values]
-            e = ConcatExpr(items)
+            return self.exprs.concat(items, pos=pos)
         elif t is PathAnchorNode:
             # Note: This creates a degrated "path" with only the anchor.
             #       If it's part of a full path, it will necessarily be created
             #       as the first element of a ConcatExpr.
             #       Later, PathType.normalize() will recognize this case and
             #       create a proper PathExpr from this.
-            e = PathExpr([], anchor=ast.text, anchor_file=ast.pos.filename)
+            return self.exprs.path([], anchor=ast.text, anchor_file=pos.filename, pos=pos)
         elif isinstance(ast, BoolNode):
-            e = self._build_bool_expression(ast)
+            return self._build_bool_expression(ast, pos)
         else:
             assert False, "unrecognized AST node (%s)" % ast
-        e.pos = ast.pos
-        return e
 
 
-    def _build_bool_expression(self, ast):
+    def _build_bool_expression(self, ast, pos):
         t = type(ast)
         if t is NotNode:
-            return BoolExpr(BoolExpr.NOT, self._build_expression(ast.left))
+            return self.exprs.bool(BoolExpr.NOT, self._build_expression(ast.left), pos=pos)
         else:
             if t is AndNode:
                 op = BoolExpr.AND
@@ -526,4 +736,4 @@ class Builder(object, CondTrackingMixin):
                 op = BoolExpr.NOT_EQUAL
             left = self._build_expression(ast.left)
             right = self._build_expression(ast.right)
-            return BoolExpr(op, left, right)
+            return self.exprs.bool(op, left, right, pos=pos)
@@ -0,0 +1,281 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Generating outputs for several toolsets in parallel.
+
+Worker processes are forked after the model is finalized, so that they all
+start with a copy of it and don't need to clone it. Each of them specializes
+the model for one toolset and runs its generator, but doesn't write any files
+or show any messages: output files and log records are sent back to the main
+process instead, which replays them in the order of toolsets. Output files
+conflicts, messages and statistics are thus the same as when the toolsets are
+generated one after another.
+
+Independent projects can be processed in parallel in a similar way, see
+:func:`map_in_workers`.
+"""
+
+import os
+import sys
+import signal
+import logging
+import traceback
+import cPickle
+from collections import deque
+
+import bkl.io
+import bkl.manifest
+from bkl.error import Error
+
+logger = logging.getLogger("bkl.interpreter.parallel")
+
+# Interpreter used by worker processes, inherited from the main process
+_interpreter = None
+
+
+def is_available():
+    """
+    Returns True if parallel generation is possible on this platform. The
+    implementation relies on fork() to pass the model to worker processes.
+    """
+    return hasattr(os, "fork")
+
+
+def _fork_worker(func, arg):
+    """
+    Forks a worker process calling *func(arg)*. Returns its pid and file from
+    which the pickled result can be read.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        code = 0
+        try:
+            with os.fdopen(w, "wb") as f:
+                cPickle.dump(func(arg), f, cPickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(w)
+    return pid, os.fdopen(r, "rb")
+
+
+def _imap_forked(func, args, jobs):
+    """
+    Like :meth:`multiprocessing.Pool.imap`, but calls *func* for every item
+    of *args* in a new process, with up to *jobs* of them running at once.
+
+    The processes are forked directly from the calling thread, unlike
+    multiprocessing.Pool's replacement workers, which are forked from its
+    handler thread and may deadlock on locks held by other threads then.
+    """
+    args = iter(args)
+    running = deque()
+    try:
+        while True:
+            for arg in args:
+                running.append(_fork_worker(func, arg))
+                if len(running) >= jobs:
+                    break
+            if not running:
+                break
+            pid, f = running.popleft()
+            try:
+                result = cPickle.load(f)
+            except EOFError:
+                raise RuntimeError("worker process %d failed" % pid)
+            finally:
+                f.close()
+                os.waitpid(pid, 0)
+            yield result
+    finally:
+        for pid, f in running:
+            f.close()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+
+class _RecordingHandler(logging.Handler):
+    """Logging handler storing records in a list of events."""
+    def __init__(self, events):
+        logging.Handler.__init__(self)
+        self.events = events
+
+    def emit(self, record):
+        # make the record picklable:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.events.append(("log", record))
+
+
+def _record_output(events, f):
+    events.append(("file", (f.filename, f.eol, f.charset, f.text,
+                            str(f.creator), str(f.create_for))))
+
+
+def _worker(toolset):
+    """
+    Generates output for *toolset* in a worker process. Returns tuple with
+    list of events (log records and output files), input files recorded in
+    :mod:`bkl.manifest`, statistics of passes and exception, if any.
+    """
+    events = []
+    root = logging.getLogger()
+    root.handlers = [_RecordingHandler(events)]
+    bkl.io._redirect_commit = lambda f: _record_output(events, f)
+    bkl.manifest.reset()
+    _interpreter.pass_manager.reset_stats()
+
+    error = None
+    try:
+        _interpreter.generate_for_toolset(toolset, skip_making_copy=True)
+    except Error as e:
+        error = e
+    except Exception:
+        error = RuntimeError("unexpected error generating for toolset %s:\n%s" %
+                             (toolset, traceback.format_exc()))
+    stats = _interpreter.pass_manager.get_stats()
+    return (events, bkl.manifest._inputs, stats, error)
+
+
+def generate_for_toolsets(interpreter, toolsets, jobs):
+    """
+    Generates output for all *toolsets* by calling
+    :meth:`bkl.interpreter.Interpreter.generate_for_toolset` of
+    *interpreter* in up to *jobs* worker processes.
+    """
+    global _interpreter
+    logger.debug("generating for %d toolsets in %d processes", len(toolsets), jobs)
+
+    # flush output buffers, so that their content isn't duplicated by children
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    _interpreter = interpreter
+    # every process generates only one toolset, because generate_for_toolset()
+    # modifies the model:
+    results = _imap_forked(_worker, toolsets, jobs)
+    try:
+        for events, inputs, stats, error in results:
+            for kind, data in events:
+                if kind == "log":
+                    logging.getLogger(data.name).handle(data)
+                else:
+                    filename, eol, charset, text, creator, create_for = data
+                    f = bkl.io.OutputFile(filename, eol, charset, creator, create_for)
+                    f.text = text
+                    f.commit()
+            bkl.manifest._inputs.update(inputs)
+            for phase, s in stats:
+                interpreter.pass_manager.add_stats(phase, s)
+            if error is not None:
+                raise error
+    finally:
+        _interpreter = None
+        results.close()
+
+
+class _RecordingStream(object):
+    """File-like object storing everything written to it in a list of events."""
+    def __init__(self, events):
+        self.events = events
+
+    def write(self, text):
+        self.events.append(("stdout", text))
+
+    def flush(self):
+        pass
+
+
+# Function called by map_in_workers() workers and its arguments
+_map_func = None
+_map_items = None
+
+
+def _map_worker(index):
+    """
+    Calls the function passed to :func:`map_in_workers` for item *index* in a
+    worker process. Returns tuple with list of events (log records and
+    output) and the result or exception.
+    """
+    import bkl.interpreter
+    events = []
+    root = logging.getLogger()
+    root.handlers = [_RecordingHandler(events)]
+    sys.stdout = _RecordingStream(events)
+    bkl.interpreter.reset_state()
+
+    result = error = None
+    try:
+        result = _map_func(_map_items[index])
+    except Error as e:
+        error = e
+    except Exception:
+        error = RuntimeError("unexpected error processing %s:\n%s" %
+                             (_map_items[index], traceback.format_exc()))
+    sys.stdout.flush()
+    return (events, result, error)
+
+
+def map_in_workers(func, items, jobs):
+    """
+    Calls *func* for every item of *items* in up to *jobs* worker processes
+    and yields the results in order. *func* can be any callable, it isn't
+    pickled: the workers are forked from this process and inherit it, as well
+    as loaded plugins, parsed files and everything else already loaded.
+
+    Every item is processed in a new worker, starting with state reset by
+    :func:`bkl.interpreter.reset_state`. Messages logged and standard output
+    written by the workers are shown in the order of *items*, as if they were
+    processed one after another.
+    """
+    global _map_func, _map_items
+    logger.debug("processing %d items in %d processes", len(items), jobs)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    _map_func = func
+    _map_items = items
+    results = _imap_forked(_map_worker, range(len(items)), jobs)
+    try:
+        for events, result, error in results:
+            for kind, data in events:
+                if kind == "log":
+                    logging.getLogger(data.name).handle(data)
+                else:
+                    sys.stdout.write(data)
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        _map_func = _map_items = None
+        results.close()
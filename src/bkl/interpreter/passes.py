@@ -37,11 +37,26 @@ import bkl.vartypes
 import bkl.expr
 import bkl.model
 import bkl.vartypes
+from passmanager import Pass, FINALIZE, FAMILY, TOOLSET, count_visited
 from bkl.error import Error, NonConstError, TypeError
-from bkl.expr import RewritingVisitor
+from bkl.expr import Visitor, RewritingVisitor
 from bkl.utils import memoized
 
 
+def _all_variables(model):
+    """
+    Like :meth:`bkl.model.ModelPart.all_variables`, but counts the visited
+    variables for pass statistics.
+    """
+    count = 0
+    try:
+        for var in model.all_variables():
+            count += 1
+            yield var
+    finally:
+        count_visited(count)
+
+
 def detect_potential_problems(model):
     """
     Run several warnings-generating steps, to detect common problems.
@@ -57,7 +72,7 @@ def normalize_and_validate_bool_subexpressions(model):
     variables' values with respect to their types.
     """
     logger.debug("checking boolean expressions")
-    for var in model.all_variables():
+    for var in _all_variables(model):
         bkl.vartypes.normalize_and_validate_bool_subexpressions(var.value)
 
 
@@ -67,7 +82,7 @@ def normalize_vars(model):
     changes non-list value expressions for lists into single-item lists.
     """
     logger.debug("normalizing variables")
-    for var in model.all_variables():
+    for var in _all_variables(model):
         # if the type of the variable wasn't determined yet, guess it
         if var.type is bkl.vartypes.TheAnyType:
             var.type = bkl.vartypes.guess_expr_type(var.value)
@@ -82,7 +97,7 @@ def validate_vars(model):
     executed beforehand.
     """
     logger.debug("checking types of variables")
-    for var in model.all_variables():
+    for var in _all_variables(model):
         try:
             var.type.validate(var.value)
         except TypeError as err:
@@ -125,7 +140,7 @@ def remove_disabled_model_parts(model, toolset):
             _remove_from_list(target.headers, allow_dynamic=True)
         for target in targets_to_del:
             logger.debug("removing disabled %s", target)
-            del module.targets[target.name]
+            module.remove_target(target)
 
     # remove any empty submodules:
     mods_to_del = []
@@ -142,7 +157,7 @@ def remove_disabled_model_parts(model, toolset):
                          module, toolset, mod_toolsets.as_py())
             mods_to_del.append(module)
     for module in mods_to_del:
-        model.modules.remove(module)
+        model.remove_module(module)
 
     # and remove unused settings too:
     settings_to_del = []
@@ -250,17 +265,22 @@ def normalize_paths_in_model(model, toolset):
 
     for module in model.modules:
         norm.set_context(module)
-        for var in module.variables.itervalues():
-            var.value = norm.visit(var.value)
+        count_visited(len(module.variables))
+        for var in module.variables.values():
+            module.update_variable_value(var, norm.visit(var.value))
         for target in module.targets.itervalues():
             norm.set_context(target)
-            for var in target.all_variables():
-                var.value = norm.visit(var.value)
+            for part in target.all_parts():
+                count_visited(len(part.variables))
+                for var in part.variables.values():
+                    part.update_variable_value(var, norm.visit(var.value))
 
 
 def make_variables_for_missing_props(model, toolset):
     """
-    Creates variables for properties that don't have variables set yet.
+    Creates variables for properties that don't have variables set yet. If
+    *toolset* is :const:`None`, only properties that are not specific to any
+    toolset are considered.
     """
     logger.debug("adding properties' default values (%s)" % model)
     model.make_variables_for_missing_props(toolset)
@@ -277,28 +297,303 @@ def simplify_exprs(model):
     """
     logger.debug("simplifying expressions")
     simplifier = simplify.BasicSimplifier()
-    for var in model.all_variables():
+    for var in _all_variables(model):
         var.value = simplifier.visit(var.value)
 
 
-def eliminate_superfluous_conditionals(model):
+def _paths_context(part):
+    """
+    Returns the module or target to use as context of
+    :class:`PathsNormalizer` for variables of *part* or :const:`None` if
+    :func:`normalize_paths_in_model()` doesn't process them.
+    """
+    while part is not None:
+        if isinstance(part, bkl.model.Target) or isinstance(part, bkl.model.Module):
+            return part
+        part = part.parent
+    return None
+
+
+def process_variables(model):
+    """
+    Does the same as :func:`normalize_and_validate_bool_subexpressions()`,
+    :func:`normalize_vars()`, :func:`validate_vars()`,
+    :func:`normalize_paths_in_model()` (without toolset) and
+    :func:`simplify_exprs()` run one after another, but in a single traversal
+    of the model, applying all these steps to one variable at a time.
+
+    Some of the steps look at values of referenced variables, so variables
+    are processed in dependency order: before a variable, all variables it
+    references are processed.
+    """
+    logger.debug("processing variables")
+    norm = PathsNormalizer(model)
+    simplifier = simplify.BasicSimplifier()
+    refs = _ReferencesCollector()
+    TheAnyType = bkl.vartypes.TheAnyType
+    leaf_types = _Dependencies._LEAF_TYPES
+
+    # (part, name) keys of variables being or already processed:
+    seen = set()
+
+    def dependencies(var):
+        if type(var.value) in leaf_types:
+            return iter(())
+        refs.reset()
+        refs.visit(var.value)
+        return iter(refs.found[:])
+
+    def process(part, name, var):
+        # The dependencies are walked depth-first with an explicit stack of
+        # (part, name, variable, iterator over its unvisited dependencies),
+        # because chains of them can be longer than the recursion limit.
+        seen.add((part, name))
+        stack = [(part, name, var, dependencies(var))]
+        while stack:
+            part, name, var, deps = stack[-1]
+            for ref in deps:
+                if ref not in seen:
+                    seen.add(ref)
+                    ref_part, ref_name = ref
+                    ref_var = ref_part.variables[ref_name]
+                    stack.append((ref_part, ref_name, ref_var, dependencies(ref_var)))
+                    break
+            else:
+                stack.pop()
+                process_one(part, name, var)
+
+    def process_one(part, name, var):
+        if type(var.value) not in leaf_types:
+            bkl.vartypes.normalize_and_validate_bool_subexpressions(var.value)
+        if var.type is TheAnyType:
+            var.type = bkl.vartypes.guess_expr_type(var.value)
+        var.value = var.type.normalize(var.value)
+        try:
+            var.type.validate(var.value)
+        except TypeError as err:
+            err.msg = "variable \"%s\" (%s): %s" % (var.name, var.type, err.msg)
+            raise
+        if type(var.value) in leaf_types:
+            # neither paths normalization nor simplification can change it
+            return
+        context = _paths_context(part)
+        if context is not None:
+            norm.set_context(context)
+            part.update_variable_value(var, norm.visit(var.value))
+            var = part.variables[name]
+        var.value = simplifier.visit(var.value)
+
+    count = 0
+    for part in model.all_parts():
+        for name, var in part.variables.items():
+            count += 1
+            if (part, name) not in seen:
+                process(part, name, var)
+    count_visited(count)
+
+
+class _ReferencesCollector(Visitor):
+    """
+    Collects variables referenced by an expression, as (part, name) tuples
+    identifying where they are defined, see :class:`_Dependencies`.
+    """
+    def __init__(self):
+        super(_ReferencesCollector, self).__init__()
+        self.reset()
+
+    def reset(self):
+        self.found = []
+        self.unresolved = False
+
+    literal = Visitor.noop
+    bool_value = Visitor.noop
+    null = Visitor.noop
+    placeholder = Visitor.noop
+    concat = Visitor.visit_children
+    list = Visitor.visit_children
+    path = Visitor.visit_children
+    bool = Visitor.visit_children
+    if_ = Visitor.visit_children
+
+    def reference(self, e):
+        var = e.get_variable()
+        part = e.get_context()
+        while part is not None and part.variables.get(e.var) is not var:
+            part = part.parent
+        if var is None or part is None:
+            # property's default value, which may depend on anything
+            self.unresolved = True
+        else:
+            self.found.append((part, e.var))
+
+
+class _Dependencies(object):
+    """
+    Reverse dependencies between variables: which variables reference which.
+
+    Variables are identified by (part, name) tuples rather than by Variable
+    objects, because the objects may be replaced when modified, see
+    :meth:`bkl.model.ModelPart.update_variable_value()`.
+    """
+    def __init__(self):
+        self.dependents = {}
+        # variables referencing something that can't be tracked
+        self.volatile = set()
+        self._collector = _ReferencesCollector()
+
+    # expressions that can't contain references:
+    _LEAF_TYPES = frozenset([bkl.expr.LiteralExpr, bkl.expr.BoolValueExpr,
+                             bkl.expr.NullExpr, bkl.expr.PlaceholderExpr])
+
+    def add(self, part, name, value):
+        """Records dependencies of variable *name* of *part* with *value*."""
+        if type(value) in self._LEAF_TYPES:
+            return
+        refs = self._collector
+        refs.reset()
+        refs.visit(value)
+        key = (part, name)
+        for dep in refs.found:
+            self.dependents.setdefault(dep, set()).add(key)
+        if refs.unresolved:
+            self.volatile.add(key)
+
+    def affected_by(self, changed):
+        """
+        Returns set of variables whose values depend, directly or indirectly,
+        on any of the *changed* variables.
+        """
+        affected = set(self.volatile)
+        todo = list(changed)
+        while todo:
+            for dep in self.dependents.get(todo.pop(), ()):
+                if dep not in affected:
+                    affected.add(dep)
+                    todo.append(dep)
+        return affected
+
+
+def eliminate_superfluous_conditionals(model, toolsets=None):
     """
     Removes as much of conditional content as possible. This involves doing
     as many optimizations as possible, even if the calculation is relatively
     expensive (compared to simplify_exprs()).
+
+    The simplifications are repeated until nothing changes, but only on
+    variables changed in the previous pass and those that (transitively)
+    reference them. Variables already simplified by a previous call, e.g. on
+    the model shared by a family of toolsets this model was copied from, are
+    only simplified again if they or anything they reference changed since.
+
+    If *toolsets* are given, the model is only used for these toolsets (see
+    :class:`bkl.interpreter.simplify.ToolsetsSimplifier`).
     """
+    if toolsets:
+        simplifier = simplify.ToolsetsSimplifier(toolsets)
+    else:
+        simplifier = simplify.ConditionalsSimplifier()
+    deps = _Dependencies()
+    all_vars = []
+    worklist = []
+    for part in model.all_parts():
+        for name, var in part.variables.iteritems():
+            all_vars.append((part, name))
+            deps.add(part, name, var.value)
+            if var._simplified_value is not var.value:
+                worklist.append((part, name))
+    if len(worklist) != len(all_vars):
+        affected = deps.affected_by(worklist)
+        affected.update(worklist)
+        worklist = [x for x in all_vars if x in affected]
+
     iteration = 1
-    simplifier = simplify.ConditionalsSimplifier()
-    while True:
-        logger.debug("removing superfluous conditional expressions: pass %i", iteration)
-        modified = False
-        for var in model.all_variables():
+    visits = 0
+    while worklist:
+        logger.debug("removing superfluous conditional expressions: pass %i, %d variables",
+                     iteration, len(worklist))
+        visits += len(worklist)
+        changed = []
+        for part, name in worklist:
+            var = part.variables[name]
             old = var.value
-            var.value = simplifier.visit(var.value)
-            if old is not var.value:
-                logger.debug("new pass triggered because of this change: {%s} -> {%s}", old, var.value)
-                modified = True
-        if modified:
-            iteration += 1
-        else:
+            new = simplifier.visit(old)
+            if old is not new:
+                logger.debug("new pass triggered because of this change: {%s} -> {%s}", old, new)
+                part.update_variable_value(var, new)
+                deps.add(part, name, new)
+                changed.append((part, name))
+        if not changed:
             break
+        # changed variables themselves are visited again too, because their
+        # new value may allow further simplifications, as in a full pass:
+        affected = deps.affected_by(changed)
+        affected.update(changed)
+        worklist = [x for x in all_vars if x in affected]
+        iteration += 1
+    logger.debug("removing superfluous conditional expressions: %d variables visited in %d passes",
+                 visits, iteration)
+    count_visited(visits)
+
+    for part, name in all_vars:
+        var = part.variables[name]
+        var._simplified_value = var.value
+
+
+def standard_passes(fused=False):
+    """
+    Returns list of the standard passes, as :class:`bkl.interpreter.passmanager.Pass`
+    objects.
+
+    If *fused* is True, :func:`process_variables()` is used instead of the
+    passes it replaces.
+    """
+    if fused:
+        variables_passes = [
+            Pass("process_variables", FINALIZE, process_variables,
+                 provides=["normalize_and_validate_bool_subexpressions",
+                           "normalize_vars",
+                           "validate_vars",
+                           "normalize_paths_in_model",
+                           "simplify_exprs"]),
+            ]
+    else:
+        variables_passes = [
+            Pass("normalize_and_validate_bool_subexpressions", FINALIZE,
+                 normalize_and_validate_bool_subexpressions),
+            Pass("normalize_vars", FINALIZE, normalize_vars,
+                 deps=["normalize_and_validate_bool_subexpressions"]),
+            Pass("validate_vars", FINALIZE, validate_vars,
+                 deps=["normalize_vars"]),
+            Pass("normalize_paths_in_model", FINALIZE,
+                 lambda model: normalize_paths_in_model(model, toolset=None),
+                 deps=["validate_vars"]),
+            Pass("simplify_exprs", FINALIZE, simplify_exprs,
+                 deps=["normalize_paths_in_model"]),
+            ]
+
+    return [
+        Pass("detect_potential_problems", FINALIZE, detect_potential_problems,
+             diagnostic=True),
+        ] + variables_passes + [
+        # Generic properties' defaults and simplifications not depending on
+        # the exact toolset are shared by toolsets of the same family:
+        Pass("make_variables_for_missing_props", FAMILY,
+             lambda model, toolsets: make_variables_for_missing_props(model, None)),
+        Pass("eliminate_superfluous_conditionals", FAMILY, eliminate_superfluous_conditionals,
+             deps=["make_variables_for_missing_props"]),
+        Pass("remove_disabled_model_parts", TOOLSET, remove_disabled_model_parts),
+        # TODO: do this in finalize() instead
+        Pass("make_variables_for_missing_props", TOOLSET, make_variables_for_missing_props,
+             deps=["remove_disabled_model_parts"]),
+        Pass("eliminate_superfluous_conditionals", TOOLSET,
+             lambda model, toolset: eliminate_superfluous_conditionals(model),
+             deps=["make_variables_for_missing_props"]),
+        # This is done second time here (in addition to finalize()) to deal
+        # with paths added by make_variables_for_missing_props() and paths with
+        # @builddir (which is toolset specific and couldn't be resolved
+        # earlier).  Ideally we wouldn't do it, but hopefully it's not all that
+        # inefficient, as no real work is done for paths that are already
+        # normalized:
+        Pass("normalize_paths_in_model", TOOLSET, normalize_paths_in_model,
+             deps=["eliminate_superfluous_conditionals"]),
+        ]
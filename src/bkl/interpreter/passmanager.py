@@ -0,0 +1,318 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Management of the passes run on the model.
+
+Every pass is described by a :class:`Pass` object, which gives it a name and
+says in which phase of processing it runs and which other passes must run
+before it. :class:`PassManager` keeps the registered passes, runs them in
+order satisfying these dependencies and optionally measures how long each of
+them takes.
+
+There are three phases:
+
+``finalize``
+    Passes run on the common model, after it was built from input files (see
+    :meth:`bkl.interpreter.Interpreter.finalize`). They are called as
+    ``func(model)``.
+
+``family``
+    Passes run on a copy of the model shared by a family of similar toolsets
+    (see :meth:`bkl.interpreter.Interpreter.make_family_model`), from which
+    the toolset-specific copies are then made. They are called as
+    ``func(model, toolsets)``, where *toolsets* is the list of names of the
+    toolsets of the family. They may only do work whose result is the same
+    for all of these toolsets and that the ``toolset`` phase passes would do
+    otherwise, because the family phase is only an optimization and is not
+    always run.
+
+``toolset``
+    Passes run on toolset-specific copies of the model (see
+    :meth:`bkl.interpreter.Interpreter.finalize_for_toolset`). They are
+    called as ``func(model, toolset)``, where *toolset* is toolset's name.
+
+Besides the standard passes (see :mod:`bkl.interpreter.passes`), plugins can
+add their own by implementing :meth:`bkl.api.CustomStep.passes`.
+"""
+
+import gc
+import logging
+from time import time
+
+from bkl.error import Error
+
+logger = logging.getLogger("bkl.interpreter.passmanager")
+
+#: Phase of passes run on the common model.
+FINALIZE = "finalize"
+#: Phase of passes run on models shared by toolsets of the same family.
+FAMILY = "family"
+#: Phase of passes run on toolset-specific models.
+TOOLSET = "toolset"
+
+PHASES = (FINALIZE, FAMILY, TOOLSET)
+
+
+class Pass(object):
+    """
+    Description of a pass.
+
+    .. attribute:: name
+
+       Unique name of the pass, used to refer to it in :attr:`deps`.
+
+    .. attribute:: phase
+
+       Phase in which the pass runs, one of :const:`FINALIZE`,
+       :const:`FAMILY` and :const:`TOOLSET`.
+
+    .. attribute:: func
+
+       Function implementing the pass, see the module's documentation for its
+       arguments.
+
+    .. attribute:: deps
+
+       Names of passes of the same phase that must run before this one.
+
+    .. attribute:: diagnostic
+
+       True if the pass only checks the model and reports warnings, without
+       modifying it; such passes may be skipped.
+
+    .. attribute:: provides
+
+       Names of other passes whose work this pass does too, so that it can
+       be used instead of them. Dependencies on them are satisfied by this
+       pass.
+    """
+    def __init__(self, name, phase, func, deps=[], diagnostic=False, provides=[]):
+        assert phase in PHASES
+        self.name = name
+        self.phase = phase
+        self.func = func
+        self.deps = list(deps)
+        self.diagnostic = diagnostic
+        self.provides = list(provides)
+
+    def __str__(self):
+        return "%s:%s" % (self.phase, self.name)
+
+    def __repr__(self):
+        return "<Pass %s>" % self
+
+
+class PassStats(object):
+    """
+    Statistics of one pass, accumulated over all its runs (e.g. for all
+    toolsets), as collected when :attr:`PassManager.time_passes` is enabled.
+
+    .. attribute:: time
+
+       Wall time spent in the pass, in seconds.
+
+    .. attribute:: variables
+
+       Number of variables visited by the pass, as reported by the pass with
+       :func:`count_visited`.
+
+    .. attribute:: objects
+
+       Net number of objects allocated by the pass, i.e. the increase in the
+       number of objects tracked by the garbage collector.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.time = 0.0
+        self.variables = 0
+        self.objects = 0
+
+    def add(self, other):
+        self.runs += other.runs
+        self.time += other.time
+        self.variables += other.variables
+        self.objects += other.objects
+
+
+# Statistics of the pass being run or None if they aren't collected
+_current_stats = None
+
+
+def count_visited(count=1):
+    """
+    Called by passes to report that they visited *count* variables, for the
+    purposes of :attr:`PassManager.time_passes` statistics.
+    """
+    if _current_stats is not None:
+        _current_stats.variables += count
+
+
+class PassManager(object):
+    """
+    Registry of passes that runs them in the correct order.
+
+    .. attribute:: time_passes
+
+       If True, statistics about every pass run are collected, see
+       :meth:`get_stats` and :meth:`format_stats`. Off by default.
+
+    .. attribute:: skip_diagnostics
+
+       If True, diagnostic passes, i.e. the ones that only report warnings,
+       are not run. Off by default.
+    """
+    def __init__(self, passes=[]):
+        self.time_passes = False
+        self.skip_diagnostics = False
+        self._stats = {}
+        self._stats_order = []
+        self._passes = []
+        self._names = set()
+        self._ordered = {}
+        for p in passes:
+            self.register(p)
+
+
+    def register(self, p):
+        """Registers new pass *p*, a :class:`Pass` instance."""
+        key = (p.phase, p.name)
+        if key in self._names:
+            raise Error("pass \"%s\" is already registered" % p)
+        self._names.add(key)
+        self._passes.append(p)
+        self._ordered.pop(p.phase, None)
+
+
+    def has_pass(self, phase, name):
+        """Returns True if pass *name* is registered for *phase*."""
+        return (phase, name) in self._names
+
+
+    def get_passes(self, phase):
+        """
+        Returns list of passes of given *phase*, sorted so that every pass
+        comes after all of its dependencies. Otherwise, passes are kept in the
+        order of registration.
+        """
+        if phase not in self._ordered:
+            self._ordered[phase] = self._sort([p for p in self._passes if p.phase == phase])
+        return self._ordered[phase]
+
+
+    def _sort(self, passes):
+        names = set(p.name for p in passes)
+        for p in passes:
+            names.update(p.provides)
+        for p in passes:
+            for d in p.deps:
+                if d not in names:
+                    raise Error("pass \"%s\" depends on unknown pass \"%s\"" % (p, d))
+        ordered = []
+        done = set()
+        remaining = list(passes)
+        while remaining:
+            for p in remaining:
+                if all(d in done for d in p.deps):
+                    break
+            else:
+                raise Error("circular dependency between passes %s" %
+                            ", ".join('"%s"' % p for p in remaining))
+            remaining.remove(p)
+            ordered.append(p)
+            done.add(p.name)
+            done.update(p.provides)
+        return ordered
+
+
+    def run(self, phase, model, *args):
+        """
+        Runs all passes of *phase* on *model*. Any additional arguments are
+        passed to pass functions.
+        """
+        global _current_stats
+        for p in self.get_passes(phase):
+            if p.diagnostic and self.skip_diagnostics:
+                logger.debug("skipping diagnostic pass %s", p)
+                continue
+            logger.debug("running pass %s", p)
+            if not self.time_passes:
+                p.func(model, *args)
+                continue
+
+            stats = PassStats(p.name)
+            stats.runs = 1
+            objects_before = len(gc.get_objects())
+            start = time()
+            _current_stats = stats
+            try:
+                p.func(model, *args)
+            finally:
+                _current_stats = None
+                stats.time = time() - start
+                stats.objects = len(gc.get_objects()) - objects_before
+                self.add_stats(phase, stats)
+
+
+    def get_stats(self):
+        """
+        Returns statistics collected when :attr:`time_passes` is enabled, as
+        list of ``(phase, stats)`` tuples, where *stats* is :class:`PassStats`
+        instance, in the order in which the passes were first run.
+        """
+        return [(key[0], self._stats[key]) for key in self._stats_order]
+
+
+    def add_stats(self, phase, stats):
+        """
+        Adds *stats* of a pass of *phase* to the collected statistics, e.g.
+        the ones collected in another process.
+        """
+        key = (phase, stats.name)
+        if key not in self._stats:
+            self._stats[key] = PassStats(stats.name)
+            self._stats_order.append(key)
+        self._stats[key].add(stats)
+
+
+    def reset_stats(self):
+        """Forgets all statistics collected so far."""
+        self._stats.clear()
+        del self._stats_order[:]
+
+
+    def format_stats(self):
+        """
+        Returns human-readable table of the collected statistics.
+        """
+        lines = ["%-10s %-45s %5s %9s %10s %10s" %
+                    ("phase", "pass", "runs", "time (s)", "variables", "objects")]
+        total = 0.0
+        for phase, s in self.get_stats():
+            total += s.time
+            lines.append("%-10s %-45s %5d %9.3f %10d %10d" %
+                         (phase, s.name, s.runs, s.time, s.variables, s.objects))
+        lines.append("%-10s %-45s %5s %9.3f" % ("", "total", "", total))
+        return "\n".join(lines)
@@ -195,6 +195,49 @@ class ConditionalsSimplifier(BasicSimplifier):
             return e
 
 
+class ToolsetsSimplifier(ConditionalsSimplifier):
+    """
+    Conditionals simplifier for models used only for some toolsets, e.g. a
+    model shared by a family of toolsets: comparisons of the ``toolset``
+    property with other toolsets' names are known to be false even though
+    its value isn't known yet.
+    """
+    def __init__(self, toolsets):
+        super(ToolsetsSimplifier, self).__init__()
+        self.toolsets = set(toolsets)
+
+    def bool(self, e):
+        e = super(ToolsetsSimplifier, self).bool(e)
+        if not isinstance(e, BoolExpr):
+            return e
+        op = e.operator
+        if op == BoolExpr.EQUAL or op == BoolExpr.NOT_EQUAL:
+            is_equal = self._compare_toolset(e.left, e.right)
+            if is_equal is None:
+                is_equal = self._compare_toolset(e.right, e.left)
+            if is_equal is not None:
+                return BoolValueExpr(is_equal == (op == BoolExpr.EQUAL), pos=e.pos)
+        return e
+
+    def _compare_toolset(self, toolset, value):
+        # Returns True if *toolset* is the toolset property and is always
+        # equal to *value*, False if it's never equal to it and None if
+        # it's not known.
+        try:
+            while isinstance(toolset, ReferenceExpr):
+                toolset = toolset.get_value()
+            if not (isinstance(toolset, PlaceholderExpr) and toolset.var == "toolset"):
+                return None
+            value = value.as_py()
+        except NonConstError:
+            return None
+        if value not in self.toolsets:
+            return False
+        if len(self.toolsets) == 1:
+            return True
+        return None
+
+
 def simplify(e):
     """
     Simplifies given expression as much as possible, employing all tricks in
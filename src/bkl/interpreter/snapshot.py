@@ -0,0 +1,227 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+
+"""
+Snapshots of finalized models.
+
+Parsing the input, building the model and finalizing it doesn't depend on
+the toolsets the outputs are generated for, yet it usually takes most of the
+time of a run. When the project is processed again with unchanged inputs,
+only for different toolsets or to dump the model, the finalized model is
+loaded from a snapshot saved by the previous run (see :func:`save`) and the
+processing continues with generating the outputs. Models specialized for
+individual toolsets are saved in separate snapshots in the same way, because
+specializing the model is expensive too.
+
+A snapshot is keyed the same way as a :mod:`bkl.manifest` is: it records
+hashes of all input files of the project, Bakefile version and options that
+influence the model, and is only used if none of them changed. Warnings
+reported while building the model are stored in the snapshot too and are
+reported again when it is used. Plugins loaded by the project are recorded
+as well and are loaded again before the snapshot is used, because their
+extensions are needed by the model and to generate the outputs.
+
+Snapshots are pickled models; extensions (e.g. target types) are stored by
+their names and resolved to the instances of the current process on load.
+"""
+
+import os
+import os.path
+import sys
+import zlib
+import cPickle as pickle
+import logging
+from cStringIO import StringIO
+
+import bkl.api
+import bkl.error
+import bkl.manifest
+import bkl.parser.cache
+import bkl.plugins
+import bkl.props
+
+logger = logging.getLogger("bkl.interpreter.snapshot")
+
+# Version of the format of snapshot files, increment when changing it.
+_FORMAT_VERSION = 6
+_SUFFIX = ".model"
+
+# pickling deeply nested expressions needs a lot of stack
+_RECURSION_LIMIT = 20000
+
+
+class WarningsRecorder(bkl.parser.cache.WarningsRecorder):
+    """
+    Logging handler collecting warnings reported while building the model,
+    so that they can be stored in the snapshot. Use it in the same way as
+    :class:`bkl.parser.cache.WarningsRecorder`.
+    """
+    def emit(self, record):
+        if not self._suspended:
+            self.warnings.append((record.getMessage(), getattr(record, "pos", None)))
+
+
+def _persistent_id(obj):
+    if isinstance(obj, bkl.api.Extension):
+        cls = type(obj)
+        return "%s:%s" % (cls.__module__, cls.__name__)
+    return None
+
+
+def _persistent_load(pid):
+    module, name = pid.split(":")
+    try:
+        cls = getattr(sys.modules[module], name)
+    except (KeyError, AttributeError):
+        raise pickle.UnpicklingError("unknown extension %s" % pid)
+    return cls.get()
+
+
+def _snapshot_filename(snapshot_dir, filename, toolset):
+    path = os.path.normcase(os.path.abspath(filename))
+    name = bkl.manifest.hash_data(path)
+    if toolset:
+        name += "." + toolset
+    return os.path.join(snapshot_dir, name + _SUFFIX)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def save(snapshot_dir, filename, options, model, warnings=[], toolset=None):
+    """
+    Saves snapshot of *model*, finalized model of the project *filename*
+    processed with *options* (any picklable value), together with
+    *warnings* collected by :class:`WarningsRecorder` and hashes of all input
+    files recorded so far (see :func:`bkl.manifest.add_input`). If *toolset*
+    is given, *model* is the model finalized for this toolset.
+    """
+    header = {
+        "format":  _FORMAT_VERSION,
+        "version": bkl.manifest._get_version(),
+        "options": options,
+        "inputs":  dict(bkl.manifest._inputs),
+        "plugins": [fn for fn in bkl.plugins._loaded_files if fn in bkl.manifest._inputs],
+        "warnings": warnings,
+        }
+    path = _snapshot_filename(snapshot_dir, filename, toolset)
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, _RECURSION_LIMIT))
+    try:
+        buf = StringIO()
+        p = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        p.persistent_id = _persistent_id
+        p.dump(model)
+        data = zlib.compress(buf.getvalue(), 1)
+
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        tmpname = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpname, "wb") as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            f.write(data)
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpname, path)
+        logger.debug("saved snapshot of %s (%d bytes)", filename, len(data))
+    except (IOError, OSError, pickle.PicklingError, TypeError, RuntimeError) as e:
+        logger.debug("failed to save snapshot of %s: %s", filename, e)
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+
+def load(snapshot_dir, filename, options, replay_warnings=True, toolset=None):
+    """
+    Returns finalized model of the project *filename* processed with
+    *options* (for *toolset*, if given) from its snapshot, or :const:`None`
+    if there's no snapshot or the project's inputs changed since it was
+    saved. Input files of the project are recorded as if it was processed
+    and, unless *replay_warnings* is False, warnings reported when the model
+    was built are reported again.
+    """
+    path = _snapshot_filename(snapshot_dir, filename, toolset)
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, _RECURSION_LIMIT))
+    try:
+        with f:
+            header = pickle.load(f)
+            if header.get("format") != _FORMAT_VERSION:
+                logger.debug("snapshot of %s is in different format", filename)
+                return None
+            if header.get("version") != bkl.manifest._get_version():
+                logger.debug("snapshot of %s was saved by different Bakefile version", filename)
+                return None
+            if header.get("options") != options:
+                logger.debug("snapshot of %s was saved with different options", filename)
+                return None
+            inputs = header.get("inputs")
+            if not inputs:
+                return None
+            for fn, hash in inputs.iteritems():
+                if bkl.manifest._hash_file(fn) != hash:
+                    logger.debug("not using snapshot of %s, %s changed", filename, fn)
+                    return None
+
+            # the model may use extensions defined by plugins:
+            plugins = header["plugins"]
+            if plugins:
+                for fn in plugins:
+                    bkl.plugins.load_from_file(fn)
+                bkl.props.registry.force_rescan()
+
+            u = pickle.Unpickler(StringIO(zlib.decompress(f.read())))
+            u.persistent_load = _persistent_load
+            model = u.load()
+    except Exception as e:
+        # anything can go wrong when unpickling damaged or incompatible data
+        logger.debug("removing unusable snapshot %s of %s: %s", path, filename, e)
+        _remove(path)
+        return None
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+    logger.debug("using snapshot of %s", filename)
+    bkl.manifest._inputs.update(inputs)
+    if replay_warnings:
+        for msg, pos in header["warnings"]:
+            bkl.error.warning("%s", msg, pos=pos)
+    return model
+
+
+def remove(snapshot_dir, filename, toolset=None):
+    """
+    Removes snapshot of *filename* (for *toolset*, if given), so that it
+    isn't used again.
+    """
+    _remove(_snapshot_filename(snapshot_dir, filename, toolset))
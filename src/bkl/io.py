@@ -30,6 +30,8 @@ changes, line endings conversions etc.
 import os
 import os.path
 
+import bkl.manifest
+
 import logging
 logger = logging.getLogger("bkl.io")
 
@@ -55,6 +57,11 @@ EOL_UNIX    = "unix"
 
 _all_written_files = {}
 
+# If set, OutputFile.commit() calls this function with the file instead of
+# writing it. This is used to write files generated in worker processes from
+# the main process, see bkl.interpreter.parallel.
+_redirect_commit = None
+
 class OutputFile(object):
     """
     File to be written by Bakefile.
@@ -90,6 +97,8 @@ class OutputFile(object):
         self.filename = filename
         self.eol = eol
         self.charset = charset
+        self.creator = creator
+        self.create_for = create_for
         self.text = ""
 
     def write(self, text):
@@ -113,8 +122,12 @@ class OutputFile(object):
         self.text = self.text.replace(placeholder, value, 1)
 
     def commit(self):
+        if _redirect_commit is not None:
+            _redirect_commit(self)
+            return
         if self.eol == EOL_WINDOWS:
             self.text = self.text.replace("\n", "\r\n")
+        bkl.manifest.add_output(self.filename, self.text)
         try:
             rel_fn = os.path.relpath(self.filename)
         except ValueError:
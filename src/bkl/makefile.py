@@ -247,6 +247,8 @@ class MakefileToolset(Toolset):
             """
             mod_deps = set()
             project = main.project
+            # not walking the submodules, because submodules of removed
+            # modules are kept in the project:
             inspect = [submodule] + [p for p in project.modules if p.is_submodule_of(submodule)]
             for mod in inspect:
                 for target in mod.targets.itervalues():
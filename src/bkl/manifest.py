@@ -0,0 +1,193 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Manifest of files used and generated by the last run, used to avoid doing
+the same work again.
+
+While processing a project, all input files that influence the output are
+recorded (see :func:`add_input`) -- parsed ``.bkl`` files, including
+submodules and imports, loaded plugins and external project files -- together
+with the generated files (see :func:`add_output`). :func:`save` then stores
+their hashes, along with Bakefile version and options affecting the output.
+If none of them changed by the next run, :func:`is_up_to_date` returns True
+and the project doesn't need to be processed at all.
+
+Dependencies are tracked for the project as a whole: modules inherit
+variables from their parents and the generated files reference targets from
+other modules, so the whole project is processed again when any of its
+inputs changes. Output files that end up unchanged are not modified even
+then, see :meth:`bkl.io.OutputFile.commit`.
+"""
+
+import os
+import os.path
+import sys
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger("bkl.manifest")
+
+# Version of the format of manifest files, increment when changing it.
+_FORMAT_VERSION = 1
+_SUFFIX = ".manifest"
+
+# Input and output files of the current run, as absolute filename -> hash of
+# the content
+_inputs = {}
+_outputs = {}
+
+
+def hash_data(data):
+    """Returns hash of *data*, as used for files recorded in the manifest."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def _hash_file(filename):
+    try:
+        with open(filename, "rb") as f:
+            return hash_data(f.read())
+    except IOError:
+        return None
+
+
+def add_input(filename, data=None, content_hash=None):
+    """
+    Records that *filename* was used as an input. *data* is the content of
+    the file, as it was read, or *content_hash* its hash (see
+    :func:`hash_data`); if neither is given, the file is read again.
+    """
+    path = os.path.abspath(filename)
+    if content_hash is None:
+        content_hash = hash_data(data) if data is not None else _hash_file(path)
+    _inputs[path] = content_hash
+
+
+def add_output(filename, data):
+    """
+    Records that *filename* was generated with content *data*.
+    """
+    _outputs[os.path.abspath(filename)] = hash_data(data)
+
+
+def reset():
+    """Forgets all files recorded so far, e.g. before processing another project."""
+    _inputs.clear()
+    _outputs.clear()
+
+
+_version = None
+
+def _get_version():
+    """
+    Returns string identifying this version of Bakefile. Besides the version
+    number, it includes timestamps of Bakefile's own modules, so that
+    development versions are recognized as different too.
+    """
+    global _version
+    if _version is None:
+        import bkl
+        import bkl.version
+        h = hashlib.sha1()
+        h.update("%d %s %s" % (_FORMAT_VERSION, bkl.version.VERSION, sys.version))
+        pkg_dir = os.path.dirname(os.path.abspath(bkl.__file__))
+        for dirpath, dirnames, filenames in os.walk(pkg_dir):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith(".py"):
+                    st = os.stat(os.path.join(dirpath, fn))
+                    h.update("%s %d %d\n" % (fn, st.st_size, st.st_mtime))
+        _version = h.hexdigest()
+    return _version
+
+
+def _manifest_filename(manifest_dir, filename):
+    path = os.path.normcase(os.path.abspath(filename))
+    return os.path.join(manifest_dir, hash_data(path) + _SUFFIX)
+
+
+def is_up_to_date(manifest_dir, filename, options):
+    """
+    Returns True if processing of *filename* with given *options* (any JSON
+    serializable value) wouldn't change anything, because neither the inputs
+    nor the outputs changed since the manifest was saved.
+    """
+    try:
+        with open(_manifest_filename(manifest_dir, filename), "rb") as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    if manifest.get("version") != _get_version():
+        logger.debug("manifest of %s was written by different Bakefile version", filename)
+        return False
+    if manifest.get("options") != options:
+        logger.debug("options used for %s changed", filename)
+        return False
+    for kind in ("inputs", "outputs"):
+        files = manifest.get(kind)
+        if not files:
+            return False
+        for fn, hash in files.iteritems():
+            if _hash_file(fn) != hash:
+                logger.debug("%s changed", fn)
+                return False
+    return True
+
+
+def save(manifest_dir, filename, options):
+    """
+    Saves manifest of the current run, processing of *filename* with
+    *options*, i.e. all files recorded with :func:`add_input` and
+    :func:`add_output`.
+    """
+    data = json.dumps({
+                "version": _get_version(),
+                "options": options,
+                "inputs":  _inputs,
+                "outputs": _outputs,
+                }, sort_keys=True, indent=1)
+    path = _manifest_filename(manifest_dir, filename)
+    try:
+        if not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        tmpname = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpname, "wb") as f:
+            f.write(data)
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpname, path)
+    except (IOError, OSError) as e:
+        logger.debug("failed to save manifest of %s: %s", filename, e)
+
+
+def remove(manifest_dir, filename):
+    """
+    Removes manifest of *filename*, so that it is processed again next time.
+    """
+    try:
+        os.remove(_manifest_filename(manifest_dir, filename))
+    except OSError:
+        pass
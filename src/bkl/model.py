@@ -24,6 +24,7 @@
 
 import os.path
 import copy
+import weakref
 
 import logging
 logger = logging.getLogger("bkl.model")
@@ -33,6 +34,60 @@ import props
 import expr
 from utils import memoized_property
 
+
+class ResolutionStats(object):
+    """
+    Statistics of the cache of variables resolution used by
+    :meth:`ModelPart.resolve_variable` and
+    :meth:`ModelPart.get_variable_value`.
+
+    .. attribute:: hits
+
+       Number of lookups answered from the cache.
+
+    .. attribute:: misses
+
+       Number of lookups that had to be resolved, in this scope (they may
+       still hit the cache in parent scopes).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    def format(self):
+        total = self.hits + self.misses
+        return "variables resolution cache: %d lookups, %d hits (%.1f%%)" % \
+                (total, self.hits, 100.0 * self.hits / total if total else 0.0)
+
+#: Statistics of the cache of variables resolution.
+resolution_stats = ResolutionStats()
+
+# Generations of variable names: incremented whenever a variable with the
+# name is added anywhere, which invalidates the cached resolutions of the name
+# (see ModelPart._resolve()).
+_variable_generations = {}
+
+def _variable_added(name):
+    _variable_generations[name] = _variable_generations.get(name, 0) + 1
+    _value_changed(name)
+
+# Generations of values of variables: incremented whenever a variable with the
+# name is added or its value is changed with Variable.set_value() or
+# ModelPart.update_variable_value(), which invalidates cached default
+# expressions computed from it (see ModelPart.cached_default_expr()).
+_value_generations = {}
+
+def _value_changed(name):
+    _value_generations[name] = _value_generations.get(name, 0) + 1
+
+# Names of variables looked up while computing a default expression, or None
+# if no default expression is being computed.
+_looked_up = None
+
+
 class Variable(object):
     """
     A Bakefile variable.
@@ -69,6 +124,9 @@ class Variable(object):
        Indicates if the value was set explicitly by the user.
        Normally true, only false for properties' default values.
     """
+    __slots__ = ("name", "type", "value", "readonly", "is_property",
+                 "is_explicitly_set", "pos", "_simplified_value")
+
     def __init__(self, name, value, type=None, readonly=False, source_pos=None):
         self.name = name
         if type is None:
@@ -79,6 +137,8 @@ class Variable(object):
         self.is_property = False
         self.is_explicitly_set = True
         self.pos = source_pos
+        # value for which eliminate_superfluous_conditionals() was done
+        self._simplified_value = None
 
     @staticmethod
     def from_property(prop, value=None):
@@ -105,6 +165,23 @@ class Variable(object):
             raise error.Error("variable \"%s\" is read-only" % self.name)
         # FIXME: type checks
         self.value = value
+        _value_changed(self.name)
+
+
+# Variables holding shared default values of properties, see
+# Property.is_default_shared().
+_shared_defaults = {}
+
+def _shared_default_variable(prop, value):
+    # Returns variable for property *prop* with its shared default *value*,
+    # which may be used in any number of model parts, because they never
+    # modify it directly (see ModelPart.update_variable_value()).
+    var = _shared_defaults.get(prop)
+    if var is None or var.value is not value:
+        var = Variable.from_property(prop, value)
+        var.is_explicitly_set = False
+        _shared_defaults[prop] = var
+    return var
 
 
 class Configuration(object):
@@ -135,9 +212,10 @@ class Configuration(object):
         self.base = base
         self.is_debug = is_debug
         self.source_pos = source_pos
-        # for internal use, this is a list of AST nodes that
-        # define the configuration
-        self._definition = []
+        # for internal use, this is a sequence of AST nodes that
+        # define the configuration and the same compiled by the builder
+        self._definition = ()
+        self._patch = ()
 
     def create_derived(self, new_name, source_pos=None):
         """Returns a new copy of this configuration with a new name."""
@@ -183,9 +261,10 @@ class Template(object):
         self.name = name
         self.bases = bases
         self.source_pos = source_pos
-        # for internal use, this is a list of AST nodes that
-        # define the configuration
-        self._definition = []
+        # for internal use, this is a sequence of AST nodes that
+        # define the configuration and the same compiled by the builder
+        self._definition = ()
+        self._patch = ()
 
 
 class ModelPart(object):
@@ -199,7 +278,9 @@ class ModelPart(object):
 
     .. attribute:: variables
 
-       Dictionary of all variables defined in global scope in this module
+       Dictionary of all variables defined in global scope in this module.
+       Use :meth:`add_variable()` to add variables to it, so that cached
+       resolutions of variables are updated.
 
     .. attribute:: parent
 
@@ -216,13 +297,51 @@ class ModelPart(object):
         self.parent = parent
         self.variables = utils.OrderedDict()
         self.source_pos = source_pos
+        # names of variables whose objects are shared with another copy of
+        # the model or with other parts, see update_variable_value()
+        self._shared_variables = set()
+        # cached results of _resolve() and _default_scope()
+        self._resolved = {}
+        self._default_scopes = {}
+        # cached results of cached_default_expr()
+        self._default_exprs = {}
+
+    # the cached resolutions are only valid in this process, with its
+    # generations of variables, so they are not pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_resolved"]
+        del state["_default_scopes"]
+        del state["_default_exprs"]
+        state.pop("_configurations", None)
+        state.pop("_proxy_resolvers", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._resolved = {}
+        self._default_scopes = {}
+        self._default_exprs = {}
 
     def _clone_into(self, clone):
         clone.source_pos = self.source_pos
-        # variables must be copied, but shallow copy is OK for them
-        clone.variables = utils.OrderedDict()
-        for k,v in self.variables.iteritems():
-            clone.variables[k] = copy.copy(v)
+        # variables are shared by both copies until one of them modifies them:
+        clone.variables = self.variables.copy()
+        clone._shared_variables = set(self.variables)
+        self._shared_variables.update(self.variables)
+        # references in them are rebound by _rebind_references():
+        clone._default_exprs = self._default_exprs.copy()
+
+    def _rebind_references(self, rebinder):
+        # Called by Project.clone() on the copy of the model to make its
+        # variables reference its parts, see _ReferencesRebinder.
+        for name, var in self.variables.items():
+            new = rebinder.rebind_variable(var)
+            if new is not var:
+                self.variables[name] = new
+                self._shared_variables.discard(name)
+        for prop, (deps, value) in self._default_exprs.items():
+            self._default_exprs[prop] = (deps, rebinder.rebind(value))
 
     def _clone(self, parent, objmap):
         raise NotImplementedError
@@ -344,18 +463,52 @@ class ModelPart(object):
         .. note:: Unlike :meth:`get_variable_value()`, this method doesn't
                   look for properties' default values.
         """
-        var = self.get_variable(name)
-        if var is not None:
-            return var
-
-        if self.parent:
+        scope = self._resolve(name)
+        if scope is None:
+            return None
+        return scope.variables.get(name)
+
+
+    def _resolve(self, name):
+        # Returns the part in which variable *name* used in this part is
+        # defined, or None. This is cached until a variable with this name is
+        # added anywhere, or the known properties change.
+        if _looked_up is not None:
+            _looked_up.append(name)
+        gen = _variable_generations.get(name, 0)
+        props_gen = props.registry.generation
+        entry = self._resolved.get(name)
+        if entry is not None and entry[0] == gen and entry[1] == props_gen:
+            resolution_stats.hits += 1
+            return entry[2]
+        resolution_stats.misses += 1
+
+        if name in self.variables:
+            scope = self
+        elif self.parent:
             # there may be a property with this name; if so, we must check it for
             # its 'inheritable' flag:
             p = self.get_prop(name)
             can_inherit = (p is None) or p.inheritable
-            if can_inherit:
-                return self.parent.resolve_variable(name)
-        return None
+            scope = self.parent._resolve(name) if can_inherit else None
+        else:
+            scope = None
+        self._resolved[name] = (gen, props_gen, scope)
+        return scope
+
+
+    def _default_scope(self, name):
+        # Returns the nearest part with property *name*, or None. This only
+        # depends on the known properties.
+        props_gen = props.registry.generation
+        entry = self._default_scopes.get(name)
+        if entry is not None and entry[0] == props_gen:
+            return entry[1]
+        scope = self
+        while scope and scope.get_prop(name) is None:
+            scope = scope.parent
+        self._default_scopes[name] = (props_gen, scope)
+        return scope
 
 
     def get_variable_value(self, name):
@@ -385,12 +538,9 @@ class ModelPart(object):
 
         # there may be a property with this name; try to find it and use its
         # default value
-        scope = self
-        while scope:
-            p = scope.get_prop(name)
-            if p is not None:
-                return p.default_expr(scope, throw_if_required=False)
-            scope = scope.parent
+        scope = self._default_scope(name)
+        if scope is not None:
+            return scope.get_prop(name).default_expr(scope, throw_if_required=False)
         raise error.UndefinedError("unknown variable \"%s\"" % name)
 
 
@@ -416,6 +566,7 @@ class ModelPart(object):
         """Adds a new variable object."""
         assert var.name not in self.variables
         self.variables[var.name] = var
+        _variable_added(var.name)
 
 
     def set_property_value(self, prop, value):
@@ -426,12 +577,70 @@ class ModelPart(object):
         wrapper around :meth:`add_variable()` and :meth:`get_prop()`.
         """
         if prop in self.variables:
-            self.variables[prop].value = value
+            self.update_variable_value(self.variables[prop], value)
         else:
             v = Variable.from_property(self.get_prop(prop), value)
             self.add_variable(v)
 
 
+    def update_variable_value(self, var, value):
+        """
+        Sets value of variable *var* defined in this part to *value*.
+
+        Unlike setting :attr:`Variable.value` directly, this works correctly
+        with copies of the model made by :meth:`Project.clone()`, which share
+        variable objects with the original: a shared variable is replaced with
+        a private copy before modifying it.
+        """
+        if value is var.value:
+            return
+        if var.name in self._shared_variables:
+            assert self.variables[var.name] is var
+            self._shared_variables.discard(var.name)
+            var = copy.copy(var)
+            self.variables[var.name] = var
+        var.value = value
+        _value_changed(var.name)
+
+
+    def cached_default_expr(self, prop, make):
+        """
+        Returns default value of property *prop* in this part, as computed by
+        calling *make*, which is only done if the value isn't cached yet.
+
+        The cached value remains valid until a variable it was computed from
+        (i.e. looked up while *make* was running) is added or its value is
+        changed with :meth:`update_variable_value()` or
+        :meth:`Variable.set_value()`. Assigning to :attr:`Variable.value`
+        directly, as the passes normalizing the model do, doesn't invalidate
+        it.
+
+        .. seealso:: :meth:`bkl.api.Property.default_expr()`
+        """
+        global _looked_up
+        entry = self._default_exprs.get(prop)
+        if entry is not None:
+            deps, value = entry
+            if all(_value_generations.get(n, 0) == g for n, g in deps):
+                # the outer default, if any, depends on the same variables
+                if _looked_up is not None:
+                    _looked_up.extend(n for n, g in deps)
+                return value
+
+        outer = _looked_up
+        _looked_up = []
+        try:
+            value = make()
+            names = set(_looked_up)
+        finally:
+            _looked_up = outer
+        if outer is not None:
+            outer.extend(names)
+        deps = tuple((n, _value_generations.get(n, 0)) for n in names)
+        self._default_exprs[prop] = (deps, value)
+        return value
+
+
     def get_prop(self, name):
         """
         Try to get a property *name*. Called by get_variable_value() if no
@@ -480,7 +689,8 @@ class ModelPart(object):
         Creates variables for properties that don't have variables set yet.
 
         :param toolset: Name of the toolset to generate for. Properties
-                specific to other toolsets are ignored for efficiency.
+                specific to other toolsets are ignored for efficiency. If
+                :const:`None`, all toolset-specific properties are ignored.
         """
         for p in self.enum_props():
             if p.toolsets and toolset not in p.toolsets:
@@ -490,10 +700,17 @@ class ModelPart(object):
                     # don't create default for inheritable properties at higher
                     # levels than what they're defined for
                     continue
-                var = Variable.from_property(p, p.default_expr(self, throw_if_required=True))
-                var.is_explicitly_set = False
+                value = p.default_expr(self, throw_if_required=True)
+                if p.is_default_shared():
+                    # the same value is used everywhere, so is the variable
+                    var = _shared_default_variable(p, value)
+                    self._shared_variables.add(p.name)
+                else:
+                    var = Variable.from_property(p, value)
+                    var.is_explicitly_set = False
                 logger.debug("%s: setting default of %s: %s", self, var.name, var.value)
                 self.variables[p.name] = var
+                _variable_added(p.name)
 
 
     def all_variables(self):
@@ -508,6 +725,16 @@ class ModelPart(object):
                 yield v
 
 
+    def all_parts(self):
+        """
+        Returns iterator over this part and all parts under it, recursively.
+        """
+        yield self
+        for c in self.child_parts():
+            for p in c.all_parts():
+                yield p
+
+
     def __getitem__(self, key):
         try:
             return self.get_variable_value(key)
@@ -515,6 +742,80 @@ class ModelPart(object):
             raise KeyError(str(e))
 
 
+class _ReferencesRebinder(object):
+    """
+    Rebinds references in expressions shared by a copy of the model made by
+    :meth:`Project.clone()` with the original to the parts of the copy, as
+    given by *scope_map*. Expressions without such references are returned
+    unchanged, so that they stay shared, and each expression is only
+    processed once.
+    """
+    def __init__(self, scope_map):
+        self.scope_map = scope_map
+        # already processed expressions, as id -> (expression, result)
+        self._done = {}
+
+    def _rebind_items(self, items):
+        # returns None if no item changes, without making a new list then
+        for n, i in enumerate(items):
+            new = self.rebind(i)
+            if new is not i:
+                return items[:n] + [new] + [self.rebind(x) for x in items[n+1:]]
+        return None
+
+    def rebind(self, e):
+        """Returns expression *e* with rebound references."""
+        t = type(e)
+        # the most common case, not worth remembering:
+        if t is expr.LiteralExpr:
+            return e
+        done = self._done.get(id(e))
+        if done is not None:
+            return done[1]
+        new = e
+        if t is expr.ReferenceExpr:
+            context = self.scope_map.get(e.context)
+            if context is not None:
+                new = expr.ReferenceExpr(e.var, context, pos=e.pos)
+        elif t is expr.ListExpr or t is expr.ConcatExpr:
+            items = self._rebind_items(e.items)
+            if items is not None:
+                new = t(items, pos=e.pos)
+        elif t is expr.PathExpr:
+            components = self._rebind_items(e.components)
+            if components is not None:
+                new = expr.PathExpr(components, e.anchor, e.anchor_file, pos=e.pos)
+        elif t is expr.BoolExpr:
+            left = self.rebind(e.left)
+            right = None if e.right is None else self.rebind(e.right)
+            if left is not e.left or right is not e.right:
+                new = expr.BoolExpr(e.operator, left, right, pos=e.pos)
+        elif t is expr.IfExpr:
+            cond = self.rebind(e.cond)
+            yes = self.rebind(e.value_yes)
+            no = self.rebind(e.value_no)
+            if cond is not e.cond or yes is not e.value_yes or no is not e.value_no:
+                new = expr.IfExpr(cond, yes, no, pos=e.pos)
+        self._done[id(e)] = (e, new)
+        return new
+
+    def rebind_variable(self, var):
+        """
+        Returns *var* if its value doesn't change by rebinding, otherwise
+        its copy with the rebound value.
+        """
+        value = self.rebind(var.value)
+        if value is var.value:
+            return var
+        simplified = var._simplified_value is var.value
+        var = copy.copy(var)
+        var.value = value
+        if simplified:
+            var._simplified_value = value
+        return var
+
+
+
 class Project(ModelPart):
     """
     Abstract model that completely describes state of loaded and processed
@@ -535,6 +836,11 @@ class Project(ModelPart):
     .. attribute:: templates
 
        Dictionary of all templates defined in the project.
+
+    .. attribute:: scope_map
+
+       Mapping of parts of the original model to their copies in this one,
+       if this model is a copy made by :meth:`clone()`, or empty dictionary.
     """
 
     name = "project"
@@ -542,7 +848,10 @@ class Project(ModelPart):
     def __init__(self):
         super(Project, self).__init__(parent=None)
         self.fully_qualified_name = ""
+        self.scope_map = {}
         self.modules = []
+        # all targets in the project, indexed by their names:
+        self._targets_by_name = {}
         self.configurations = utils.OrderedDict()
         self.settings = utils.OrderedDict()
         self.templates = {}
@@ -555,10 +864,16 @@ class Project(ModelPart):
         Makes an independent copy of the model.
 
         Unlike deepcopy(), this does *not* copy everything, but uses an
-        appropriate mix of deep and shallow copies. For example, expressions,
-        which are read-only, are copied shallowly, but variables or model
-        parts, both of which can be modified in further toolset-specific
-        optimizations, are copied deeply.
+        appropriate mix of deep and shallow copies. Model parts are copied,
+        because their structure (e.g. list of targets) is modified in further
+        toolset-specific optimizations. Variables are shared by both copies
+        until modified with :meth:`ModelPart.update_variable_value()` and
+        expressions, which are read-only, are always shared.
+
+        Expressions referencing parts of the original model are rebound to
+        the corresponding parts of the copy (see :attr:`scope_map`), so the
+        copy is self-contained; only variables whose values change by this
+        aren't shared.
         """
         c = Project()
         objmap = {self:c}
@@ -574,20 +889,19 @@ class Project(ModelPart):
         c.templates = self.templates
         c._srcdir_map = self._srcdir_map
 
-        # We need to process all expressions and remap ReferenceExpr.context to
-        # point to the new objects. This is relatively expensive (about as much
-        # as all the work above was), but unavoidable without changing the way
-        # ReferenceExpr works.
-        class _RewriteContext(expr.RewritingVisitor):
-            def __init__(self, objmap):
-                super(_RewriteContext, self).__init__()
-                self.objmap = objmap
-            def reference(self, e):
-                return expr.ReferenceExpr(e.var, self.objmap[e.context], e.pos)
-
-        rewr = _RewriteContext(objmap)
-        for var in c.all_variables():
-            var.value = rewr.visit(var.value)
+        # Expressions may reference parts of this model as well as parts of
+        # the model this one was copied from, if any:
+        c.scope_map = dict((orig, objmap[part]) for orig, part in self.scope_map.iteritems())
+        c.scope_map.update(objmap)
+
+        rebinder = _ReferencesRebinder(c.scope_map)
+        c._rebind_references(rebinder)
+        for x in c.settings.itervalues():
+            x._rebind_references(rebinder)
+        for m in c.modules:
+            m._rebind_references(rebinder)
+            for t in m.targets.itervalues():
+                t._rebind_references(rebinder)
 
         return c
 
@@ -613,17 +927,25 @@ class Project(ModelPart):
 
     def get_target(self, id):
         """Returns Target object identified by its string ID."""
-        for t in self.all_targets():
-            if t.name == id:
-                return t
-        raise error.Error("target \"%s\" doesn't exist" % id)
+        try:
+            return self._targets_by_name[id]
+        except KeyError:
+            raise error.Error("target \"%s\" doesn't exist" % id)
 
     def has_target(self, id):
         """Returns true if target with given name exists."""
-        for t in self.all_targets():
-            if t.name == id:
-                return True
-        return False
+        return id in self._targets_by_name
+
+    def remove_module(self, module):
+        """
+        Removes *module* and its targets from the project. Its submodules,
+        if any, are kept.
+        """
+        self.modules.remove(module)
+        if isinstance(module.parent, Module):
+            module.parent._submodules.remove(module)
+        for t in module.targets.itervalues():
+            del self._targets_by_name[t.name]
 
     def _get_prop(self, name):
         return props.get_project_prop(name)
@@ -679,7 +1001,10 @@ class Module(ModelPart):
     def __init__(self, parent, source_pos):
         super(Module, self).__init__(parent, source_pos)
         self.targets = utils.OrderedDict()
+        self._submodules = []
         self.project.modules.append(self)
+        if isinstance(parent, Module):
+            parent._submodules.append(self)
         self.imports = set()
 
     def _clone(self, parent, objmap):
@@ -701,6 +1026,11 @@ class Module(ModelPart):
     def child_parts(self):
         return self.targets.itervalues()
 
+    def remove_target(self, target):
+        """Removes *target* from this module and from the project."""
+        del self.targets[target.name]
+        del self.project._targets_by_name[target.name]
+
     @property
     def source_file(self):
         return self.source_pos.filename
@@ -722,14 +1052,21 @@ class Module(ModelPart):
     @property
     def submodules(self):
         """Submodules of this module."""
-        return (x for x in self.project.modules if x.parent is self)
+        return iter(self._submodules)
 
     def is_submodule_of(self, module):
         """Returns True if this module is (grand-)*child of *module*."""
+        return module in self._ancestors
+
+    @memoized_property
+    def _ancestors(self):
+        # parent links never change, so this can be computed just once
+        ancestors = set()
         m = self.parent
-        while m and m is not module:
+        while m:
+            ancestors.add(m)
             m = m.parent
-        return m is module
+        return ancestors
 
     def _get_prop(self, name):
         return props.get_module_prop(name)
@@ -756,26 +1093,78 @@ class ConfigurationsPropertyMixin:
         >>> for cfg in target.configurations:
         ...     outdir = cfg["outdir"]
         """
-        prj = self.project
+        for cfg in self._get_configurations():
+            yield ConfigurationProxy(self, cfg)
+
+    def _get_configurations(self):
+        # The list of configurations is checked only once, unless the value
+        # of the property changes. The cache is set lazily and is not copied
+        # into clones of the model.
         cfglist = self["configurations"]
+        cached = self.__dict__.get("_configurations")
+        if cached is not None and cached[0] is cfglist:
+            return cached[1]
+        prj = self.project
+        configs = []
         for cname in cfglist.as_py():
             try:
-                cfg = prj.configurations[cname]
+                configs.append(prj.configurations[cname])
             except KeyError:
                 # TODO: validate the values earlier, as part of vartypes validation
                 raise error.Error("configuration \"%s\" not defined" % cname, pos=cfglist.pos)
-            yield ConfigurationProxy(self, cfg)
+        self._configurations = (cfglist, configs)
+        return configs
+
+    def _proxy_resolver(self, config, arch):
+        # Returns ProxyIfResolver for given configuration and architecture,
+        # shared by all proxies in the project: the resolved values don't
+        # depend on the part they are used in and the same expressions (e.g.
+        # default values) are often used by many parts, so caching them for
+        # all proxies is much more efficient than caching them per part.
+        prj = self.project
+        try:
+            resolvers = prj._proxy_resolvers
+        except AttributeError:
+            resolvers = prj._proxy_resolvers = {}
+        key = (config.name, arch)
+        try:
+            return resolvers[key]
+        except KeyError:
+            r = resolvers[key] = ProxyIfResolver(config.name, arch)
+            return r
 
 
 class ProxyIfResolver(expr.RewritingVisitor):
     """
-    Replaces references to $(config) with value, allowing the expressions
-    to be evaluated.
+    Replaces references to $(config) (and $(arch), if given) with value,
+    allowing the expressions to be evaluated.
+
+    Results of :meth:`resolve` are cached, so the mapping must not be
+    changed after it was used.
     """
-    def __init__(self, config):
+    def __init__(self, config, arch=None):
         super(ProxyIfResolver, self).__init__()
         self.mapping = {"config": config}
+        if arch is not None:
+            self.mapping["arch"] = arch
         self.inside_cond = 0
+        # id of expression -> (expression, resolved value)
+        self._resolved = {}
+
+    def resolve(self, e):
+        """
+        Returns expression *e* with the conditionals resolved, using a cached
+        result if *e* was already resolved. The cache assumes that values of
+        variables referenced from *e* don't change afterwards, which is the
+        case when generating output from the final model.
+        """
+        entry = self._resolved.get(id(e))
+        if entry is not None and entry[0] is e:
+            return entry[1]
+        value = self.visit(e)
+        # keeping the expression in the cache guarantees its id is not reused
+        self._resolved[id(e)] = (e, value)
+        return value
 
     def visit_cond(self, e):
         try:
@@ -819,17 +1208,26 @@ class ConfigurationProxy(object):
 
     See :meth:`bkl.model.ModelPartWithConfigurations.configurations` for more information.
     """
-    def __init__(self, model, config):
+    def __init__(self, model, config, arch=None):
         self.model = model
         self.config = config
-        self._visitor = ProxyIfResolver(config.name)
+        self.arch = arch
 
     name = property(lambda self: self.config.name)
     is_debug = property(lambda self: self.config.is_debug)
     project = property(lambda self: self.model.project)
 
+    def _set_arch(self, arch):
+        self._arch = arch
+        self._visitor = self.model._proxy_resolver(self.config, arch)
+
+    arch = property(lambda self: self._arch, _set_arch, doc="""
+        Architecture to resolve references to $(arch) for, or :const:`None`
+        to keep them unresolved.
+        """)
+
     def __getitem__(self, key):
-        return self._visitor.visit(self.model[key])
+        return self._visitor.resolve(self.model[key])
 
     def apply_subst(self, value):
         """
@@ -839,9 +1237,9 @@ class ConfigurationProxy(object):
         and so the proxy is only partially effective.
         """
         if isinstance(value, list):
-            return [self._visitor.visit(x) for x in value]
+            return [self._visitor.resolve(x) for x in value]
         else:
-            return self._visitor.visit(value)
+            return self._visitor.resolve(value)
 
     def should_build(self):
         # see ModelPart.should_build()
@@ -876,7 +1274,8 @@ class Target(ModelPart, ConfigurationsPropertyMixin):
 
     .. attribute:: sources
 
-       List of source files, as SourceFile instances.
+       List of source files, as :class:`SourceFileList` of SourceFile
+       instances.
 
     .. attribute:: headers
 
@@ -888,20 +1287,28 @@ class Target(ModelPart, ConfigurationsPropertyMixin):
         super(Target, self).__init__(parent, source_pos)
         self.name = name
         self.type = target_type
-        self.sources = []
-        self.headers = []
+        self.sources = SourceFileList(self)
+        self.headers = SourceFileList(self)
 
         assert isinstance(parent, Module)
         assert not parent.project.has_target(name)
         parent.targets[name] = self
+        parent.project._targets_by_name[name] = self
 
     def _clone(self, parent, objmap):
-        c = Target(parent, self.name, self.type, self.source_pos)
+        # don't use the constructor, the checks it does are expensive and
+        # unnecessary here
+        c = Target.__new__(Target)
+        ModelPart.__init__(c, parent)
+        c.name = self.name
+        c.type = self.type
+        parent.targets[c.name] = c
+        parent.project._targets_by_name[c.name] = c
         objmap[self] = c
         ModelPart._clone_into(self, c)
         # These must be fully cloned:
-        c.sources = [x._clone(c, objmap) for x in self.sources]
-        c.headers = [x._clone(c, objmap) for x in self.headers]
+        c.sources = self.sources._clone(c, objmap)
+        c.headers = self.headers._clone(c, objmap)
         return c
 
     def __str__(self):
@@ -914,6 +1321,19 @@ class Target(ModelPart, ConfigurationsPropertyMixin):
     def all_source_files(self):
         return self.child_parts()
 
+    def _rebind_references(self, rebinder):
+        ModelPart._rebind_references(self, rebinder)
+        self.sources._rebind_references(rebinder)
+        self.headers._rebind_references(rebinder)
+
+    def all_variables(self):
+        # don't create SourceFile objects just to enumerate their variables
+        for v in self.variables.itervalues():
+            yield v
+        for files in (self.sources, self.headers):
+            for v in files._all_variables():
+                yield v
+
     def _get_prop(self, name):
         return props.get_target_prop(self.type, name)
 
@@ -926,17 +1346,76 @@ class Target(ModelPart, ConfigurationsPropertyMixin):
 class SourceFile(ModelPart, ConfigurationsPropertyMixin):
     """
     Source file object.
+
+    Files without any settings of their own are stored compactly in
+    :class:`SourceFileList` and only exist as SourceFile objects while they
+    are used; such a file becomes a permanent part of the list as soon as it
+    is modified.
     """
     def __init__(self, parent, filename, source_pos):
         super(SourceFile, self).__init__(parent, source_pos)
+        # SourceFileList this file is stored compactly in, or None
+        self._files = None
         self.set_property_value("_filename", filename)
 
     def _clone(self, parent, objmap):
-        c = SourceFile(parent, self.filename, self.source_pos)
+        # the variables are copied below, no need to set them in constructor
+        c = SourceFile.__new__(SourceFile)
+        ModelPart.__init__(c, parent)
+        c._files = None
         objmap[self] = c
         ModelPart._clone_into(self, c)
         return c
 
+    def _materialize(self):
+        # Makes the file a permanent part of the model, which is necessary
+        # before adding or replacing any of its variables.
+        if self._files is not None:
+            self._files._materialize(self)
+
+    def add_variable(self, var):
+        self._materialize()
+        ModelPart.add_variable(self, var)
+
+    def update_variable_value(self, var, value):
+        if self._files is not None and value is not var.value:
+            if var.name == "_filename":
+                # filenames are kept in the list, even for modified files
+                self._files._update_filename(self, value)
+                return
+            self._materialize()
+        ModelPart.update_variable_value(self, var, value)
+
+    def make_variables_for_missing_props(self, toolset):
+        files = self._files
+        if files is None:
+            ModelPart.make_variables_for_missing_props(self, toolset)
+            return
+        had = set(self.variables)
+        ModelPart.make_variables_for_missing_props(self, toolset)
+        shared = []
+        null = []
+        for name, var in self.variables.iteritems():
+            if name in had:
+                continue
+            if name in self._shared_variables:
+                # shared defaults are the same for all compactly stored files
+                # of the list (see Property.is_default_shared())
+                shared.append((name, var))
+            elif var.value.is_null():
+                # null default is the same as no variable at all
+                null.append(name)
+            else:
+                self._materialize()
+                return
+        # this object must look the same as when it's created again later;
+        # removing the variable changes the scope it's found in, so bump its
+        # generation again, like when it was added above:
+        for name in null:
+            del self.variables[name]
+            _variable_added(name)
+        files._add_defaults(shared)
+
     @property
     def filename(self):
         f = self["_filename"]
@@ -968,6 +1447,220 @@ class SourceFile(ModelPart, ConfigurationsPropertyMixin):
         return props.enum_file_props()
 
 
+class SourceFileList(object):
+    """
+    List of :class:`SourceFile` objects of a target (:attr:`Target.sources`
+    or :attr:`Target.headers`), which can be used like a Python list of them.
+
+    Targets may have many thousands of files, almost none of which have any
+    settings of their own, so this doesn't keep a full SourceFile object for
+    each of them: the files are stored in parallel columns (their
+    ``_filename`` variables and positions) and only those that have other
+    variables are kept as SourceFile objects, in a sparse overlay. The others are created
+    on demand when iterating over the list or indexing it, and are only kept
+    while they are referenced, so the same object is returned for a file as
+    long as it is in use.
+
+    Their default values of properties are stored in the list too, as long
+    as they are shared by all parts (see
+    :meth:`bkl.api.Property.is_default_shared`).
+    """
+    def __init__(self, target):
+        self._target = target
+        # ``_filename`` variables of the files and their positions in the
+        # input (None for files kept as SourceFile objects)
+        self._filename_vars = []
+        self._positions = []
+        # for each file: None, the SourceFile (if it has variables of its own)
+        # or a weak reference to it (if it doesn't)
+        self._parts = []
+        # variables of files that don't have any variables of their own: the
+        # ``_filename`` (set for each file) and default values of properties
+        # shared by all of them
+        self._template = utils.OrderedDict([("_filename", None)])
+        self._defaults = frozenset()
+        # are the column's variables shared with a clone of the model?
+        self._shared = False
+        # indices of files removed by remove(), which are only dropped from
+        # the columns, all at once, by _compact() when the list is used next
+        self._removed = set()
+
+    def add_file(self, filename, source_pos):
+        """
+        Adds file *filename* (as :class:`bkl.expr.Expr`) to the list, without
+        creating a :class:`SourceFile` object for it.
+        """
+        var = Variable.from_property(props.get_file_prop("_filename"), filename)
+        self._filename_vars.append(var)
+        self._positions.append(source_pos)
+        self._parts.append(None)
+        _variable_added("_filename")
+
+    def append(self, srcfile):
+        """Adds :class:`SourceFile` object *srcfile* to the list."""
+        assert srcfile._files is None
+        srcfile._index = len(self._parts)
+        self._filename_vars.append(None)
+        self._positions.append(None)
+        self._parts.append(srcfile)
+
+    def remove(self, srcfile):
+        """Removes *srcfile* from the list."""
+        i = self._index(srcfile)
+        self._filename_vars[i] = self._positions[i] = self._parts[i] = None
+        self._removed.add(i)
+        srcfile._files = srcfile._index = None
+
+    def _compact(self):
+        # Drops the files removed since the last call from the columns and
+        # updates the indices of the remaining ones.
+        removed = self._removed
+        keep = [i for i in xrange(len(self._parts)) if i not in removed]
+        self._filename_vars = [self._filename_vars[i] for i in keep]
+        self._positions = [self._positions[i] for i in keep]
+        self._parts = [self._parts[i] for i in keep]
+        for i, p in enumerate(self._parts):
+            f = p() if type(p) is weakref.ref else p
+            if f is not None:
+                f._index = i
+        self._removed = set()
+
+    def __len__(self):
+        if self._removed:
+            self._compact()
+        return len(self._parts)
+
+    def __iter__(self):
+        i = 0
+        while i < len(self):
+            yield self._get(i)
+            i += 1
+
+    def __getitem__(self, index):
+        if self._removed:
+            self._compact()
+        if isinstance(index, slice):
+            return [self._get(i) for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("source file index out of range")
+        return self._get(index)
+
+    def __contains__(self, srcfile):
+        i = getattr(srcfile, "_index", None)
+        return i is not None and i < len(self._parts) and self._get_stored(i) is srcfile
+
+    def _get(self, i):
+        p = self._parts[i]
+        if p is not None:
+            if type(p) is not weakref.ref:
+                return p
+            f = p()
+            if f is not None:
+                return f
+        var = self._filename_vars[i]
+        f = SourceFile.__new__(SourceFile)
+        ModelPart.__init__(f, self._target, self._positions[i])
+        f._files = self
+        f._index = i
+        f.variables = self._template.copy()
+        f.variables["_filename"] = var
+        f._shared_variables = set(self._defaults)
+        self._parts[i] = weakref.ref(f)
+        return f
+
+    def _all_variables(self):
+        # Yields variables of all files, like iterating over the files and
+        # calling their all_variables() would.
+        if self._removed:
+            self._compact()
+        template = self._template
+        for i in xrange(len(self._parts)):
+            p = self._parts[i]
+            if p is not None:
+                f = p() if type(p) is weakref.ref else p
+                if f is not None:
+                    for v in f.all_variables():
+                        yield v
+                    continue
+            yield self._filename_vars[i]
+            for name in template.order[1:]:
+                yield template[name]
+
+    def _index(self, srcfile):
+        # files in the list remember their index, which is kept up to date by
+        # _compact(), so that they don't have to be searched for
+        if srcfile not in self:
+            raise ValueError("%s is not in the list" % srcfile)
+        return srcfile._index
+
+    def _get_stored(self, i):
+        p = self._parts[i]
+        return p() if type(p) is weakref.ref else p
+
+    def _materialize(self, srcfile):
+        # Keeps compactly stored srcfile as full SourceFile object from now on.
+        i = self._index(srcfile)
+        self._filename_vars[i] = self._positions[i] = None
+        self._parts[i] = srcfile
+        srcfile._files = None
+
+    def _update_filename(self, srcfile, value):
+        i = self._index(srcfile)
+        var = self._filename_vars[i]
+        if self._shared:
+            var = copy.copy(var)
+            self._filename_vars[i] = var
+            srcfile.variables["_filename"] = var
+        var.value = value
+        _value_changed(var.name)
+
+    def _add_defaults(self, variables):
+        if variables:
+            self._template.update(variables)
+            self._defaults = self._defaults.union(n for n, v in variables)
+
+    def _clone(self, target, objmap):
+        if self._removed:
+            self._compact()
+        c = SourceFileList(target)
+        c._filename_vars = list(self._filename_vars)
+        c._positions = list(self._positions)
+        c._parts = [p._clone(target, objmap)
+                    if p is not None and type(p) is not weakref.ref else None
+                    for p in self._parts]
+        for i, p in enumerate(c._parts):
+            if p is not None:
+                p._index = i
+        c._template = self._template.copy()
+        c._defaults = self._defaults
+        # like ModelPart._clone_into(), share the variables until modified:
+        c._shared = self._shared = True
+        return c
+
+    def _rebind_references(self, rebinder):
+        # see ModelPart._rebind_references()
+        for i, var in enumerate(self._filename_vars):
+            if var is not None:
+                self._filename_vars[i] = rebinder.rebind_variable(var)
+        for name, var in self._template.items():
+            if var is not None:
+                self._template[name] = rebinder.rebind_variable(var)
+        for p in self._parts:
+            if p is not None and type(p) is not weakref.ref:
+                p._rebind_references(rebinder)
+
+    # weak references can't be pickled
+    def __getstate__(self):
+        if self._removed:
+            self._compact()
+        state = self.__dict__.copy()
+        state["_parts"] = [p if type(p) is not weakref.ref else None
+                           for p in self._parts]
+        return state
+
+
 
 class Setting(ModelPart):
     """
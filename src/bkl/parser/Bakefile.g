@@ -77,6 +77,19 @@ scope StmtScope;
 }
     : introductory_stmt* stmt* EOF -> ^(PROGRAM introductory_stmt* stmt*);
 
+// Same as program, but instead of building the whole tree, every top-level
+// statement is passed to self.on_statement() as soon as it is parsed. See
+// bkl.parser.parse_streaming().
+program_streaming
+scope StmtScope;
+@init {
+    $StmtScope::insideTarget = False
+    $StmtScope::insideConfigOrSetting = False
+}
+    : (s1=introductory_stmt! { self.on_statement($s1.tree) })*
+      (s2=stmt! { self.on_statement($s2.tree) })*
+      EOF!;
+
 stmt
     : stmt_always_allowed
     | {$StmtScope::insideTarget}?=> stmt_inside_target
@@ -35,14 +35,31 @@ except ImportError:
     else:
         raise
 
+import sys
+
 import ast
+import cache
+import fastlexer
+import prefetch
 from BakefileLexer import BakefileLexer
 from BakefileParser import BakefileParser, LITERAL
 from BakefileQuotedStringLexer import BakefileQuotedStringLexer
 from BakefileQuotedStringParser import BakefileQuotedStringParser
 
+import bkl.manifest
 from bkl.error import ParserError, VersionError, warning
-from bkl.utils import memoized
+from bkl.utils import memoized_bounded
+
+#: Whether to use the faster regex-based lexer (see :mod:`bkl.parser.fastlexer`)
+#: instead of the ANTLR-generated one. The ANTLR lexer is still used for
+#: inputs the fast lexer can't handle, to get correct error messages.
+use_fast_lexer = True
+
+#: Whether to keep parsed ASTs of files in memory after they were added to the
+#: model, so that processing the same files again doesn't parse them again
+#: (see :mod:`bkl.daemon`). Callers of :func:`parse_file` normally release
+#: them as soon as they aren't needed.
+keep_parsed_files = False
 
 
 # Helper to implement errors handling in a way we prefer
@@ -74,24 +91,26 @@ class _BakefileErrorsMixin(object):
 class _BakefileParserMixin(object):
     def unescape(self, token, text):
         """Removes \\ escapes from the text."""
-        out = ""
+        if '\\' not in text:
+            return text
+        out = []
         start = 0
         while True:
             pos = text.find('\\', start)
             if pos == -1:
-                out += text[start:]
+                out.append(text[start:])
                 break
             else:
-                out += text[start:pos]
+                out.append(text[start:pos])
                 c = text[pos+1]
-                out += c
+                out.append(c)
                 start = pos+2
                 if c != '"' and c != '\\' and c != '$':
                     source_pos = self._get_position(token)
                     source_pos.column += pos+1
                     warning("unnecessary escape sequence '\\%s' (did you mean '\\\\%s'?)" % (c, c),
                             pos=source_pos)
-        return out
+        return "".join(out)
 
 
 # The lexer and parser used to parse .bkl files.
@@ -123,6 +142,18 @@ class _Parser(_BakefileErrorsMixin, _BakefileParserMixin, BakefileParser):
         if not text:
             return self._adaptor.create(LITERAL, token, "")
 
+        # Only strings with variable references need the island grammar, the
+        # rest are simple literals that only need to be unescaped. Notice that
+        # the token is positioned on the first character inside the quotes,
+        # same as the island parser's token would be:
+        if '$' not in text:
+            t = antlr3.CommonToken(oldToken=token)
+            t.charPositionInLine += 1
+            return self._adaptor.create(LITERAL, t, self.unescape(t, text))
+
+        return self._parse_quoted_str_island(token, text)
+
+    def _parse_quoted_str_island(self, token, text):
         stream = antlr3.StringStream(text)
         stream.setLine(token.line)
         stream.setCharPositionInLine(token.charPositionInLine + 1)
@@ -142,9 +173,16 @@ def get_parser(code, filename=None):
     if code and code[-1] != "\n":
         code += "\n"
 
-    cStream = antlr3.StringStream(code)
-    lexer = _Lexer(cStream)
-    lexer.filename = filename
+    lexer = None
+    if use_fast_lexer:
+        try:
+            lexer = fastlexer.FastLexer(code, filename)
+        except (fastlexer.LexerError, UnicodeError):
+            pass
+    if lexer is None:
+        cStream = antlr3.StringStream(code)
+        lexer = _Lexer(cStream)
+        lexer.filename = filename
 
     tStream = antlr3.CommonTokenStream(lexer)
     parser = _Parser(tStream)
@@ -162,40 +200,177 @@ def parse(code, filename=None, detect_compatibility_errors=True):
     """
     parser = get_parser(code, filename)
     try:
-        return parser.program().tree
+        return ast.compact(parser.program().tree, filename)
     except ParserError as err:
-        if not detect_compatibility_errors:
-            raise
-        # Report usage of bkl-ng with old bkl files in user-friendly way:
-        if code.startswith("<?xml"):
-            raise ParserError("this file is incompatible with new Bakefile versions; please use Bakefile 0.2.x to process it",
-                              pos=ast.Position(filename))
-        else:
-            # Another possible problem is that that this version of Bakefile
-            # may be too old and doesn't recognize some newly introduced
-            # syntax. Try to report that nicely too.
-            code_lines = code.splitlines()
-            for idx in xrange(0, len(code_lines)):
-                ln = code_lines[idx]
-                if "requires" in ln:
-                    try:
-                        parse(ln, detect_compatibility_errors=False)
-                    except VersionError as e:
-                        e.pos.filename = filename
-                        e.pos.line = idx+1
-                        raise
-                    except ParserError as e:
-                        pass
-            raise err
-
-
-@memoized
+        if detect_compatibility_errors:
+            _report_compatibility_errors(code, filename)
+        raise
+
+
+def parse_streaming(code, filename, on_statement, detect_compatibility_errors=True):
+    """
+    Parses Bakefile code like :func:`parse`, but instead of returning the
+    whole AST, calls *on_statement* with every top-level statement node as
+    soon as it is parsed, so that the statements don't have to be kept in
+    memory all at the same time.
+
+    If *on_statement* raises an exception, the rest of the input is still
+    parsed (but not passed to *on_statement*) and the exception is re-raised
+    only if there are no syntax errors, so that the same error is reported as
+    when the file is parsed with :func:`parse` first and processed afterwards.
+    """
+    failure = []
+
+    def handle(tree):
+        if failure or tree is None:
+            return
+        # empty statements produce nil trees:
+        nodes = tree.children if tree.isNil() else [tree]
+        try:
+            for node in nodes:
+                on_statement(ast.compact(node, filename))
+        except Exception:
+            failure.append(sys.exc_info())
+
+    parser = get_parser(code, filename)
+    parser.on_statement = handle
+    try:
+        parser.program_streaming()
+    except ParserError:
+        if detect_compatibility_errors:
+            _report_compatibility_errors(code, filename)
+        raise
+    if failure:
+        exc_type, exc_value, exc_tb = failure[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def _report_compatibility_errors(code, filename):
+    """
+    Called when parsing *code* failed, raises more helpful error if the
+    failure is caused by the file being for a different version of Bakefile.
+    """
+    # Report usage of bkl-ng with old bkl files in user-friendly way:
+    if code.startswith("<?xml"):
+        raise ParserError("this file is incompatible with new Bakefile versions; please use Bakefile 0.2.x to process it",
+                          pos=ast.Position(filename))
+    else:
+        # Another possible problem is that that this version of Bakefile
+        # may be too old and doesn't recognize some newly introduced
+        # syntax. Try to report that nicely too.
+        code_lines = code.splitlines()
+        for idx in xrange(0, len(code_lines)):
+            ln = code_lines[idx]
+            if "requires" in ln:
+                try:
+                    parse(ln, detect_compatibility_errors=False)
+                except VersionError as e:
+                    e.pos.filename = filename
+                    e.pos.line = idx+1
+                    raise
+                except ParserError as e:
+                    pass
+
+
 def parse_file(filename):
     """
     Reads Bakefile code from given file returns parsed AST.
+
+    Parsed ASTs of recently used files are kept in memory, so calling this
+    function repeatedly with the same file is cheap. Use
+    ``parse_file.forget(filename)`` to release the AST of a file that won't be
+    needed again.
+
+    If the file was already parsed by :func:`bkl.parser.prefetch.prefetch`,
+    that AST is used. If the persistent cache is enabled (see
+    :mod:`bkl.parser.cache`), the AST is loaded from it if possible and stored
+    in it otherwise.
+    """
+    tree, content_hash = _parse_file(filename)
+    # recorded even if the AST was kept in memory, e.g. when it is imported
+    # by several projects processed one after another:
+    bkl.manifest.add_input(filename, content_hash=content_hash)
+    return tree
+
+
+@memoized_bounded(64)
+def _parse_file(filename):
+    """
+    Implementation of :func:`parse_file`, returns tuple of the AST and hash
+    of the file's content.
     """
     with file(filename, "rt") as f:
-        return parse(f.read(), filename)
+        code = f.read()
+    content_hash = bkl.manifest.hash_data(code)
+
+    prefetched = prefetch.take(filename, code)
+    if prefetched is not None:
+        data, warnings = prefetched
+        tree = ast.deserialize_tree(data, filename)
+        cache.replay_warnings(filename, warnings)
+        if cache.cache_dir is not None:
+            cache.store(filename, code, tree, warnings)
+        return (tree, content_hash)
+
+    if cache.cache_dir is None:
+        return (parse(code, filename), content_hash)
+
+    tree = cache.load(filename, code)
+    if tree is None:
+        with cache.WarningsRecorder() as w:
+            tree = parse(code, filename)
+        cache.store(filename, code, tree, w.warnings)
+    return (tree, content_hash)
+
+# same interface as memoized functions have:
+parse_file.func = lambda filename: _parse_file.func(filename)[0]
+parse_file.forget = _parse_file.forget
+parse_file.clear = _parse_file.clear
+
+
+def parse_file_streaming(filename, on_statement):
+    """
+    Reads Bakefile code from given file and passes its top-level statements
+    to *on_statement* one by one, see :func:`parse_streaming`.
+
+    The same sources of already parsed ASTs as in :func:`parse_file` are used
+    if available, and the parsed AST is stored in the persistent cache.
+    """
+    with file(filename, "rt") as f:
+        code = f.read()
+    bkl.manifest.add_input(filename, code)
+
+    # use the whole tree only if it doesn't have to be parsed (or must be
+    # kept anyway):
+    tree = None
+    if keep_parsed_files or (filename,) in _parse_file.cache:
+        tree = parse_file(filename)
+    elif prefetch._prefetched.get(filename):
+        tree = parse_file(filename)
+        parse_file.forget(filename)
+    elif cache.cache_dir is not None:
+        tree = cache.load(filename, code)
+    if tree is not None:
+        for node in tree.children:
+            on_statement(node)
+        return
+
+    if cache.cache_dir is None:
+        parse_streaming(code, filename, on_statement)
+        return
+
+    # the statements have to be kept for the cache, but only in the compact
+    # form, without the ANTLR tree:
+    statements = []
+    with cache.WarningsRecorder() as w:
+        def handle(node):
+            statements.append(node)
+            with w.suspended():
+                on_statement(node)
+        parse_streaming(code, filename, handle)
+    linecol = statements[0]._linecol if statements else 0
+    tree = ast.RootNode("PROGRAM", filename, linecol, tuple(statements))
+    cache.store(filename, code, tree, w.warnings)
 
 
 # for testing of AST construction, make this script runnable:
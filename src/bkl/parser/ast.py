@@ -26,7 +26,20 @@ from antlr3.tree import CommonTree, CommonTreeAdaptor
 
 import BakefileParser
 
-from bkl.utils import memoized_property
+
+# Names of the source files referenced by positions. Positions only store
+# the index of the name in this table, which is shared by all of them:
+_filenames = [None]
+_filename_ids = {None: 0}
+
+def _get_filename_id(filename):
+    try:
+        return _filename_ids[filename]
+    except KeyError:
+        _filenames.append(filename)
+        id = _filename_ids[filename] = len(_filenames) - 1
+        return id
+
 
 class Position(object):
     """
@@ -47,20 +60,38 @@ class Position(object):
 
        Column on the line.
     """
+    __slots__ = ("_file", "line", "column")
+
     def __init__(self, filename=None, line=None, column=None):
-        self.filename = filename
+        self._file = _get_filename_id(filename)
         self.line = line
         self.column = column
 
+    @property
+    def filename(self):
+        return _filenames[self._file]
+
+    @filename.setter
+    def filename(self, value):
+        self._file = _get_filename_id(value)
+
+    # the filename IDs are only valid in this process, so pickle the name:
+    def __getstate__(self):
+        return (self.filename, self.line, self.column)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
     def __eq__(self, other):
-        return (self.filename == other.filename and
+        return (self._file == other._file and
                 self.line == other.line and
                 self.column == other.column)
 
     def __str__(self):
         hdr = []
-        if self.filename:
-            hdr.append(self.filename)
+        filename = self.filename
+        if filename:
+            hdr.append(filename)
         if self.line is not None:
             hdr.append(str(self.line))
         if self.column is not None:
@@ -68,29 +99,50 @@ class Position(object):
         return ":".join(hdr)
 
 
-class Node(CommonTree):
+class Node(object):
     """
     Base class for Bakefile AST tree node.
+
+    The nodes are created from ANTLR's tree after parsing (see
+    :func:`compact`) and are kept as small as possible: they don't keep any
+    reference to the tokens or the parser and are immutable.
+
+    .. attribute:: children
+
+       Tuple of children nodes.
+
+    .. attribute:: text
+
+       Text of the node's token.
+
+    .. attribute:: filename
+
+       Name of the source file.
     """
+    __slots__ = ("children", "text", "filename", "_linecol")
+
+    def __init__(self, text, filename, linecol=None, children=()):
+        self.text = text
+        self.filename = filename
+        self._linecol = linecol
+        self.children = children
 
     # Position of the node in source code, as parser.Position object.
     # FIXME: if it doesn't have position, look at siblings in the tree
     # and return "near $foo.pos" for some foo parent or sibling
-    @memoized_property
+    @property
     def pos(self):
         """Position of the node in source code"""
-        pos = Position()
-        pos.filename = self.filename
-        if self.token:
-            pos.line = self.line
-            pos.column = self.charPositionInLine
+        pos = Position(self.filename)
+        lc = self._linecol
+        if lc is not None:
+            pos.line = lc >> _COLUMN_BITS
+            pos.column = lc & _COLUMN_MASK
         return pos
 
     def __str__(self):
         return self.__class__.__name__
 
-    # CommonTree methods:
-
     def toString(self):
         return str(self)
 
@@ -104,24 +156,26 @@ class Node(CommonTree):
         return '%s\n%s' % (s, '\n'.join(_formatNode(c) for c in self.children))
 
 
+# Line and column are packed into a single integer in the nodes:
+_COLUMN_BITS = 20
+_COLUMN_MASK = (1 << _COLUMN_BITS) - 1
+
+
 class RootNode(Node):
     """Root node of loaded .bkl file."""
-    pass
+    __slots__ = ()
 
 
 class NilNode(Node):
     """Empty node."""
-    def __init__(self, payload=None):
-        Node.__init__(self, payload)
+    __slots__ = ()
     def __nonzero__(self):
         return False
 
 
 class LiteralNode(Node):
     """Single value, i.e. literal."""
-
-    #: Text of the value, as string.
-    text = property(lambda self: self.token.text)
+    __slots__ = ()
 
     def __str__(self):
         return '%s "%s"' % (self.__class__.__name__, self.text)
@@ -129,11 +183,12 @@ class LiteralNode(Node):
 
 class PathAnchorNode(LiteralNode):
     """A literal with path anchor (@srcdir etc.)."""
-    pass
+    __slots__ = ()
 
 
 class BoolvalNode(Node):
     """Boolean constant (true/false)."""
+    __slots__ = ()
 
     #: Value of the node, as boolean
     value = property(lambda self: self.text == "true")
@@ -147,6 +202,7 @@ class ListNode(Node):
     Right side of variable assignment, contains list of values (LiteralNode,
     VarReferenceNode etc.).
     """
+    __slots__ = ()
     #: List of values in the assignment. May be single value, maybe be
     #: multiple values, code using this must correctly interpret it and
     #: check values' types.
@@ -157,14 +213,14 @@ class ConcatNode(Node):
     """
     Concatenation of several parts, to form single string.
     """
+    __slots__ = ()
     #: List of fragments.
     values = property(lambda self: self.children)
 
 
 class IdNode(Node):
     """Identifier (variable, target, template, ...)."""
-    # Text of the identifier, as string.
-    text = property(lambda self: self.token.text)
+    __slots__ = ()
 
     def __str__(self):
         return '%s %s' % (self.__class__.__name__, self.text)
@@ -172,12 +228,14 @@ class IdNode(Node):
 
 class VarReferenceNode(Node):
     """Reference to a variable."""
+    __slots__ = ()
     var = property(lambda self: self.children[0].text,
                    doc="Referenced variable")
 
 
 class AssignmentNode(Node):
     """Assignment of value to a variable."""
+    __slots__ = ()
     lvalue = property(lambda self: self.children[0],
                       doc="Variable assigning to, LvalueNode")
     value = property(lambda self: self.children[1],
@@ -187,11 +245,13 @@ class AssignmentNode(Node):
 
 class AppendNode(AssignmentNode):
     """Assignment of value to a variable by appending (operator +=)."""
+    __slots__ = ()
     append = True
 
 
 class LvalueNode(Node):
     """Left side of assignment."""
+    __slots__ = ()
     var = property(lambda self: self.children[-1].text,
                    doc="Variable assigning to")
     @property
@@ -203,6 +263,7 @@ class LvalueNode(Node):
 
 class FilesListNode(Node):
     """Setting of sources/headers."""
+    __slots__ = ()
     kind = property(lambda self: self.children[0].text,
                     doc="Sources/headers")
     files = property(lambda self: self.children[1],
@@ -211,6 +272,7 @@ class FilesListNode(Node):
 
 class IfNode(Node):
     """Conditional content node -- "if" statement."""
+    __slots__ = ()
     cond = property(lambda self: self.children[0],
                    doc="Condition expression")
     content = property(lambda self: self.children[1:],
@@ -218,50 +280,71 @@ class IfNode(Node):
 
 
 class BoolNode(Node):
-    operator = property(lambda self: self.token.type,
-                        doc="Boolean operator (token type, e.g. AND)")
+    __slots__ = ()
+    #: Boolean operator (token type, e.g. AND)
+    operator = None
     left = property(lambda self: self.children[0], doc="Left operand")
     right = property(lambda self: self.children[1], doc="Right operand")
 
-class OrNode(BoolNode): pass
-class AndNode(BoolNode): pass
-class NotNode(BoolNode): pass
-class EqualNode(BoolNode): pass
-class NotEqualNode(BoolNode): pass
+class OrNode(BoolNode):
+    __slots__ = ()
+    operator = BakefileParser.OR
+
+class AndNode(BoolNode):
+    __slots__ = ()
+    operator = BakefileParser.AND
+
+class NotNode(BoolNode):
+    __slots__ = ()
+    operator = BakefileParser.NOT
+
+class EqualNode(BoolNode):
+    __slots__ = ()
+    operator = BakefileParser.EQUAL
+
+class NotEqualNode(BoolNode):
+    __slots__ = ()
+    operator = BakefileParser.NOT_EQUAL
 
 
 class SubmoduleNode(Node):
     """Inclusion of a submodule."""
+    __slots__ = ()
     file = property(lambda self: self.children[0].text,
                     doc="File with submodule definition")
 
 
 class ImportNode(Node):
     """Textual inclusion of a file."""
+    __slots__ = ()
     file = property(lambda self: self.children[0].text,
                     doc="File to include")
 
 
 class PluginNode(Node):
     """Inclusion of a plugin."""
+    __slots__ = ()
     file = property(lambda self: self.children[0].text,
                     doc="File with plugin code")
 
 
 class SrcdirNode(Node):
     """Overriding of the @srcdir value."""
+    __slots__ = ()
     srcdir = property(lambda self: self.children[0].text,
                       doc="The new srcdir directory")
 
 
 class BaseListNode(Node):
     """List of base templates."""
+    __slots__ = ()
     names = property(lambda self: self.children,
                      doc="List of strings with base names")
 
 
 class TemplateNode(Node):
     """Template definition node."""
+    __slots__ = ()
     name = property(lambda self: self.children[0].text,
                     doc="Name of the target")
     base_templates = property(lambda self: self.children[1].names,
@@ -272,6 +355,7 @@ class TemplateNode(Node):
 
 class TargetNode(Node):
     """Creation of a makefile target."""
+    __slots__ = ()
     type = property(lambda self: self.children[0].text,
                     doc="Type of the target")
     name = property(lambda self: self.children[1].text,
@@ -284,6 +368,7 @@ class TargetNode(Node):
 
 class ConfigurationNode(Node):
     """Definition of a configuration."""
+    __slots__ = ()
     name = property(lambda self: self.children[0].text,
                     doc="Name of the configuration")
     base = property(lambda self: self.children[1].names[0] if self.children[1].names else None,
@@ -294,58 +379,106 @@ class ConfigurationNode(Node):
 
 class SettingNode(Node):
     """Definition of a user setting."""
+    __slots__ = ()
     name = property(lambda self: self.children[0].text,
                     doc="Name of the setting")
     content = property(lambda self: self.children[1:],
                        doc="Properties assignments and such")
 
 
+# mapping of token types to AST node classes
+_TOKENS_MAP = {
+    BakefileParser.NIL            : NilNode,
+    BakefileParser.PROGRAM        : RootNode,
+    BakefileParser.LITERAL        : LiteralNode,
+    BakefileParser.BOOLVAL        : BoolvalNode,
+    BakefileParser.PATH_ANCHOR    : PathAnchorNode,
+    BakefileParser.ID             : IdNode,
+    BakefileParser.LIST           : ListNode,
+    BakefileParser.CONCAT         : ConcatNode,
+    BakefileParser.VAR_REFERENCE  : VarReferenceNode,
+    BakefileParser.ASSIGN         : AssignmentNode,
+    BakefileParser.APPEND         : AppendNode,
+    BakefileParser.LVALUE         : LvalueNode,
+    BakefileParser.FILES_LIST     : FilesListNode,
+    BakefileParser.TARGET         : TargetNode,
+    BakefileParser.IF             : IfNode,
+    BakefileParser.OR             : OrNode,
+    BakefileParser.AND            : AndNode,
+    BakefileParser.NOT            : NotNode,
+    BakefileParser.EQUAL          : EqualNode,
+    BakefileParser.NOT_EQUAL      : NotEqualNode,
+    BakefileParser.SUBMODULE      : SubmoduleNode,
+    BakefileParser.IMPORT         : ImportNode,
+    BakefileParser.PLUGIN         : PluginNode,
+    BakefileParser.SRCDIR         : SrcdirNode,
+    BakefileParser.BASE_LIST      : BaseListNode,
+    BakefileParser.CONFIGURATION  : ConfigurationNode,
+    BakefileParser.SETTING        : SettingNode,
+    BakefileParser.TEMPLATE       : TemplateNode,
+}
+
+# token types of AST node classes, i.e. reverse of _TOKENS_MAP
+_NODE_TYPES = dict((cls, t) for t, cls in _TOKENS_MAP.iteritems())
+
+# Strings used in the nodes are shared, there's a lot of repetition in them
+_strings = {}
+
+
+def _pack_position(line, column):
+    if column > _COLUMN_MASK:
+        column = _COLUMN_MASK
+    return (line << _COLUMN_BITS) | column
+
+
+def compact(tree, filename):
+    """
+    Converts the tree produced by ANTLR parser into tree of :class:`Node`
+    instances that doesn't reference any parser objects.
+    """
+    token = tree.token
+    if token is None:
+        return NilNode(None, filename)
+    text = token.text
+    if text is not None:
+        text = _strings.setdefault(text, text)
+    return _TOKENS_MAP[token.type](
+                text,
+                filename,
+                _pack_position(tree.line, tree.charPositionInLine),
+                tuple(compact(c, filename) for c in tree.children))
+
+
+def serialize_tree(node):
+    """
+    Converts AST into nested tuples that can be marshalled or pickled.
+
+    .. seealso:: :func:`deserialize_tree`
+    """
+    return (_NODE_TYPES[type(node)], node.text, node._linecol,
+            tuple(serialize_tree(c) for c in node.children))
+
+
+def deserialize_tree(data, filename):
+    """
+    Inverse of :func:`serialize_tree`, recreates AST of file *filename*.
+    """
+    type, text, linecol, children = data
+    if text is not None:
+        text = _strings.setdefault(text, text)
+    return _TOKENS_MAP[type](text, filename, linecol,
+                             tuple(deserialize_tree(c, filename) for c in children))
+
+
 class _TreeAdaptor(CommonTreeAdaptor):
-    """Adaptor for ANTLR3 AST tree creation."""
+    """
+    Adaptor for ANTLR3 AST tree creation. The tree created by ANTLR is only
+    used during parsing and is converted into :class:`Node` tree with
+    :func:`compact` afterwards.
+    """
     def __init__(self, filename):
         self.filename = filename
 
-    # mapping of token types to AST node classes
-    TOKENS_MAP = {
-        BakefileParser.NIL            : NilNode,
-        BakefileParser.PROGRAM        : RootNode,
-        BakefileParser.LITERAL        : LiteralNode,
-        BakefileParser.BOOLVAL        : BoolvalNode,
-        BakefileParser.PATH_ANCHOR    : PathAnchorNode,
-        BakefileParser.ID             : IdNode,
-        BakefileParser.LIST           : ListNode,
-        BakefileParser.CONCAT         : ConcatNode,
-        BakefileParser.LIST_OR_CONCAT : Node, # post-processed below
-        BakefileParser.VAR_REFERENCE  : VarReferenceNode,
-        BakefileParser.ASSIGN         : AssignmentNode,
-        BakefileParser.APPEND         : AppendNode,
-        BakefileParser.LVALUE         : LvalueNode,
-        BakefileParser.FILES_LIST     : FilesListNode,
-        BakefileParser.TARGET         : TargetNode,
-        BakefileParser.IF             : IfNode,
-        BakefileParser.OR             : OrNode,
-        BakefileParser.AND            : AndNode,
-        BakefileParser.NOT            : NotNode,
-        BakefileParser.EQUAL          : EqualNode,
-        BakefileParser.NOT_EQUAL      : NotEqualNode,
-        BakefileParser.SUBMODULE      : SubmoduleNode,
-        BakefileParser.IMPORT         : ImportNode,
-        BakefileParser.PLUGIN         : PluginNode,
-        BakefileParser.SRCDIR         : SrcdirNode,
-        BakefileParser.BASE_LIST      : BaseListNode,
-        BakefileParser.CONFIGURATION  : ConfigurationNode,
-        BakefileParser.SETTING        : SettingNode,
-        BakefileParser.TEMPLATE       : TemplateNode,
-    }
-
-    def createWithPayload(self, payload):
-        if payload is None:
-            return NilNode()
-        else:
-            n = self.TOKENS_MAP[payload.type](payload)
-            n.filename = self.filename
-            return n
-
     def rulePostProcessing(self, root):
         root = CommonTreeAdaptor.rulePostProcessing(self, root)
         if root is not None:
@@ -0,0 +1,291 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Persistent cache of parsed ASTs.
+
+Parsing with the pure-Python ANTLR runtime is slow, so parsed trees are
+stored in a cache directory and reused by subsequent runs for as long as the
+file's content and the parser stay the same. Each entry is keyed by the
+absolute path of the file, SHA-1 hash of its content and a fingerprint of
+Bakefile version and grammar; entries that don't match, can't be read or are
+otherwise damaged are removed and the file is parsed again.
+
+The cache is disabled by default, set :data:`cache_dir` to enable it.
+"""
+
+import os
+import os.path
+import sys
+import marshal
+import contextlib
+import hashlib
+import logging
+
+import ast
+
+logger = logging.getLogger("bkl.parser.cache")
+
+#: Directory to store cached ASTs in or :const:`None` if caching is disabled.
+cache_dir = None
+
+#: Maximum total size of the cache, in bytes. Least recently used entries are
+#: evicted when it is exceeded.
+max_size = 32 * 1024 * 1024
+
+# Version of the format of cache entries, increment when changing it.
+_FORMAT_VERSION = 2
+_SUFFIX = ".ast"
+
+
+def get_default_cache_dir():
+    """
+    Returns the default location of the cache, i.e. per-user cache directory
+    as customary on the platform.
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.environ.get("APPDATA")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "bakefile")
+
+
+_fingerprint = None
+
+def _get_fingerprint():
+    """
+    Returns string identifying the parser that produced cached trees: any
+    change to Bakefile version, Python version or the parser modules
+    (including the generated grammar code) invalidates all entries.
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        import bkl.version
+        h = hashlib.sha1()
+        h.update("%d %s %s" % (_FORMAT_VERSION, bkl.version.VERSION, sys.version))
+        parser_dir = os.path.dirname(os.path.abspath(__file__))
+        for fn in sorted(os.listdir(parser_dir)):
+            if fn.endswith(".py") or fn.endswith(".tokens"):
+                with open(os.path.join(parser_dir, fn), "rb") as f:
+                    h.update(fn)
+                    h.update(f.read())
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+def _entry_filename(filename):
+    path = os.path.normcase(os.path.abspath(filename))
+    return os.path.join(cache_dir, hashlib.sha1(path).hexdigest() + _SUFFIX)
+
+
+class WarningsRecorder(logging.Handler):
+    """
+    Logging handler collecting warnings reported while parsing, so that they
+    can be stored in the cache and repeated when the entry is used.
+
+    Usage:
+
+    .. code-block:: python
+
+       with WarningsRecorder() as w:
+           ...parse...
+       store(filename, code, tree, w.warnings)
+    """
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.warnings = []
+        self._suspended = 0
+
+    def emit(self, record):
+        if self._suspended:
+            return
+        pos = getattr(record, "pos", None)
+        if pos:
+            self.warnings.append((record.getMessage(), pos.line, pos.column))
+        else:
+            self.warnings.append((record.getMessage(), None, None))
+
+    def __enter__(self):
+        logging.getLogger("bkl.error").addHandler(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        logging.getLogger("bkl.error").removeHandler(self)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """
+        Context manager for ignoring warnings that are not caused by parsing,
+        e.g. when the parsed statements are processed as soon as they are
+        parsed.
+        """
+        self._suspended += 1
+        try:
+            yield
+        finally:
+            self._suspended -= 1
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _read_entry(filename, code):
+    """
+    Returns tuple with path of the cache entry for *filename*, its serialized
+    tree and list of warnings, or :const:`None` if there's no valid entry.
+    """
+    path = _entry_filename(filename)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    try:
+        fingerprint, content_hash, tree, warnings = marshal.loads(data)
+        valid = (fingerprint == _get_fingerprint() and
+                 content_hash == hashlib.sha1(code).hexdigest())
+    except (EOFError, ValueError, TypeError):
+        logger.debug("removing corrupt cache entry %s for %s", path, filename)
+        _remove(path)
+        return None
+    if not valid:
+        logger.debug("removing stale cache entry %s for %s", path, filename)
+        _remove(path)
+        return None
+    return (path, tree, warnings)
+
+
+def contains(filename, code):
+    """
+    Returns True if the cache has a valid entry for *filename* with content
+    *code*.
+    """
+    return _read_entry(filename, code) is not None
+
+
+def load(filename, code):
+    """
+    Returns cached AST for *filename* with content *code* or :const:`None` if
+    there's no valid cache entry for it. Warnings issued when the file was
+    originally parsed are reported again.
+    """
+    entry = _read_entry(filename, code)
+    if entry is None:
+        return None
+    path, tree, warnings = entry
+    try:
+        root = ast.deserialize_tree(tree, filename)
+    except (KeyError, ValueError, TypeError):
+        logger.debug("removing corrupt cache entry %s for %s", path, filename)
+        _remove(path)
+        return None
+
+    logger.debug("using cached AST of %s", filename)
+    # update modification time to keep track of least recently used entries
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+    replay_warnings(filename, warnings)
+    return root
+
+
+def replay_warnings(filename, warnings):
+    """
+    Reports warnings collected by :class:`WarningsRecorder` when parsing
+    *filename* again.
+    """
+    from bkl.error import warning
+    for msg, line, column in warnings:
+        warning("%s", msg, pos=ast.Position(filename, line, column))
+
+
+def store(filename, code, tree, warnings=[]):
+    """
+    Stores parsed AST *tree* of *filename* with content *code* in the cache.
+    *warnings* is list of warnings issued during parsing, as collected by
+    :class:`WarningsRecorder`.
+    """
+    path = _entry_filename(filename)
+    data = marshal.dumps((_get_fingerprint(),
+                          hashlib.sha1(code).hexdigest(),
+                          ast.serialize_tree(tree),
+                          warnings))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file first, so that concurrently running
+        # instances never see incomplete entries:
+        tmpname = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpname, "wb") as f:
+            f.write(data)
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpname, path)
+    except (IOError, OSError) as e:
+        logger.debug("failed to store cached AST of %s: %s", filename, e)
+        return
+    _evict()
+
+
+def _evict():
+    """Removes least recently used entries if the cache is too large."""
+    entries = []
+    total = 0
+    for fn in os.listdir(cache_dir):
+        if not fn.endswith(_SUFFIX):
+            continue
+        path = os.path.join(cache_dir, fn)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= max_size:
+        return
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        logger.debug("evicting cache entry %s", path)
+        _remove(path)
+        total -= size
+
+
+def clear():
+    """Removes all entries from the cache."""
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return
+    for fn in os.listdir(cache_dir):
+        if fn.endswith(_SUFFIX):
+            _remove(os.path.join(cache_dir, fn))
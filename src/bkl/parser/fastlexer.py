@@ -0,0 +1,168 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Lexer for ``.bkl`` files implemented with regular expressions.
+
+The lexer generated by ANTLR from ``Bakefile.g`` processes the input one
+character at a time and is the slowest part of parsing. :class:`FastLexer`
+produces exactly the same tokens (including hidden ones, with the same
+positions), but is much faster. It doesn't do any error reporting, though: if
+the input is not lexically valid, :exc:`LexerError` is raised and the caller
+should use the ANTLR lexer to get a proper error message.
+
+The rules below must be kept in sync with the lexer rules in ``Bakefile.g``.
+"""
+
+import re
+
+import antlr3
+from antlr3 import CommonToken, EOF, DEFAULT_CHANNEL, HIDDEN_CHANNEL
+
+import BakefileParser as _tokens
+
+
+class LexerError(Exception):
+    """
+    Raised by :class:`FastLexer` if it can't tokenize the input.
+    """
+    pass
+
+
+_TOKEN_RE = re.compile(r"""
+      (?P<WS>[ \t]+)
+    | (?P<NEWLINE>[\n\r])
+    | (?P<COMMENT>//[^\n\r]*\r?\n)
+    | (?P<ML_COMMENT>/\*.*?\*/)
+    | (?P<BAD_COMMENT>/[/*])
+    | (?P<TEXT>[a-zA-Z0-9_./-]+)
+    | (?P<DOUBLE_QUOTED_TEXT>"(?:\\.|[^"\\])*")
+    | (?P<SINGLE_QUOTED_TEXT>'(?:\\.|[^'\\])*')
+    | (?P<ANCHOR_KEYWORD>@[a-z_]+)
+    | (?P<OPERATOR>&&|\|\||==|!=|::|\+=|[!=:()$,;{}])
+    """, re.S | re.X)
+
+_HIDDEN = frozenset(["WS", "NEWLINE", "COMMENT", "ML_COMMENT"])
+
+_SIMPLE_TYPES = {
+    "WS":                 _tokens.WS,
+    "NEWLINE":            _tokens.NEWLINE,
+    "COMMENT":            _tokens.COMMENT,
+    "ML_COMMENT":         _tokens.ML_COMMENT,
+    "DOUBLE_QUOTED_TEXT": _tokens.DOUBLE_QUOTED_TEXT,
+    "SINGLE_QUOTED_TEXT": _tokens.SINGLE_QUOTED_TEXT,
+    "ANCHOR_KEYWORD":     _tokens.ANCHOR_KEYWORD,
+}
+
+# Types of keywords and operators, by their text; anonymous tokens used in
+# the grammar (e.g. 'if' or ';') are taken from the parser's token names.
+_FIXED_TYPES = {
+    "&&":    _tokens.AND,
+    "||":    _tokens.OR,
+    "!":     _tokens.NOT,
+    "==":    _tokens.EQUAL,
+    "!=":    _tokens.NOT_EQUAL,
+    "(":     _tokens.LPAREN,
+    ")":     _tokens.RPAREN,
+    "::":    _tokens.SCOPE_SEP,
+    "true":  _tokens.TRUE,
+    "false": _tokens.FALSE,
+}
+for _type, _name in enumerate(_tokens.tokenNames):
+    if _name.startswith("'"):
+        _FIXED_TYPES[_name[1:-1]] = _type
+
+
+class FastLexer(antlr3.TokenSource):
+    """
+    Token source for :class:`antlr3.CommonTokenStream` that can be used
+    instead of the generated lexer.
+
+    The entire input is tokenized by the constructor, which raises
+    :exc:`LexerError` if it fails.
+    """
+    def __init__(self, code, filename=None):
+        self.filename = filename
+        self.tokens = self._tokenize(unicode(code))
+        self.tokens.reverse()
+
+    def _tokenize(self, code):
+        tokens = []
+        match = _TOKEN_RE.match
+        line = 1
+        column = 0
+        pos = 0
+        end = len(code)
+        while pos < end:
+            m = match(code, pos)
+            if m is None:
+                raise LexerError(self._describe(code, pos, line, column))
+            kind = m.lastgroup
+            text = m.group()
+            if kind == "TEXT" or kind == "OPERATOR":
+                type = _FIXED_TYPES.get(text, _tokens.TEXT)
+            elif kind == "BAD_COMMENT":
+                raise LexerError(self._describe(code, pos, line, column))
+            else:
+                type = _SIMPLE_TYPES[kind]
+
+            t = CommonToken(type=type,
+                            channel=HIDDEN_CHANNEL if kind in _HIDDEN else DEFAULT_CHANNEL,
+                            text=text,
+                            start=pos,
+                            stop=m.end() - 1)
+            t.line = line
+            t.charPositionInLine = column
+            tokens.append(t)
+
+            pos = m.end()
+            newlines = text.count("\n")
+            if newlines:
+                line += newlines
+                column = len(text) - text.rfind("\n") - 1
+            else:
+                column += len(text)
+
+        self._eof_index = pos
+        self._eof_line = line
+        self._eof_column = column
+        return tokens
+
+    def _describe(self, code, pos, line, column):
+        return "%s:%d:%d: can't tokenize input at %r" % (self.filename, line, column, code[pos:pos+10])
+
+    def nextToken(self):
+        if self.tokens:
+            return self.tokens.pop()
+        return self.makeEOFToken()
+
+    def makeEOFToken(self):
+        eof = CommonToken(type=EOF, channel=DEFAULT_CHANNEL, text="<EOF>",
+                          start=self._eof_index, stop=self._eof_index)
+        eof.line = self._eof_line
+        eof.charPositionInLine = self._eof_column
+        return eof
+
+    def getSourceName(self):
+        return self.filename
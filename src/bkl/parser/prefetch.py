@@ -0,0 +1,195 @@
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Parallel parsing of all files of a project.
+
+Submodules and imports are normally parsed one by one, as the
+:class:`bkl.interpreter.builder.Builder` encounters them. :func:`prefetch`
+instead finds all files a project consists of up front, using a cheap token
+scan of ``submodule``, ``import`` and ``plugin`` statements, and parses them
+in a pool of worker processes. The resulting ASTs are then used by
+:func:`bkl.parser.parse_file` when the builder asks for them, so the order in
+which files are processed (and warnings reported) doesn't change.
+
+Prefetching is only an optimization: files that can't be scanned or parsed
+are simply left alone and handled (and errors reported) as usual later.
+"""
+
+import os.path
+import re
+import hashlib
+import logging
+
+import ast
+import cache
+import fastlexer
+from BakefileParser import TEXT, SINGLE_QUOTED_TEXT, DOUBLE_QUOTED_TEXT
+
+logger = logging.getLogger("bkl.parser.prefetch")
+
+# Parsed files not used by parse_file() yet, as filename -> (content hash,
+# serialized tree, warnings)
+_prefetched = {}
+
+_STATEMENTS = set(["submodule", "import", "plugin"])
+_ESCAPE_RE = re.compile(r"\\(.)", re.S)
+
+
+def _literal_value(token):
+    """Returns value of literal token or None if it isn't a simple one."""
+    if token.type == TEXT:
+        return token.text
+    if token.type == SINGLE_QUOTED_TEXT or token.type == DOUBLE_QUOTED_TEXT:
+        text = token.text[1:-1]
+        if token.type == DOUBLE_QUOTED_TEXT and "$" in text:
+            return None
+        return _ESCAPE_RE.sub(r"\1", text)
+    return None
+
+
+def scan_dependencies(filename, code):
+    """
+    Finds ``submodule``, ``import`` and ``plugin`` statements in *code* of
+    *filename* without parsing it. Returns list of ``(kind, path)`` tuples,
+    where *kind* is the statement keyword and *path* is the referenced file,
+    relative to the current directory in the same way the builder computes
+    it.
+
+    The scan is approximate: it may find statements that the builder won't
+    use (e.g. conditional ones) and it doesn't find statements with file names
+    that aren't simple literals.
+    """
+    try:
+        lexer = fastlexer.FastLexer(code, filename)
+    except (fastlexer.LexerError, UnicodeError):
+        return []
+    tokens = [t for t in reversed(lexer.tokens) if t.channel == fastlexer.DEFAULT_CHANNEL]
+
+    deps = []
+    dirname = os.path.dirname(filename)
+    for i in xrange(len(tokens) - 2):
+        keyword = tokens[i].text
+        if keyword in _STATEMENTS and tokens[i+2].text == ";":
+            value = _literal_value(tokens[i+1])
+            if value is None:
+                continue
+            if keyword == "plugin":
+                path = os.path.join(dirname, value)
+            else:
+                path = os.path.relpath(os.path.join(dirname, value))
+            deps.append((str(keyword), path))
+    return deps
+
+
+def _read(filename):
+    try:
+        with file(filename, "rt") as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def find_files(filename):
+    """
+    Returns the graph of files used by *filename*, as list of ``(filename,
+    dependencies)`` tuples in the order of discovery, where *dependencies* is
+    the list returned by :func:`scan_dependencies`.
+    """
+    graph = []
+    seen = set([filename])
+    queue = [filename]
+    while queue:
+        fn = queue.pop(0)
+        code = _read(fn)
+        deps = scan_dependencies(fn, code) if code is not None else []
+        graph.append((fn, deps))
+        for kind, dep in deps:
+            if kind != "plugin" and dep not in seen:
+                seen.add(dep)
+                queue.append(dep)
+    return graph
+
+
+def _parse_worker(filename):
+    """Parses *filename* in a worker process."""
+    from bkl.parser import parse
+    code = _read(filename)
+    if code is None:
+        return (filename, None, None, None)
+    try:
+        with cache.WarningsRecorder() as w:
+            tree = parse(code, filename)
+    except Exception:
+        # errors are reported when the file is parsed again by parse_file()
+        return (filename, None, None, None)
+    return (filename, hashlib.sha1(code).hexdigest(), ast.serialize_tree(tree), w.warnings)
+
+
+def prefetch(filename, jobs):
+    """
+    Finds all files used by *filename* and parses them using *jobs* worker
+    processes. Files that are already in the persistent cache
+    (:mod:`bkl.parser.cache`) or kept in memory by
+    :func:`bkl.parser.parse_file` are skipped.
+    """
+    from bkl.parser import _parse_file
+    files = []
+    for fn, deps in find_files(filename):
+        if (fn,) in _parse_file.cache:
+            continue
+        if cache.cache_dir is not None:
+            code = _read(fn)
+            if code is not None and cache.contains(fn, code):
+                continue
+        files.append(fn)
+    if len(files) < 2 or jobs < 2:
+        return
+
+    logger.debug("parsing %d files in %d processes", len(files), jobs)
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(files)))
+    try:
+        for fn, content_hash, tree, warnings in pool.imap(_parse_worker, files):
+            if tree is not None:
+                _prefetched[fn] = (content_hash, tree, warnings)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def take(filename, code):
+    """
+    Returns prefetched serialized tree and warnings for *filename* with
+    content *code* as a tuple, or :const:`None` if not available. The entry is
+    removed, it is only used once.
+    """
+    try:
+        content_hash, tree, warnings = _prefetched.pop(filename)
+    except KeyError:
+        return None
+    if content_hash != hashlib.sha1(code).hexdigest():
+        return None
+    return (tree, warnings)
@@ -26,6 +26,9 @@ import sys
 import logging
 __logger = logging.getLogger("bkl.plugins")
 
+# absolute paths of plugins loaded by load_from_file(), in the order of loading
+_loaded_files = []
+
 
 def load_from_file(filename):
     """
@@ -34,6 +37,11 @@ def load_from_file(filename):
     import os.path
     import imp
     from bkl.error import Error
+    import bkl.manifest
+    bkl.manifest.add_input(filename)
+    path = os.path.abspath(filename)
+    if path not in _loaded_files:
+        _loaded_files.append(path)
     basename = os.path.splitext(os.path.basename(filename))[0]
     if basename.startswith("bkl.plugins."):
         modname = basename
@@ -41,8 +49,8 @@ def load_from_file(filename):
         modname = "bkl.plugins.%s" % basename.replace(".", "_")
 
     if modname in sys.modules:
-        prev_file = sys.modules[modname].__file__
-        if filename == prev_file or filename == prev_file[:-1]: #.pyc->.py
+        prev_file = os.path.abspath(sys.modules[modname].__file__)
+        if path == prev_file or path == prev_file[:-1]: #.pyc->.py
             # plugin already loaded from this file, skip it
             __logger.debug("plugin %s from %s is already loaded, nothing to do", modname, filename)
             return
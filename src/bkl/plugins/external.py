@@ -31,6 +31,7 @@ from bkl.vartypes import PathType
 from bkl.error import Error, error_context
 from bkl.plugins.vsbase import VSProjectBase, PROJECT_KIND_NET
 from bkl.utils import memoized_property, filter_duplicates
+import bkl.manifest
 
 import xml.etree.ElementTree
 import re
@@ -100,7 +101,9 @@ class VSExternalProjectBase(VSProjectBase):
         self.projectfile = target["file"]
         self.dependencies = []
         self.source_pos = target.source_pos
-        xmldoc = xml.etree.ElementTree.parse(self.projectfile.as_native_path_for_output(target))
+        filename = self.projectfile.as_native_path_for_output(target)
+        bkl.manifest.add_input(filename)
+        xmldoc = xml.etree.ElementTree.parse(filename)
         self.xml = xmldoc.getroot()
 
     @memoized_property
@@ -965,7 +965,7 @@ class VSToolsetBase(Toolset):
                 p = self.ARCHS_MAPPING[arch]
                 cfg.vs_platform = p
                 cfg.vs_name = "%s|%s" % (cfg.name, p)
-                cfg._visitor.mapping["arch"] = arch
+                cfg.arch = arch
                 yield cfg
 
 # Internal helper functions:
@@ -317,6 +317,8 @@ class PropertiesRegistry(object):
     Registry of existing properties.
     """
     def __init__(self):
+        #: Incremented whenever the set of known properties may change.
+        self.generation = 0
         self._init_vars()
 
     def _init_vars(self):
@@ -451,6 +453,7 @@ class PropertiesRegistry(object):
 
     def force_rescan(self):
         """Force re-scanning of properties"""
+        self.generation += 1
         self._init_vars()
 
 
@@ -64,7 +64,7 @@ class OrderedDict(dict):
 
     def __copy__(self):
         c = OrderedDict()
-        c.update(self.iteritems())
+        dict.update(c, self)
         c.order = self.order[:]
         return c
 
@@ -168,6 +168,14 @@ class memoized(object):
             # Better to not cache than to blow up entirely.
             return self.func(*args)
 
+    def forget(self, *args):
+        """Removes the value cached for given arguments, if any."""
+        self.cache.pop(args, None)
+
+    def clear(self):
+        """Removes all cached values."""
+        self.cache.clear()
+
     def __repr__(self):
         """Return the function's docstring."""
         return self.func.__doc__
@@ -177,6 +185,48 @@ class memoized(object):
         return functools.partial(self.__call__, obj)
 
 
+def memoized_bounded(maxsize):
+    """
+    Decorator similar to :class:`memoized`, but only the *maxsize* most
+    recently used values are kept in the cache. Use as
+    ``@memoized_bounded(100)``.
+    """
+    return lambda func: _BoundedMemoized(func, maxsize)
+
+
+class _BoundedMemoized(memoized):
+    def __init__(self, func, maxsize):
+        memoized.__init__(self, func)
+        self.maxsize = maxsize
+        self.order = []
+
+    def __call__(self, *args):
+        try:
+            value = self.cache[args]
+        except KeyError:
+            value = self.func(*args)
+            self.cache[args] = value
+            self.order.append(args)
+            if len(self.order) > self.maxsize:
+                del self.cache[self.order.pop(0)]
+            return value
+        except TypeError:
+            return self.func(*args)
+        # move to the end of the list of recently used values:
+        self.order.remove(args)
+        self.order.append(args)
+        return value
+
+    def forget(self, *args):
+        if args in self.cache:
+            del self.cache[args]
+            self.order.remove(args)
+
+    def clear(self):
+        self.cache.clear()
+        del self.order[:]
+
+
 class memoized_property(object):
     """
     Decorator for lazily evaluated properties.
@@ -342,9 +342,11 @@ class _BoolNormalizer(expr.Visitor):
         self._bool_type.validate(e.cond)
 
 
+_bool_normalizer = _BoolNormalizer()
+
 def normalize_and_validate_bool_subexpressions(e):
     """
     Performs type normalization and validation steps for typed subexpressions,
     namely for IfExpr conditions and boolean expressions.
     """
-    _BoolNormalizer().visit(e)
+    _bool_normalizer.visit(e)
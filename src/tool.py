@@ -27,6 +27,7 @@ import sys
 import logging
 from optparse import OptionParser, OptionGroup
 from time import time
+from itertools import izip
 
 # This is needed to initialize colored output on Windows. It must be done
 # before any stdout is done.
@@ -80,7 +81,39 @@ class BklOptionParser(OptionParser):
         import bkl.version
         return "bakefile %s" % bkl.version.get_version()
 
-parser = BklOptionParser(version="bakefile")
+
+def run_client(socket_path, argv):
+    """
+    Sends request to process command line arguments *argv* to the daemon
+    listening on *socket_path* (see bkl.daemon) and shows its output. Returns
+    exit code.
+    """
+    import os
+    import json
+    import socket
+    s = socket.socket(socket.AF_UNIX)
+    try:
+        s.connect(socket_path)
+    except socket.error as e:
+        sys.stderr.write("cannot connect to bakefile daemon at %s: %s\n" % (socket_path, e))
+        return 1
+    f = s.makefile("r+b")
+    f.write(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+    f.flush()
+    while True:
+        line = f.readline()
+        if not line:
+            sys.stderr.write("bakefile daemon at %s stopped unexpectedly\n" % socket_path)
+            return 1
+        kind, data = json.loads(line)
+        if kind == "exit":
+            return data
+        stream = sys.stdout if kind == "stdout" else sys.stderr
+        stream.write(data.encode("utf-8"))
+        stream.flush()
+
+
+parser = BklOptionParser(usage="%prog [options] file.bkl...", version="bakefile")
 parser.add_option(
         "-v", "--verbose",
         action="store_true", dest="verbose", default=False,
@@ -102,6 +135,51 @@ parser.add_option(
         action="append", dest="toolsets",
         metavar="TOOLSET",
         help="only generate files for the given toolset (may be specified more than once)")
+parser.add_option(
+        "-j", "--jobs",
+        action="store", type="int", dest="jobs", default=1,
+        metavar="N",
+        help="use N processes to speed up processing (default: 1)")
+parser.add_option(
+        "", "--cache-dir",
+        action="store", dest="cache_dir", default=None,
+        metavar="DIR",
+        help="directory to cache parsed input files and finalized models in (default: per-user cache directory)")
+parser.add_option(
+        "", "--no-cache",
+        action="store_false", dest="use_cache", default=True,
+        help="don't use cache of parsed input files and always process the input, even if it didn't change")
+parser.add_option(
+        "", "--low-memory",
+        action="store_true", dest="streaming", default=False,
+        help="process input files as they are parsed instead of parsing them first, to reduce memory usage")
+parser.add_option(
+        "", "--early-specialization",
+        action="store_true", dest="early_specialization", default=False,
+        help="with --toolset, skip content for other toolsets as soon as possible; faster, but errors in it are not reported")
+parser.add_option(
+        "", "--intern-expressions",
+        action="store_true", dest="intern_expressions", default=False,
+        help="share identical expressions in the model to reduce memory usage; errors may be reported at another occurrence of the expression")
+parser.add_option(
+        "", "--input-list",
+        action="store", dest="input_list", default=None,
+        metavar="FILE",
+        help="process .bkl files listed in FILE, one per line, in addition to the ones given as arguments")
+parser.add_option(
+        "", "--daemon",
+        action="store", dest="daemon", default=None,
+        metavar="SOCKET",
+        help="keep running, listening for requests on Unix socket SOCKET and regenerating the project when its files change")
+parser.add_option(
+        "", "--connect",
+        action="store", dest="connect", default=None,
+        metavar="SOCKET",
+        help="let the daemon listening on SOCKET do the work (see --daemon)")
+parser.add_option(
+        "", "--skip-diagnostics",
+        action="store_true", dest="skip_diagnostics", default=False,
+        help="don't run passes that only check the project for potential problems and warn about them")
 
 debug_group = OptionGroup(parser, "Debug Options")
 debug_group.add_option(
@@ -117,64 +195,238 @@ debug_group.add_option(
         action="store", dest="dump_toolset", default=False,
         metavar="TOOLSET",
         help="like --dump-model, but with toolset-optimized model")
+debug_group.add_option(
+        "", "--antlr-lexer",
+        action="store_false", dest="fast_lexer", default=True,
+        help="always use ANTLR-generated lexer instead of the faster one")
+debug_group.add_option(
+        "", "--time-passes",
+        action="store_true", dest="time_passes", default=False,
+        help="show time spent in individual processing passes")
+debug_group.add_option(
+        "", "--resolution-stats",
+        action="store_true", dest="resolution_stats", default=False,
+        help="show hit rate of the cache of variables resolution")
+debug_group.add_option(
+        "", "--fused-passes",
+        action="store_true", dest="fused_passes", default=False,
+        help="process all variables in a single pass instead of several ones")
+debug_group.add_option(
+        "", "--verify-cache",
+        action="store_true", dest="verify_cache", default=False,
+        help="always build the model from scratch and check that its cached snapshot is the same")
 parser.add_option_group(debug_group)
 
 options, args = parser.parse_args(sys.argv[1:])
 
-if len(args) != 1:
-    sys.stderr.write("incorrect number of arguments, exactly 1 .bkl required\n")
-    sys.exit(3)
-
-if options.debug:
-    log_level = logging.DEBUG
-elif options.verbose:
-    log_level = logging.INFO
-else:
-    log_level = logging.WARNING
-logger.setLevel(log_level)
-
-if options.diff_only and options.force:
-    sys.stderr.write("--diff-only and --force option can't be used together\n")
-    sys.exit(3)
+if options.connect:
+    # the client doesn't need to load Bakefile at all
+    sys.exit(run_client(options.connect, sys.argv[1:]))
 
 # note: we intentionally import bakefile this late so that the logging
 # module is already initialized
 import bkl.error
+import bkl.interpreter
+import bkl.interpreter.parallel
 from bkl.interpreter import Interpreter
+from bkl.interpreter.passes import standard_passes
+from bkl.interpreter.passmanager import PassManager
 import bkl.dumper
 import bkl.io
+import bkl.model
+import bkl.manifest
+import bkl.parser.cache
+
+
+def set_log_level(options):
+    if options.debug:
+        log_level = logging.DEBUG
+    elif options.verbose:
+        log_level = logging.INFO
+    else:
+        log_level = logging.WARNING
+    logger.setLevel(log_level)
+
+
+def read_input_list(filename):
+    """
+    Returns names of files listed in *filename*, ignoring empty lines and
+    comments. Relative names are relative to the list's directory.
+    """
+    import os.path
+    files = []
+    dirname = os.path.dirname(filename)
+    with open(filename, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                files.append(os.path.join(dirname, line))
+    return files
+
+
+def run(options, args, in_daemon=False):
+    """
+    Processes the projects as given by command line *options* and *args*.
+    Returns exit code.
+    """
+    files = list(args)
+    if options.input_list:
+        try:
+            files += read_input_list(options.input_list)
+        except IOError as e:
+            sys.stderr.write("cannot read list of input files: %s\n" % e)
+            return 3
+    if not files:
+        sys.stderr.write("incorrect number of arguments, at least 1 .bkl required\n")
+        return 3
+
+    set_log_level(options)
+
+    if options.diff_only and options.force:
+        sys.stderr.write("--diff-only and --force option can't be used together\n")
+        return 3
 
-try:
-    start_time = time()
     bkl.io.dry_run = options.dry_run
     bkl.io.diff_only = options.diff_only
     bkl.io.force_output = options.force
-    if options.dump:
-        intr = bkl.dumper.DumpingInterpreter()
-    elif options.dump_toolset:
-        intr = bkl.dumper.DumpingInterpreter(options.dump_toolset)
+    bkl.parser.use_fast_lexer = options.fast_lexer
+    if options.use_cache:
+        bkl.parser.cache.cache_dir = (options.cache_dir or
+                                      bkl.parser.cache.get_default_cache_dir())
     else:
-        intr = Interpreter()
-    if options.toolsets:
-        intr.limit_toolsets(options.toolsets)
-    intr.process_file(args[0])
-    logger.info("created files: %d, updated files: %d (time: %.1fs)",
-                bkl.io.num_created, bkl.io.num_modified, time() - start_time)
-
-except KeyboardInterrupt:
-    if options.debug:
-        raise
-    else:
-        sys.exit(2)
-except IOError as e:
-    if options.debug:
-        raise
+        bkl.parser.cache.cache_dir = None
+
+    if len(files) == 1:
+        return process_project(options, files[0], in_daemon)
     else:
-        logging.error(e)
-        sys.exit(1)
-except bkl.error.Error as e:
-    if options.debug:
-        raise
+        return process_batch(options, files, in_daemon)
+
+
+def process_batch(options, files, in_daemon):
+    """
+    Processes several independent projects, in parallel if more jobs are
+    allowed by *options*. Returns exit code.
+    """
+    # files imported by several projects are parsed only once:
+    bkl.parser.keep_parsed_files = True
+
+    if options.jobs > 1 and bkl.interpreter.parallel.is_available():
+        # the projects themselves are processed in parallel, not their toolsets:
+        results = bkl.interpreter.parallel.map_in_workers(
+                        lambda filename: process_project(options, filename, in_daemon, jobs=1),
+                        files, options.jobs)
     else:
+        def process_serially():
+            for filename in files:
+                bkl.interpreter.reset_state()
+                yield process_project(options, filename, in_daemon)
+        results = process_serially()
+
+    failed = []
+    for filename, code in izip(files, results):
+        if code == 2:
+            # interrupted
+            return code
+        if code != 0:
+            failed.append(filename)
+    if failed:
+        logging.error("processing of %d of %d projects failed: %s",
+                      len(failed), len(files), ", ".join(failed))
+        return 1
+    return 0
+
+
+def process_project(options, filename, in_daemon, jobs=None):
+    """
+    Processes single project *filename* as given by command line *options*.
+    Returns exit code.
+    """
+    try:
+        start_time = time()
+        if options.dump:
+            intr = bkl.dumper.DumpingInterpreter()
+        elif options.dump_toolset:
+            intr = bkl.dumper.DumpingInterpreter(options.dump_toolset)
+        else:
+            intr = Interpreter()
+        if options.toolsets:
+            intr.limit_toolsets(options.toolsets)
+        intr.jobs = jobs or options.jobs
+        intr.streaming = options.streaming
+        intr.early_specialization = options.early_specialization
+        intr.intern_expressions = options.intern_expressions
+        if options.fused_passes:
+            intr.pass_manager = PassManager(standard_passes(fused=True))
+        intr.pass_manager.time_passes = options.time_passes
+        intr.pass_manager.skip_diagnostics = options.skip_diagnostics
+        intr.snapshot_dir = bkl.parser.cache.cache_dir
+        intr.verify_snapshot = options.verify_cache
+
+        # skip processing entirely if neither the inputs nor the outputs changed
+        # since the last time (and there's no point in doing that if no outputs
+        # are written); the daemon does its own checking for changes:
+        manifest_dir = None
+        if options.use_cache and not (options.dry_run or options.diff_only or
+                                      options.dump or options.dump_toolset or
+                                      in_daemon):
+            manifest_dir = bkl.parser.cache.cache_dir
+        manifest_options = {"toolsets": sorted(options.toolsets) if options.toolsets else None,
+                            "skip_diagnostics": options.skip_diagnostics}
+        if (manifest_dir and not options.force and
+                bkl.manifest.is_up_to_date(manifest_dir, filename, manifest_options)):
+            logger.info("no changes in %s since the last run, nothing to do", filename)
+        else:
+            bkl.model.resolution_stats.reset()
+            try:
+                intr.process_file(filename)
+            except:
+                if manifest_dir:
+                    bkl.manifest.remove(manifest_dir, filename)
+                raise
+            if manifest_dir:
+                bkl.manifest.save(manifest_dir, filename, manifest_options)
+            if options.time_passes:
+                sys.stderr.write(intr.pass_manager.format_stats() + "\n")
+            if options.resolution_stats:
+                sys.stderr.write(bkl.model.resolution_stats.format() + "\n")
+        logger.info("%s: created files: %d, updated files: %d (time: %.1fs)",
+                    filename, bkl.io.num_created, bkl.io.num_modified, time() - start_time)
+
+    except KeyboardInterrupt:
+        if options.debug or in_daemon:
+            raise
+        else:
+            return 2
+    except IOError as e:
+        if options.debug:
+            raise
+        else:
+            logging.error(e)
+            return 1
+    except bkl.error.Error as e:
+        if options.debug:
+            raise
+        else:
+            logging.error(e.msg, extra={"pos":e.pos})
+            return 1
+    return 0
+
+
+if options.daemon:
+    import bkl.daemon
+    if not bkl.daemon.is_available():
+        sys.stderr.write("--daemon is not supported on this platform\n")
+        sys.exit(3)
+    set_log_level(options)
+    def handle_request(argv):
+        options, args = parser.parse_args(argv)
+        return run(options, args, in_daemon=True)
+    try:
+        bkl.daemon.Daemon(options.daemon, handle_request, sys.argv[1:]).serve()
+    except KeyboardInterrupt:
+        sys.exit(2)
+    except bkl.error.Error as e:
         logging.error(e.msg, extra={"pos":e.pos})
         sys.exit(1)
+else:
+    sys.exit(run(options, args))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Benchmark comparing making toolset-specific models for all toolsets
+separately with making them from models shared by toolset families (see
+Interpreter.share_toolset_families).
+
+Usage: bench_families.py [number of targets [number of repetitions]]
+"""
+
+import gc
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+import bkl.api
+import bkl.parser
+import bkl.dumper
+from bkl.interpreter import Interpreter, _group_by_family
+
+
+def make_project(dirname, count):
+    filename = os.path.join(dirname, "bench.bkl")
+    with open(filename, "wt") as f:
+        f.write("toolsets = %s;\n" % " ".join(sorted(bkl.api.Toolset.all_names())))
+        f.write("common_defines = BENCH;\n")
+        for i in xrange(count):
+            f.write("""
+library lib%(i)d {
+    defines = "NUM=%(i)d" $(common_defines);
+    includedirs = include/lib%(i)d ../shared;
+    sources { src/lib%(i)d/a.cpp src/lib%(i)d/b.cpp src/c.cpp }
+    headers { src/lib%(i)d/a.h }
+    if ($(toolset) == gnu) cxxflags = -O2 -Wall;
+}
+""" % {"i": i})
+    return filename
+
+
+def run(filename, share):
+    intr = Interpreter()
+    intr.pass_manager.skip_diagnostics = True
+    intr.add_module(bkl.parser.parse_file(filename), intr.model)
+    intr.finalize()
+    toolsets = sorted(bkl.api.Toolset.all_names())
+    if share:
+        families = _group_by_family(toolsets)
+    else:
+        families = [[t] for t in toolsets]
+    gc.collect()
+    dumps = {}
+    total = 0.0
+    for family in families:
+        for toolset in family:
+            last = toolset == family[-1] and (share or family is families[-1])
+            start = time()
+            model = intr.prepare_toolset_model(toolset, skip_making_copy=last,
+                                               family=family if share else None)
+            total += time() - start
+            dumps[toolset] = bkl.dumper.dump_project(model)
+    return total, dumps
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = make_project(dirname, count)
+        separate_time = shared_time = float("inf")
+        for i in xrange(repeat):
+            t, separate_dumps = run(filename, share=False)
+            separate_time = min(separate_time, t)
+            t, shared_dumps = run(filename, share=True)
+            shared_time = min(shared_time, t)
+    finally:
+        shutil.rmtree(dirname)
+
+    print "targets:          %d" % count
+    print "toolsets:         %d" % len(separate_dumps)
+    print "best of:          %d" % repeat
+    print "separate models:  %.3fs" % separate_time
+    print "family models:    %.3fs" % shared_time
+    print "identical models: %s" % (separate_dumps == shared_dumps)
+
+
+if __name__ == "__main__":
+    main()
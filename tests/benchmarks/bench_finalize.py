@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Benchmark comparing the separate variables processing passes run by
+Interpreter.finalize() with the fused process_variables() pass.
+
+Usage: bench_finalize.py [number of targets [number of repetitions]]
+"""
+
+import gc
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+import bkl.parser
+import bkl.dumper
+from bkl.interpreter import Interpreter
+from bkl.interpreter.passes import standard_passes
+from bkl.interpreter.passmanager import PassManager
+
+
+def make_project(dirname, count):
+    filename = os.path.join(dirname, "bench.bkl")
+    with open(filename, "wt") as f:
+        f.write("toolsets = gnu;\n")
+        f.write("common_defines = BENCH;\n")
+        f.write("opt_flags = -O2;\n")
+        for i in xrange(count):
+            f.write("""
+library lib%(i)d {
+    defines = "NUM=%(i)d" $(common_defines);
+    includedirs = include/lib%(i)d ../shared;
+    sources { src/lib%(i)d/a.cpp src/lib%(i)d/b.cpp src/c.cpp }
+    headers { src/lib%(i)d/a.h }
+    if ($(toolset) == gnu) cxxflags = $(opt_flags) -Wall;
+}
+""" % {"i": i})
+    return filename
+
+
+def run(filename, fused):
+    intr = Interpreter()
+    intr.pass_manager = PassManager(standard_passes(fused=fused))
+    intr.pass_manager.skip_diagnostics = True
+    intr.add_module(bkl.parser.parse_file(filename), intr.model)
+    gc.collect()
+    start = time()
+    intr.finalize()
+    return time() - start, bkl.dumper.dump_project(intr.model)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = make_project(dirname, count)
+        # warm up caches of property definitions etc.
+        run(filename, fused=False)
+        separate_time = fused_time = float("inf")
+        for i in xrange(repeat):
+            t, separate_dump = run(filename, fused=False)
+            separate_time = min(separate_time, t)
+            t, fused_dump = run(filename, fused=True)
+            fused_time = min(fused_time, t)
+    finally:
+        shutil.rmtree(dirname)
+
+    print "targets:          %d" % count
+    print "best of:          %d" % repeat
+    print "separate passes:  %.3fs" % separate_time
+    print "fused pass:       %.3fs" % fused_time
+    print "identical models: %s" % (separate_dump == fused_dump)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Benchmark reporting memory used by the model of a big project: peak RSS of
+the process, its RSS with the finalized models in memory and the number of
+model objects (expressions, variables and source positions) kept in memory.
+
+Usage: bench_memory.py [--intern] [--sources N] [number of targets]
+
+With --intern, the model is built with Interpreter.intern_expressions. With
+--sources, each target has N more source files.
+"""
+
+import gc
+import os
+import sys
+import shutil
+import resource
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+import bkl.expr
+import bkl.model
+import bkl.parser
+import bkl.parser.ast
+from bkl.interpreter import Interpreter
+
+
+def make_project(dirname, count, sources):
+    filename = os.path.join(dirname, "bench.bkl")
+    with open(filename, "wt") as f:
+        f.write("toolsets = gnu vs2010;\n")
+        f.write("common_defines = BENCH;\n")
+        for i in xrange(count):
+            f.write("""
+library lib%(i)d {
+    defines = "NUM=%(i)d" $(common_defines);
+    includedirs = include/lib%(i)d ../shared;
+    sources { src/lib%(i)d/a.cpp src/lib%(i)d/b.cpp src/lib%(i)d/c.cpp src/d.cpp }
+    headers { src/lib%(i)d/a.h src/lib%(i)d/b.h }
+    if ($(toolset) == gnu) cxxflags = -O2 -Wall;
+    if ($(config) == Debug) defines += DEBUG_LIB%(i)d;
+""" % {"i": i})
+            if sources:
+                f.write("    sources {\n")
+                for n in xrange(sources):
+                    f.write("        src/lib%d/dir%d/file%d.cpp\n" % (i, n % 50, n))
+                f.write("    }\n")
+            f.write("}\n")
+    return filename
+
+
+def count_objects():
+    classes = (bkl.expr.Expr, bkl.model.Variable, bkl.parser.ast.Position)
+    counts = Counter()
+    for o in gc.get_objects():
+        if isinstance(o, classes):
+            for cls in classes:
+                if isinstance(o, cls):
+                    counts[cls.__name__] += 1
+        elif type(o) is dict:
+            counts["dict"] += 1
+    return counts
+
+
+def current_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return float("nan")
+
+
+def main():
+    args = sys.argv[1:]
+    intern = "--intern" in args
+    if intern:
+        args.remove("--intern")
+    sources = 0
+    if "--sources" in args:
+        i = args.index("--sources")
+        sources = int(args[i + 1])
+        del args[i:i + 2]
+    count = int(args[0]) if args else 2000
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = make_project(dirname, count, sources)
+        intr = Interpreter()
+        intr.pass_manager.skip_diagnostics = True
+        intr.intern_expressions = intern
+        intr.add_module(bkl.parser.parse_file(filename), intr.model)
+        intr.finalize()
+        model = intr.prepare_toolset_model("gnu")
+    finally:
+        shutil.rmtree(dirname)
+    gc.collect()
+    counts = count_objects()
+
+    print "targets:          %d" % count
+    print "interned:         %s" % intern
+    print "extra sources:    %d" % sources
+    print "peak RSS:         %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    print "final RSS:        %.1f MB" % current_rss()
+    for name in ("Expr", "Variable", "Position", "dict"):
+        print "%-17s %d" % (name + " objects:", counts[name])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+#  This file is part of Bakefile (http://bakefile.org)
+#
+#  Copyright (C) 2008-2013 Vaclav Slavik
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+#  IN THE SOFTWARE.
+#
+
+"""
+Benchmark measuring how long it takes to build the model of a project with
+many targets using a few heavy templates and configurations derived from
+each other, whose definitions are applied to each target.
+
+Usage: bench_templates.py [number of targets [number of repetitions]]
+"""
+
+import gc
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+import bkl.expr
+import bkl.parser
+import bkl.dumper
+from bkl.interpreter import Interpreter
+
+TEMPLATES = 4
+# number of statements of each kind in a template
+TEMPLATE_SIZE = 10
+CONFIGURATIONS = 6
+
+
+def make_project(dirname, count):
+    filename = os.path.join(dirname, "bench.bkl")
+    with open(filename, "wt") as f:
+        f.write("toolsets = gnu vs2010;\n")
+        f.write("common_defines = BENCH;\n")
+        base = "Debug"
+        for c in xrange(CONFIGURATIONS):
+            f.write("""
+configuration Cfg%(c)d : %(base)s {
+    defines += CFG%(c)d;
+    if ($(toolset) == gnu) defines += CFG_GNU%(c)d;
+}
+""" % {"c": c, "base": base})
+            base = "Cfg%d" % c
+        for t in xrange(TEMPLATES):
+            f.write("template tmpl%d {\n" % t)
+            for n in xrange(TEMPLATE_SIZE):
+                f.write('    defines += "T%(t)d_%(n)d=$(id)" $(common_defines);\n' % {"t": t, "n": n})
+                f.write("    includedirs += include/t%(t)d/n%(n)d ../shared/$(id);\n" % {"t": t, "n": n})
+                f.write("    if ($(toolset) == gnu && $(config) == Debug) cxx-compiler-options += -g%(n)d -O0;\n" % {"n": n})
+                f.write("    if ($(config) == Release) { defines += NDEBUG%(n)d; libs += m%(n)d z; }\n" % {"n": n})
+            f.write("    sources { src/common%d.cpp }\n" % t)
+            f.write("}\n")
+        for i in xrange(count):
+            f.write("""
+library lib%(i)d : tmpl%(a)d, tmpl%(b)d {
+    sources { src/lib%(i)d/a.cpp }
+}
+""" % {"i": i, "a": i % TEMPLATES, "b": (i + 1) % TEMPLATES})
+    return filename
+
+
+def run(filename):
+    ast = bkl.parser.parse_file(filename)
+    intr = Interpreter()
+    gc.collect()
+    start = time()
+    intr.add_module(ast, intr.model)
+    elapsed = time() - start
+    return elapsed, intr.model
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = make_project(dirname, count)
+        best = float("inf")
+        for i in xrange(repeat):
+            t, model = run(filename)
+            best = min(best, t)
+    finally:
+        shutil.rmtree(dirname)
+
+    gc.collect()
+    exprs = sum(1 for o in gc.get_objects() if isinstance(o, bkl.expr.Expr))
+    dump = bkl.dumper.dump_project(model)
+    print "targets:          %d" % count
+    print "best of:          %d" % repeat
+    print "building model:   %.3fs" % best
+    print "Expr objects:     %d" % exprs
+    print "model dump hash:  %s" % hash(dump)
+
+
+if __name__ == "__main__":
+    main()
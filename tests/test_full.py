@@ -25,8 +25,10 @@
 import os, os.path
 from glob import glob
 
-import bkl.parser, bkl.interpreter, bkl.error
+import bkl.parser, bkl.interpreter, bkl.error, bkl.io
 import bkl.dumper
+from bkl.interpreter.passes import standard_passes
+from bkl.interpreter.passmanager import PassManager
 
 
 def test_full():
@@ -44,6 +46,33 @@ def test_full():
         yield _test_on_file, d, str(f)
 
 
+def test_full_streaming():
+    """
+    Same as test_full(), but parses the input files in streaming mode, which
+    must produce the same models and errors.
+    """
+    import projects
+    d = os.path.dirname(projects.__file__)
+    for f in glob("%s/*.bkl" % d):
+        yield _test_on_file, d, str(f), True
+    for f in glob("%s/*/*.bkl" % d):
+        yield _test_on_file, d, str(f), True
+
+
+def test_full_fused():
+    """
+    Same as test_full(), but uses the fused process_variables() pass instead
+    of separate variables processing passes, which must produce the same
+    models and errors.
+    """
+    import projects
+    d = os.path.dirname(projects.__file__)
+    for f in glob("%s/*.bkl" % d):
+        yield _test_on_file, d, str(f), False, True
+    for f in glob("%s/*/*.bkl" % d):
+        yield _test_on_file, d, str(f), False, True
+
+
 class InterpreterForTestSuite(bkl.interpreter.Interpreter):
     def generate(self):
         # dump the model first, because generate() further modifies
@@ -53,7 +82,7 @@ class InterpreterForTestSuite(bkl.interpreter.Interpreter):
         super(InterpreterForTestSuite, self).generate()
 
 
-def _test_on_file(testdir, project_file):
+def _test_on_file(testdir, project_file, streaming=False, fused=False):
     assert project_file.startswith(testdir)
 
     model_file = os.path.splitext(project_file)[0] + '.model'
@@ -62,17 +91,29 @@ def _test_on_file(testdir, project_file):
     cwd = os.getcwd()
     os.chdir(testdir)
     try:
-        _do_test_on_file(f, model_file)
+        _do_test_on_file(f, model_file, streaming, fused)
     finally:
         os.chdir(cwd)
 
-def _do_test_on_file(input, model_file):
+def _do_test_on_file(input, model_file, streaming=False, fused=False):
     print 'interpreting %s' % input
 
+    # the same files are generated by both test_full() and
+    # test_full_streaming(), don't report that as a conflict:
+    bkl.io._all_written_files.clear()
+
     try:
-        t = bkl.parser.parse_file(input)
         i = InterpreterForTestSuite()
-        i.process(t)
+        if fused:
+            i.pass_manager = PassManager(standard_passes(fused=True))
+        if streaming:
+            i.streaming = True
+            i.add_module_from_file(input, i.model)
+            i.finalize()
+            i.generate()
+        else:
+            t = bkl.parser.parse_file(input)
+            i.process(t)
         as_text = i.dumped_model
     except bkl.error.Error, e:
         as_text = "ERROR:\n%s" % str(e).replace("\\", "/")
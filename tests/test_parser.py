@@ -98,3 +98,257 @@ def test_parsing_very_old_version():
     d = os.path.dirname(test_parsing.__file__)
     with pytest.raises(bkl.error.VersionError):
         bkl.parser.parse_file(os.path.join(d, "version_very_old.bkl"))
+
+
+def _parse_with_cache(files, cache_dir):
+    bkl.parser.cache.cache_dir = cache_dir
+    try:
+        trees = {}
+        for f in files:
+            try:
+                trees[f] = bkl.parser.parse_file.func(f).toStringTree()
+            except bkl.error.Error, e:
+                trees[f] = None
+        return trees
+    finally:
+        bkl.parser.cache.cache_dir = None
+
+def test_parse_cache(tmpdir, monkeypatch):
+    """
+    Checks that ASTs loaded from the cache are identical to freshly parsed
+    ones and that the parser isn't used at all when they are.
+    """
+    import bkl.parser.cache
+    import test_parsing
+    files = glob("%s/*/*.bkl" % os.path.dirname(test_parsing.__file__))
+    cache_dir = str(tmpdir.join("cache"))
+    expected = _parse_with_cache(files, None)
+    assert _parse_with_cache(files, cache_dir) == expected
+
+    # files with errors are never stored in the cache:
+    files = [f for f in files if expected[f] is not None]
+    assert len(os.listdir(cache_dir)) == len(files)
+
+    def no_parsing(*args, **kwargs):
+        assert False, "file parsed despite being cached"
+    monkeypatch.setattr(bkl.parser, "parse", no_parsing)
+    for f, tree in _parse_with_cache(files, cache_dir).iteritems():
+        assert tree == expected[f]
+
+def test_parse_cache_invalid_entries(tmpdir):
+    import bkl.parser.cache
+    bkl.parser.cache.cache_dir = str(tmpdir.join("cache"))
+    try:
+        src = tmpdir.join("foo.bkl")
+        src.write("foo = bar;\n")
+        bkl.parser.parse_file.func(str(src))
+        entry, = tmpdir.join("cache").listdir()
+
+        # modified input file invalidates the entry:
+        src.write("foo = zar;\n")
+        t = bkl.parser.parse_file.func(str(src))
+        assert 'LiteralNode "zar"' in t.toStringTree()
+
+        # corrupt entries are detected and removed:
+        entry.write("garbage")
+        assert bkl.parser.cache.load(str(src), src.read()) is None
+        assert not entry.check()
+    finally:
+        bkl.parser.cache.cache_dir = None
+
+def test_parse_cache_eviction(tmpdir, monkeypatch):
+    import bkl.parser.cache
+    bkl.parser.cache.cache_dir = str(tmpdir.join("cache"))
+    monkeypatch.setattr(bkl.parser.cache, "max_size", 1000)
+    try:
+        for i in range(20):
+            src = tmpdir.join("file%d.bkl" % i)
+            src.write("foo = bar%d;\n" % i)
+            bkl.parser.parse_file.func(str(src))
+        entries = tmpdir.join("cache").listdir()
+        assert 0 < len(entries) < 20
+        assert sum(e.size() for e in entries) <= 1000
+    finally:
+        bkl.parser.cache.cache_dir = None
+
+
+def _parse_streaming(f):
+    code = file(f).read()
+    statements = []
+    try:
+        bkl.parser.parse_streaming(code, f, statements.append)
+    except bkl.error.Error, e:
+        return str(e)
+    return [n.toStringTree() for n in statements]
+
+def test_parse_streaming(tmpdir):
+    """
+    Checks that statements parsed in streaming mode are the same as the
+    children of the AST, including errors reported.
+    """
+    import test_parsing
+    for f in glob("%s/*/*.bkl" % os.path.dirname(test_parsing.__file__)):
+        try:
+            expected = [n.toStringTree() for n in bkl.parser.parse_file.func(f).children]
+        except bkl.error.Error, e:
+            expected = str(e)
+        assert _parse_streaming(f) == expected
+
+    # syntax errors take precedence over errors in processing the statements:
+    def fail(node):
+        raise bkl.error.Error("processing failed")
+    with pytest.raises(bkl.error.ParserError):
+        bkl.parser.parse_streaming("a = 1;\nb = ;\n", "foo.bkl", fail)
+    with pytest.raises(bkl.error.Error) as e:
+        bkl.parser.parse_streaming("a = 1;\nb = 2;\n", "foo.bkl", fail)
+    assert "processing failed" in str(e.value)
+
+    # streamed files are stored in the cache too:
+    src = tmpdir.join("foo.bkl")
+    src.write("foo = bar;\ntarget = x;\n")
+    bkl.parser.cache.cache_dir = str(tmpdir.join("cache"))
+    try:
+        bkl.parser.parse_file_streaming(str(src), lambda node: None)
+        cached = bkl.parser.cache.load(str(src), src.read())
+    finally:
+        bkl.parser.cache.cache_dir = None
+    assert cached.toStringTree() == bkl.parser.parse_file.func(str(src)).toStringTree()
+
+
+def test_parse_streaming_with_cache(tmpdir, monkeypatch):
+    """
+    Checks that files are streamed when the cache is enabled, unless they
+    are in it.
+    """
+    def no_full_parse(code, filename=None, detect_compatibility_errors=True):
+        assert False, "the whole file shouldn't be parsed"
+    monkeypatch.setattr(bkl.parser, "parse", no_full_parse)
+    bkl.parser.cache.cache_dir = str(tmpdir.join("cache"))
+    try:
+        # statements are handled one by one, even before a later syntax error:
+        src = tmpdir.join("broken.bkl")
+        src.write("a = 1;\nb = 2;\nc = ;\n")
+        statements = []
+        with pytest.raises(bkl.error.ParserError):
+            bkl.parser.parse_file_streaming(str(src), statements.append)
+        assert [n.lvalue.var for n in statements] == ["a", "b"]
+
+        src = tmpdir.join("foo.bkl")
+        src.write("foo = bar;\ntarget = x;\n")
+        for i in range(2):
+            statements = []
+            bkl.parser.parse_file_streaming(str(src), statements.append)
+            assert [n.lvalue.var for n in statements] == ["foo", "target"]
+            # the first run stored the statements in the cache:
+            assert bkl.parser.cache.contains(str(src), src.read())
+    finally:
+        bkl.parser.cache.cache_dir = None
+
+
+def _tokenize(lexer):
+    import antlr3
+    tokens = []
+    while True:
+        t = lexer.nextToken()
+        tokens.append((t.type, t.text, t.line, t.charPositionInLine,
+                       t.channel, t.start, t.stop))
+        if t.type == antlr3.EOF:
+            return tokens
+
+def _check_fast_lexer(code):
+    import antlr3
+    from bkl.parser.fastlexer import FastLexer, LexerError
+    try:
+        fast = _tokenize(FastLexer(code))
+    except LexerError:
+        fast = None
+    try:
+        lexer = bkl.parser._Lexer(antlr3.StringStream(code))
+        lexer.filename = None
+        expected = _tokenize(lexer)
+    except bkl.error.ParserError:
+        expected = None
+    # The fast lexer may refuse input that is valid (the ANTLR lexer is used
+    # then), but it must never produce different tokens:
+    if fast is not None:
+        assert fast == expected
+
+def test_fast_lexer():
+    """
+    Checks that the regex-based lexer produces exactly the same tokens as the
+    ANTLR-generated one for all .bkl files in the test suite.
+    """
+    d = os.path.dirname(os.path.abspath(__file__))
+    for dirpath, dirnames, filenames in os.walk(d):
+        for f in filenames:
+            if f.endswith(".bkl"):
+                yield _check_fast_lexer, file(os.path.join(dirpath, f), "rt").read()
+
+def test_fast_lexer_corner_cases():
+    for code in [
+            "iffy if if2 sources2 true truex true. false configurationx",
+            "a//b c", "//x\n", "//\r\n", "// x\rfoo\n", "//no newline",
+            "/*x*/y", "a/*x*/", "/*/", "/**/", "/*a*b**/", "x /* a\n b */ y",
+            "/x", "/ /b", "/\n", "a\r\nb\rc",
+            "== = =x ! != : :: ::: += + & && | ||",
+            "$(a) $a", "@srcdir/x @srcdir2 @a_b @ @Ab",
+            "\"a\\\"b\" c", "'x' 'a\\'b'", "'a\nb' \"a\nb\"", "\"unterminated",
+            "headers{} a=b;c+=d x==y a:b,c",
+            "\t  \t#",
+            ]:
+        _check_fast_lexer(code)
+
+
+def test_quoted_strings_fast_path():
+    """
+    Checks that quoted strings without variable references, which are
+    handled without the island grammar parser, produce the same nodes and
+    warnings as when they are parsed with it.
+    """
+    import antlr3
+    import bkl.parser.cache
+    from bkl.parser.BakefileParser import DOUBLE_QUOTED_TEXT
+    parser = bkl.parser.get_parser("", "test.bkl")
+    token = antlr3.CommonToken(type=DOUBLE_QUOTED_TEXT)
+    token.line = 3
+    token.charPositionInLine = 7
+    for text in ['"foo"', '"foo bar"', '"-DFOO=\\"x\\""', '"a\\\\b"', '"\\q\\x"',
+                 '"multi\nline\\t"']:
+        token.text = text
+        with bkl.parser.cache.WarningsRecorder() as fast_warnings:
+            fast = parser.parse_quoted_str(token)
+        with bkl.parser.cache.WarningsRecorder() as full_warnings:
+            full = parser._parse_quoted_str_island(token, text[1:-1])
+        assert fast.toStringTree() == full.toStringTree()
+        assert (fast.line, fast.charPositionInLine) == (full.line, full.charPositionInLine)
+        assert fast_warnings.warnings == full_warnings.warnings
+
+
+def test_prefetch(monkeypatch):
+    """
+    Checks that files found by the prefetching scan are parsed in worker
+    processes and that parse_file() then uses the results.
+    """
+    import bkl.parser.prefetch
+    import projects
+    cwd = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(projects.__file__), "submodules"))
+    try:
+        graph = bkl.parser.prefetch.find_files("main.bkl")
+        assert graph == [
+            ("main.bkl", [("submodule", "lib/libcommon.bkl"),
+                          ("submodule", "child/child.bkl")]),
+            ("lib/libcommon.bkl", []),
+            ("child/child.bkl", []),
+            ]
+        files = [fn for fn, deps in graph]
+        expected = dict((fn, bkl.parser.parse_file.func(fn).toStringTree()) for fn in files)
+
+        bkl.parser.prefetch.prefetch("main.bkl", 2)
+        def no_parsing(*args, **kwargs):
+            assert False, "file parsed despite being prefetched"
+        monkeypatch.setattr(bkl.parser, "parse", no_parsing)
+        for fn in files:
+            assert bkl.parser.parse_file.func(fn).toStringTree() == expected[fn]
+    finally:
+        os.chdir(cwd)
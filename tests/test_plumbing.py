@@ -27,12 +27,15 @@ Misc tests of Bakefile's internals' correctness.
 """
 
 import os.path
+import pytest
 
 import bkl.interpreter
+import bkl.model
 import bkl.dumper
 import bkl.io
+import bkl.manifest
 
-from bkl.expr import BoolValueExpr, ListExpr, LiteralExpr, ConcatExpr, NullExpr
+from bkl.expr import BoolValueExpr, ListExpr, LiteralExpr, ConcatExpr, NullExpr, ReferenceExpr
 
 import projects
 projects_dir = os.path.dirname(projects.__file__) 
@@ -50,6 +53,157 @@ def test_model_cloning():
     model_copy_txt = bkl.dumper.dump_project(model_copy)
     assert model_txt == model_copy_txt
 
+    # variables are shared until modified:
+    target = model.get_target("common")
+    target_copy = model_copy.get_target("common")
+    assert target_copy is not target
+    module_copy = target_copy.parent
+    var = target.parent.get_variable("vs2008.solutionfile")
+    assert module_copy.get_variable(var.name) is var
+    module_copy.update_variable_value(var, LiteralExpr("foo"))
+    assert module_copy.get_variable(var.name) is not var
+    assert bkl.dumper.dump_project(model) == model_txt
+
+    # references in the copy are resolved in the copy:
+    target.add_variable(bkl.model.Variable("ref", ReferenceExpr("outputdir", target)))
+    model_copy = model.clone()
+    target_copy = model_copy.get_target("common")
+    target_copy.variables["outputdir"] = \
+            bkl.model.Variable("outputdir", LiteralExpr("copy"))
+    assert target_copy["ref"].context is target_copy
+    assert target_copy["ref"].as_py() == "copy"
+    assert target["ref"].as_py() != "copy"
+
+
+def test_model_indexes():
+    # lookups must not scan the whole model, or this would take ages:
+    import bkl.api
+    from bkl.parser.ast import Position
+    ttype = bkl.api.TargetType.get("action")
+    project = bkl.model.Project()
+    modules = [bkl.model.Module(project, Position("main.bkl"))]
+    for m in xrange(1, 1000):
+        # a tree of modules with 10 submodules each, 4 levels deep
+        parent = modules[(m - 1) // 10] if m > 10 else modules[0]
+        modules.append(bkl.model.Module(parent, Position("sub%d.bkl" % m)))
+    for t in xrange(10000):
+        bkl.model.Target(modules[t % 1000], "t%d" % t, ttype, None)
+
+    copy = project.clone()
+    for model in (project, copy):
+        mods = [model.scope_map.get(m, m) for m in modules]
+        for t in xrange(10000):
+            assert model.get_target("t%d" % t).parent is mods[t % 1000]
+        assert not model.has_target("t10000")
+        for m in mods:
+            for sub in m.submodules:
+                assert sub.parent is m
+                assert sub.is_submodule_of(m) and sub.is_submodule_of(mods[0])
+                assert not m.is_submodule_of(sub)
+        assert sum(len(list(m.submodules)) for m in mods) == 999
+        assert mods[999].is_submodule_of(mods[99]) and mods[999].is_submodule_of(mods[9])
+        assert not mods[999].is_submodule_of(mods[8])
+
+    # removals keep the indexes up to date:
+    copy_mods = [copy.scope_map[m] for m in modules]
+    copy_mods[5].remove_target(copy.get_target("t5"))
+    copy.remove_module(copy_mods[6])
+    assert not copy.has_target("t5") and not copy.has_target("t6") and not copy.has_target("t1006")
+    assert copy_mods[6] not in copy_mods[0].submodules
+    assert project.get_target("t6").parent is modules[6]
+    assert copy.get_target("t7").parent is copy_mods[7]
+
+
+def test_removed_middle_module(tmpdir):
+    # submodules of a module removed from the model are still generated and
+    # their dependencies count as dependencies of their ancestors:
+    tmpdir.join("main.bkl").write("toolsets = gnu;\nsubmodule a/a.bkl;\nsubmodule b/b.bkl;\n")
+    tmpdir.join("a", "a.bkl").write("submodule m/m.bkl;\nlibrary alib { sources { a.c } }\n", ensure=True)
+    tmpdir.join("a", "m", "m.bkl").write("toolsets = vs2010;\nsubmodule c/c.bkl;\n", ensure=True)
+    tmpdir.join("a", "m", "c", "c.bkl").write(
+        "toolsets = gnu;\nprogram cprog { deps = blib; sources { c.c } }\n", ensure=True)
+    tmpdir.join("b", "b.bkl").write("library blib { sources { b.c } }\n", ensure=True)
+    bkl.io._all_written_files.clear()
+    i = bkl.interpreter.Interpreter()
+    i.process_file(str(tmpdir.join("main.bkl")))
+    assert not tmpdir.join("a", "m", "GNUmakefile").check()
+    assert tmpdir.join("a", "m", "c", "GNUmakefile").check()
+    assert "\na: b\n" in tmpdir.join("GNUmakefile").read()
+
+
+def test_cached_variable_resolution():
+    import bkl.api
+    from bkl.parser.ast import Position
+    project = bkl.model.Project()
+    module = bkl.model.Module(project, Position("main.bkl"))
+    target = bkl.model.Target(module, "hello", bkl.api.TargetType.get("action"), None)
+    stats = bkl.model.resolution_stats
+
+    assert target.resolve_variable("foo") is None
+    stats.reset()
+    assert target.resolve_variable("foo") is None
+    assert stats.hits == 1 and stats.misses == 0
+
+    # adding a variable invalidates cached resolutions of its name:
+    project.add_variable(bkl.model.Variable("foo", LiteralExpr("project")))
+    assert target["foo"].as_py() == "project"
+    module.add_variable(bkl.model.Variable("foo", LiteralExpr("module")))
+    assert target["foo"].as_py() == "module"
+    assert project["foo"].as_py() == "project"
+    # as does modifying it:
+    module.update_variable_value(module.get_variable("foo"), LiteralExpr("changed"))
+    assert target["foo"].as_py() == "changed"
+    # but not of other names:
+    stats.reset()
+    target.add_variable(bkl.model.Variable("bar", LiteralExpr("target")))
+    assert target["foo"].as_py() == "changed"
+    assert stats.hits == 1
+
+    # the caches are not shared with copies of the model:
+    copy = project.clone()
+    copy_target = copy.get_target("hello")
+    assert copy_target["foo"].as_py() == "changed"
+    copy_target.add_variable(bkl.model.Variable("foo", LiteralExpr("copy")))
+    assert copy_target["foo"].as_py() == "copy"
+    assert target["foo"].as_py() == "changed"
+
+
+def test_cached_default_exprs():
+    import bkl.api
+    from bkl.parser.ast import Position
+    from bkl.vartypes import StringType
+    project = bkl.model.Project()
+    module = bkl.model.Module(project, Position("main.bkl"))
+    target = bkl.model.Target(module, "hello", bkl.api.TargetType.get("action"), None)
+
+    calls = []
+    def default(t):
+        calls.append(t)
+        return t["foo"].as_py() + ".txt"
+    computed = bkl.api.Property("computed", StringType(), default=default)
+    constant = bkl.api.Property("constant", StringType(), default="hello")
+
+    project.add_variable(bkl.model.Variable("foo", LiteralExpr("project")))
+    assert computed.default_expr(target, False).as_py() == "project.txt"
+    assert computed.default_expr(target, False).as_py() == "project.txt"
+    assert len(calls) == 1
+    # changing a variable the default was computed from invalidates it:
+    project.update_variable_value(project.get_variable("foo"), LiteralExpr("changed"))
+    assert computed.default_expr(target, False).as_py() == "changed.txt"
+    module.add_variable(bkl.model.Variable("foo", LiteralExpr("module")))
+    assert computed.default_expr(target, False).as_py() == "module.txt"
+    assert len(calls) == 3
+    # but changing other variables doesn't:
+    target.add_variable(bkl.model.Variable("bar", LiteralExpr("target")))
+    assert computed.default_expr(target, False).as_py() == "module.txt"
+    assert len(calls) == 3
+    assert not computed.is_default_shared()
+
+    # defaults not depending on the context are the same everywhere:
+    e = constant.default_expr(target, False)
+    assert constant.is_default_shared()
+    assert constant.default_expr(module, False) is e
+
 
 def test_file_io_unix(tmpdir):
     p = tmpdir.join("textfile")
@@ -68,6 +222,399 @@ def test_file_io_win(tmpdir):
     assert text_read == "one\r\ntwo\r\n"
 
 
+def test_manifest(tmpdir):
+    src = tmpdir.join("foo.bkl")
+    out = tmpdir.join("foo.out")
+    manifest_dir = str(tmpdir.join("manifest"))
+    options = {"toolsets": None}
+
+    def run():
+        bkl.manifest.reset()
+        bkl.manifest.add_input(str(src))
+        bkl.io._all_written_files.pop(str(out), None)
+        f = bkl.io.OutputFile(str(out), bkl.io.EOL_UNIX)
+        f.write(src.read())
+        f.commit()
+        bkl.manifest.save(manifest_dir, str(src), options)
+
+    src.write("foo = bar;\n")
+    assert not bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+    run()
+    assert bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+    assert not bkl.manifest.is_up_to_date(manifest_dir, str(src), {"toolsets": ["gnu"]})
+
+    # changed input:
+    src.write("foo = zar;\n")
+    assert not bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+    run()
+    assert bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+
+    # modified or removed output:
+    out.write("whatever")
+    assert not bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+    out.remove()
+    assert not bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+    run()
+    bkl.manifest.remove(manifest_dir, str(src))
+    assert not bkl.manifest.is_up_to_date(manifest_dir, str(src), options)
+
+
+def test_model_snapshot(tmpdir):
+    import bkl.api
+    from bkl.interpreter import snapshot
+    from bkl.error import Error
+    src = tmpdir.join("snap.bkl")
+    src.write("""
+        toolsets = gnu;
+        program hello { sources { hello.cpp } }
+        """)
+    snapshot_dir = str(tmpdir.join("cache"))
+    options = InterpreterForTestSuite()._snapshot_options()
+
+    def process(verify=False):
+        bkl.manifest.reset()
+        i = InterpreterForTestSuite()
+        i.snapshot_dir = snapshot_dir
+        i.verify_snapshot = verify
+        i.process_file(str(src))
+        assert bkl.manifest._inputs
+        return i.model
+
+    built = process()
+    loaded = process()
+    assert loaded is not built
+    assert bkl.dumper.dump_project(loaded) == bkl.dumper.dump_project(built)
+    # extensions are the instances of this process:
+    assert loaded.get_target("hello").type is bkl.api.TargetType.get("program")
+    assert process(verify=True) is not None
+
+    # so are models specialized for toolsets:
+    i = InterpreterForTestSuite()
+    i.snapshot_dir = snapshot_dir
+    i.process_file(str(src))
+    built = i.prepare_toolset_model("gnu")
+    loaded = i.prepare_toolset_model("gnu")
+    assert loaded is not built
+    assert loaded.get_variable_value("toolset").as_py() == "gnu"
+    i.verify_snapshot = True
+    i.prepare_toolset_model("gnu")
+
+    # changed inputs invalidate the snapshot:
+    src.write(src.read().replace("hello.cpp", "hi.cpp"))
+    assert snapshot.load(snapshot_dir, str(src), options) is None
+    model = process()
+    assert "hi.cpp" in bkl.dumper.dump_project(model)
+
+    # snapshot that differs from the rebuilt model is detected:
+    model.get_target("hello").add_variable(bkl.model.Variable("bogus", LiteralExpr("x")))
+    snapshot.save(snapshot_dir, str(src), options, model)
+    try:
+        process(verify=True)
+        assert False, "mismatch not detected"
+    except Error:
+        pass
+    # ...and the snapshot is discarded:
+    assert snapshot.load(snapshot_dir, str(src), options) is None
+
+
+def test_model_snapshot_plugins(tmpdir):
+    import sys
+    import bkl.api
+    tmpdir.join("snapshot_step.py").write("""
+import os.path
+import bkl.api
+class SnapshotStep(bkl.api.CustomStep):
+    name = "snapshot_step"
+    def generate(self, model):
+        with open(os.path.join(os.path.dirname(__file__), "custom.txt"), "w") as f:
+            f.write("generated")
+""")
+    src = tmpdir.join("snap.bkl")
+    src.write("plugin snapshot_step.py;\n")
+
+    class GeneratingInterpreter(bkl.interpreter.Interpreter):
+        def generate(self):
+            self._call_custom_steps(self.model, "generate")
+
+    def process():
+        bkl.manifest.reset()
+        i = GeneratingInterpreter()
+        i.snapshot_dir = str(tmpdir.join("cache"))
+        i.process_file(str(src))
+
+    def unload_plugin():
+        # as if the project was processed by another bkl process
+        del sys.modules["bkl.plugins.snapshot_step"]
+        del bkl.api.CustomStep._implementations["snapshot_step"]
+        bkl.api._extension_instances.pop((bkl.api.CustomStep, "snapshot_step"), None)
+
+    try:
+        process()
+        assert tmpdir.join("custom.txt").read() == "generated"
+        tmpdir.join("custom.txt").remove()
+        unload_plugin()
+        # the plugin is loaded again when the snapshot is used:
+        process()
+        assert tmpdir.join("custom.txt").read() == "generated"
+    finally:
+        unload_plugin()
+
+
+def test_early_toolset_specialization():
+    import bkl.parser
+    from bkl.interpreter.builder import Builder
+    ast = bkl.parser.parse("""
+        toolsets = gnu vs2010;
+        program hello {
+            if ($(toolset) == vs2010) {
+                defines += VS;
+                sources { vs.cpp }
+            }
+            if ($(toolset) == gnu) defines += GNU;
+            if ($(toolset) != vs2010 && $(config) == Debug) defines += DBG;
+            if ($(toolset) == vs2010 || $(config) == Debug) defines += ANY;
+        }
+        """, "test.bkl")
+
+    def build(toolsets):
+        project = bkl.model.Project()
+        Builder(toolsets=toolsets).create_model(ast, project)
+        target = project.get_target("hello")
+        return (str(target.get_variable_value("defines")),
+                [str(s) for s in target.sources])
+
+    assert build(["gnu"]) == ("[GNU, (($(config) == Debug) ? DBG : null), "
+                              "(($(config) == Debug) ? ANY : null)]", [])
+    defines, sources = build(["vs2010"])
+    assert defines == "[VS, ANY]"
+    assert sources == ["file vs.cpp"]
+    # only conditions that can't be true for any of the toolsets are decided:
+    defines, sources = build(["gnu", "vs2010"])
+    assert "VS" in defines and "GNU" in defines
+    assert defines == build(None)[0]
+
+
+def test_toolset_families():
+    import bkl.parser
+    from bkl.interpreter import _group_by_family
+    assert _group_by_family(["gnu", "vs2010", "gnu-osx", "vs2008", "vs2012"]) == \
+            [["gnu", "gnu-osx"], ["vs2010", "vs2012"], ["vs2008"]]
+
+    ast = bkl.parser.parse("""
+        toolsets = gnu gnu-osx;
+        program hello {
+            sources { hello.cpp }
+            if ($(toolset) == gnu) defines += GNU;
+            if ($(toolset) == gnu-osx && $(config) == Debug) defines += OSX;
+        }
+        """, "test.bkl")
+
+    def dumps(family):
+        i = bkl.interpreter.Interpreter()
+        i.pass_manager.skip_diagnostics = True
+        i.add_module(ast, i.model)
+        i.finalize()
+        result = []
+        for t in ["gnu", "gnu-osx"]:
+            model = i.prepare_toolset_model(t, family=family)
+            result.append(bkl.dumper.dump_project(model))
+        return result
+
+    shared = dumps(["gnu", "gnu-osx"])
+    assert shared == dumps(None)
+    assert "GNU" in shared[0] and "GNU" not in shared[1]
+
+
+def _generate_in(tmpdir, project, jobs):
+    import shutil
+    d = tmpdir.join(project)
+    def generated_files(path, names):
+        return [n for n in names
+                if os.path.isfile(os.path.join(path, n)) and not n.endswith(".bkl")]
+    shutil.copytree(os.path.join(projects_dir, project), str(d), ignore=generated_files)
+    bkl.io._all_written_files.clear()
+    bkl.io.num_created = 0
+    i = bkl.interpreter.Interpreter()
+    i.jobs = jobs
+    i.process_file(str(d.join("main.bkl")))
+    return (bkl.io.num_created,
+            dict((f.relto(d), f.read("rb")) for f in d.visit() if f.check(file=1)))
+
+def test_parallel_generation(tmpdir):
+    serial = _generate_in(tmpdir.mkdir("serial"), "submodules", 1)
+    parallel = _generate_in(tmpdir.mkdir("parallel"), "submodules", 3)
+    assert serial[0] > 0
+    assert serial == parallel
+
+def test_daemon(tmpdir):
+    import shutil
+    from StringIO import StringIO
+    import bkl.daemon
+    import bkl.parser
+    d = tmpdir.join("submodules")
+    def generated_files(path, names):
+        return [n for n in names
+                if os.path.isfile(os.path.join(path, n)) and not n.endswith(".bkl")]
+    shutil.copytree(os.path.join(projects_dir, "submodules"), str(d), ignore=generated_files)
+
+    def handler(argv):
+        i = bkl.interpreter.Interpreter()
+        i.process_file(argv[0])
+        print "created files: %d" % bkl.io.num_created
+        return 0
+
+    maxsize = bkl.parser._parse_file.maxsize
+    daemon = bkl.daemon.Daemon(str(tmpdir.join("socket")), handler, ["main.bkl"])
+    try:
+        out = StringIO()
+        assert daemon.run(["main.bkl"], str(d), out) == 0
+        assert out.getvalue() != "created files: 0\n"
+        assert ("main.bkl",) in bkl.parser._parse_file.cache
+
+        # global state of the previous run must not affect the next one:
+        out = StringIO()
+        assert daemon.run(["main.bkl"], str(d), out) == 0
+        assert out.getvalue() == "created files: 0\n"
+
+        # changed files are parsed again:
+        main = d.join("main.bkl")
+        main.setmtime(main.mtime() + 10)
+        assert daemon._check_changes()
+        assert ("main.bkl",) not in bkl.parser._parse_file.cache
+
+        err = StringIO()
+        assert daemon.run(["missing.bkl"], str(d), StringIO(), err) == 1
+        assert "IOError" in err.getvalue()
+    finally:
+        daemon.close()
+        bkl.parser.keep_parsed_files = False
+        bkl.parser._parse_file.maxsize = maxsize
+        bkl.parser.parse_file.clear()
+
+
+def test_map_in_workers(tmpdir):
+    import bkl.interpreter.parallel
+    import bkl.parser
+    src = tmpdir.join("common.bkl")
+    src.write("toolsets = gnu;\n")
+
+    def process(name):
+        bkl.parser.parse_file(str(src))
+        return (name, sorted(bkl.manifest._inputs), bkl.io.num_created)
+
+    bkl.manifest.reset()
+    bkl.parser.parse_file(str(src))
+    bkl.io.num_created = 10
+    try:
+        results = list(bkl.interpreter.parallel.map_in_workers(process, ["a", "b", "c"], 2))
+    finally:
+        bkl.parser.parse_file.forget(str(src))
+    # every item starts with reset state, but files parsed before are kept:
+    assert results == [(x, [str(src)], 0) for x in ["a", "b", "c"]]
+
+
+def test_error_pickling():
+    import pickle
+    from bkl.error import TypeError
+    from bkl.parser.ast import Position
+    e = pickle.loads(pickle.dumps(TypeError("string", "foo", "bad", pos=Position("foo.bkl", 1, 2))))
+    assert isinstance(e, TypeError)
+    assert str(e) == 'foo.bkl:1:2: expression "foo" is not a valid string value: bad'
+    # positions are pickled with the filename, not its process-local ID:
+    data = pickle.dumps(Position("bar.bkl", 3), 2)
+    assert "bar.bkl" in data
+    assert pickle.loads(data) == Position("bar.bkl", 3)
+
+
+def test_eliminate_superfluous_conditionals_chain():
+    from bkl.expr import IfExpr
+    from bkl.parser.ast import Position
+    from bkl.interpreter.passes import eliminate_superfluous_conditionals
+    project = bkl.model.Project()
+    module = bkl.model.Module(project, Position("test.bkl"))
+    # variables referencing variables that come after them, so that
+    # simplifying the first ones requires several passes:
+    count = 10
+    for i in range(count):
+        value = IfExpr(BoolValueExpr(True),
+                       ReferenceExpr("v%d" % (i+1), module),
+                       LiteralExpr("no"))
+        module.add_variable(bkl.model.Variable("v%d" % i, value))
+    module.add_variable(bkl.model.Variable("v%d" % count, LiteralExpr("yes")))
+    module.add_variable(bkl.model.Variable("unrelated", ListExpr([LiteralExpr("x")])))
+
+    eliminate_superfluous_conditionals(project)
+    for i in range(count + 1):
+        assert module.get_variable("v%d" % i).value.as_py() == "yes"
+
+
+def test_process_variables_long_chain():
+    from bkl.parser.ast import Position
+    from bkl.interpreter.passes import process_variables
+    project = bkl.model.Project()
+    module = bkl.model.Module(project, Position("test.bkl"))
+    # each variable depends on the next one, so processing the first one
+    # walks a chain of dependencies longer than the recursion limit:
+    count = 2000
+    for i in range(count):
+        value = ConcatExpr([ReferenceExpr("v%d" % (i+1), module), LiteralExpr("x")])
+        module.add_variable(bkl.model.Variable("v%d" % i, value))
+    module.add_variable(bkl.model.Variable("v%d" % count, LiteralExpr("y")))
+
+    process_variables(project)
+    assert module.get_variable("v%d" % (count-1)).value.as_py() == "yx"
+
+
+def test_pass_manager():
+    from bkl.interpreter.passmanager import PassManager, Pass, FINALIZE, TOOLSET
+    from bkl.error import Error
+    calls = []
+    def make_pass(name, deps=[], diagnostic=False):
+        return Pass(name, FINALIZE, lambda model: calls.append(name),
+                    deps=deps, diagnostic=diagnostic)
+
+    pm = PassManager([make_pass("check", diagnostic=True),
+                      make_pass("last", deps=["b"]),
+                      make_pass("a"),
+                      make_pass("b", deps=["a"])])
+    pm.register(Pass("a", TOOLSET, lambda model, toolset: calls.append(toolset)))
+    assert [p.name for p in pm.get_passes(FINALIZE)] == ["check", "a", "b", "last"]
+
+    pm.time_passes = True
+    pm.run(FINALIZE, None)
+    pm.run(TOOLSET, None, "gnu")
+    assert calls == ["check", "a", "b", "last", "gnu"]
+    assert [(phase, s.name, s.runs) for phase, s in pm.get_stats()] == \
+        [(FINALIZE, "check", 1), (FINALIZE, "a", 1), (FINALIZE, "b", 1),
+         (FINALIZE, "last", 1), (TOOLSET, "a", 1)]
+
+    del calls[:]
+    pm.skip_diagnostics = True
+    pm.run(FINALIZE, None)
+    assert calls == ["a", "b", "last"]
+
+    pm.register(make_pass("cycle1", deps=["cycle2"]))
+    pm.register(make_pass("cycle2", deps=["cycle1"]))
+    try:
+        pm.get_passes(FINALIZE)
+        assert False, "circular dependency not detected"
+    except Error:
+        pass
+
+
+def test_pass_manager_provides():
+    from bkl.interpreter.passmanager import PassManager, Pass, FINALIZE
+    calls = []
+    def make_pass(name, deps=[], provides=[]):
+        return Pass(name, FINALIZE, lambda model: calls.append(name),
+                    deps=deps, provides=provides)
+
+    pm = PassManager([make_pass("last", deps=["b"]),
+                      make_pass("fused", provides=["a", "b"])])
+    pm.run(FINALIZE, None)
+    assert calls == ["fused", "last"]
+
+
 def test_expr_as_bool():
     bool_yes = BoolValueExpr(True)
     bool_no = BoolValueExpr(False)
@@ -87,6 +634,175 @@ def test_expr_as_bool():
     assert not bool(empty_literal)
     assert not bool(empty_concat)
 
+def test_interned_exprs():
+    import bkl.parser
+    from bkl.expr import InterningExprFactory, are_equal
+    from bkl.interpreter.builder import Builder
+    from bkl.parser.ast import Position
+    f = InterningExprFactory()
+    a = f.list([f.literal("foo", pos=Position("a.bkl", 1)), f.literal("")])
+    b = f.list([f.literal("foo", pos=Position("b.bkl", 2)), f.literal("")])
+    assert a is b
+    assert str(a.items[0].pos) == "a.bkl:1"
+    assert f.list([f.literal("foo")]) is not a
+    assert f.bool_value(False) is f.bool_value(False)
+    assert are_equal(a, b)
+
+    ast = bkl.parser.parse("""
+        program hello {
+            if ($(config) == Debug) defines += FOO;
+            if ($(config) == Debug) libs += FOO;
+        }
+        """, "test.bkl")
+    project = bkl.model.Project()
+    Builder(exprs=f).create_model(ast, project)
+    target = project.get_target("hello")
+    defines = target.get_variable_value("defines").items[-1]
+    libs = target.get_variable_value("libs").items[-1]
+    assert defines is libs
+    assert str(defines) == "(($(config) == Debug) ? FOO : null)"
+
+def test_compact_source_files():
+    import gc
+    import pickle
+    import weakref
+    import bkl.parser
+    from bkl.interpreter.builder import Builder
+    ast = bkl.parser.parse("""
+        program hello {
+            sources { a.cpp b.cpp c.cpp }
+            if ($(toolset) == gnu) sources { gnu.cpp }
+            b.cpp::compile-commands = "touch %(out)";
+        }
+        """, "test.bkl")
+    project = bkl.model.Project()
+    Builder().create_model(ast, project)
+    hello = project.get_target("hello")
+    sources = hello.sources
+
+    assert len(sources) == 4
+    assert [f.name for f in sources] == ["a.cpp", "b.cpp", "c.cpp", "gnu.cpp"]
+    # only files with settings of their own are kept as objects:
+    a, b, c, gnu = sources
+    assert b is sources._parts[1] and gnu is sources._parts[3]
+    assert sources._parts[0]() is a
+    # others exist only while used:
+    assert sources[0] is a
+    a_ref = weakref.ref(a)
+    del a
+    gc.collect()
+    assert a_ref() is None
+
+    # modifying them keeps them:
+    c.add_variable(bkl.model.Variable("foo", LiteralExpr("bar")))
+    assert sources._parts[2] is c
+    sources.remove(gnu)
+    assert [f.name for f in sources] == ["a.cpp", "b.cpp", "c.cpp"]
+    assert gnu not in sources
+
+    # removing files doesn't search for them and keeps the others' indices:
+    for n in xrange(1000):
+        sources.add_file(LiteralExpr("f%d.cpp" % n), None)
+    many = sources[3:]
+    for f in many[::2]:
+        sources.remove(f)
+    assert len(sources) == 503
+    assert all(f in sources for f in many[1::2])
+    assert not any(f in sources for f in many[::2])
+    assert sources[3] is many[1] and sources[-1] is many[-1]
+    for f in many[1::2]:
+        sources.remove(f)
+    assert [f.name for f in sources] == ["a.cpp", "b.cpp", "c.cpp"]
+    assert b in sources and c in sources
+
+    # the files and their variables are the same in copies of the model:
+    for model in (project.clone(), pickle.loads(pickle.dumps(project, 2))):
+        files = model.get_target("hello").sources
+        assert [str(f) for f in files] == [str(f) for f in sources]
+        assert [f.variables.keys() for f in files] == [f.variables.keys() for f in sources]
+        assert files[2]["foo"].as_py() == "bar"
+
+
+def test_configuration_proxies():
+    import bkl.parser
+    from bkl.interpreter.builder import Builder
+    ast = bkl.parser.parse("""
+        program hello {
+            if ($(config) == Debug) defines += FOO;
+            if ($(arch) == x86) defines += BAR;
+        }
+        program world {
+            configurations = Debug Testing;
+        }
+        """, "test.bkl")
+    project = bkl.model.Project()
+    Builder().create_model(ast, project)
+    hello = project.get_target("hello")
+
+    debug, release = list(hello.configurations)
+    assert debug.name == "Debug" and release.name == "Release"
+    debug.arch = release.arch = "x86"
+    assert [str(x) for x in debug["defines"]] == ["FOO", "BAR"]
+    assert [str(x) for x in release["defines"]] == ["BAR"]
+    debug.arch = "x86_64"
+    assert [str(x) for x in debug["defines"]] == ["FOO"]
+
+    # resolved values are shared by all proxies for the same configuration:
+    again = list(hello.configurations)[0]
+    again.arch = "x86_64"
+    assert again["defines"] is debug["defines"] is not release["defines"]
+    assert again.apply_subst(hello["defines"]) is again["defines"]
+
+    # the configurations are checked when used:
+    world = project.get_target("world")
+    with pytest.raises(bkl.error.Error):
+        list(world.configurations)
+    project.add_configuration(bkl.model.Configuration("Testing", base=None, is_debug=False))
+    assert [c.name for c in world.configurations] == ["Debug", "Testing"]
+
+def test_compiled_templates():
+    import bkl.parser
+    from bkl.interpreter.builder import Builder
+    ast = bkl.parser.parse("""
+        configuration Testing : Debug {
+            defines += TESTING;
+        }
+        configuration Coverage : Testing {
+            defines += COVERAGE;
+        }
+        template common {
+            defines += "ID=$(id)" SHARED;
+            if ($(config) == Release) sources { $(id).cpp }
+        }
+        program hello : common {}
+        program world : common {}
+        """, "test.bkl")
+    project = bkl.model.Project()
+    Builder().create_model(ast, project)
+    hello = project.get_target("hello")
+    world = project.get_target("world")
+
+    # the template's content is compiled only once...
+    template = project.templates["common"]
+    assert len(template._patch) == 2
+    h1, h2 = hello["defines"].items[-2:]
+    w1, w2 = world["defines"].items[-2:]
+    assert h2 is w2
+    # ...but references in it are bound to each target:
+    assert h1.items[1].context is hello and w1.items[1].context is world
+    assert hello.sources[0]["_filename"].items[0].context is hello
+    assert world.sources[0]["_filename"].items[0].context is world
+
+    # derived configurations include the content of their bases:
+    coverage = project.configurations["Coverage"]
+    assert coverage._patch[0] is project.configurations["Testing"]._patch[0]
+    module = hello.parent
+    defines = [str(x) for x in module["defines"]]
+    assert defines == ["(($(config) == Testing) ? TESTING : null)",
+                       "(($(config) == Coverage) ? TESTING : null)",
+                       "(($(config) == Coverage) ? COVERAGE : null)"]
+    assert all(x.cond.left.context is module for x in module["defines"])
+
 def test_list_expr_iterator():
     bool_yes = BoolValueExpr(True)
     bool_no = BoolValueExpr(False)